@@ -0,0 +1,367 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from classes import StageResult
+from durability import DEFAULT_DURABILITY, DURABILITY_LEVELS
+from manager import BackupManager
+from metrics import METRICS
+from scanner import scan_files
+
+logger = logging.getLogger(__name__)
+
+# Shapes of the synthetic trees at scale 1.0: how many files, the size range of
+# a file, its content (compressible text or random bytes) and how deep it is nested
+DATASETS = {
+    "tiny": {"files": 5000, "size": (0, 2048), "kind": "text", "depth": 2},
+    "huge": {"files": 3, "size": (48 << 20, 64 << 20), "kind": "random", "depth": 0},
+    "compressible": {"files": 200, "size": (256 << 10, 256 << 10), "kind": "text", "depth": 1},
+    "random": {"files": 200, "size": (256 << 10, 256 << 10), "kind": "random", "depth": 1},
+    "deep": {"files": 2000, "size": (0, 4096), "kind": "text", "depth": 16},
+}
+
+# (compression, password) of every measured combination
+COMBINATIONS = ((False, None), (True, None), (False, "bench"), (True, "bench"))
+
+# Share of the files changed before the second, incremental run
+CHANGED_SHARE = 0.01
+
+# A regression is reported when a stage gets slower than this share of the baseline
+REGRESSION_TOLERANCE = 0.10
+
+WORDS = (
+    b"backup", b"version", b"manifest", b"object", b"storage", b"restore",
+    b"project", b"file", b"hash", b"data", b"the", b"of", b"and", b"to",
+    b"config", b"value", b"error", b"user", b"id", b"timestamp",
+)
+
+
+def _text(rng: random.Random, size: int) -> bytes:
+    # Log-like lines: compresses about as well as source code and CSV exports
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+        out += b" %d\n" % rng.getrandbits(32)
+    return bytes(out[:size])
+
+
+def _content(rng: random.Random, kind: str, size: int) -> bytes:
+    return _text(rng, size) if kind == "text" else rng.randbytes(size)
+
+
+def _file_path(index: int, depth: int) -> str:
+    # Four directories per level; "deep" trees get one long chain of them
+    parts = [f"d{(index >> (2 * level)) % 4}" for level in range(depth)]
+    return "/".join(parts + [f"f{index:06d}.dat"])
+
+
+def generate_dataset(
+    root: Path, name: str, scale: float = 1.0, seed: int = 0
+) -> tuple[int, int]:
+    # The same name, scale and seed always give the same tree. Returns (files, bytes)
+    shape = DATASETS[name]
+    rng = random.Random(f"{name}-{seed}")
+    count = max(1, int(shape["files"] * scale))
+    low, high = shape["size"]
+    if scale < 1 and shape["files"] * scale < 1:
+        # Fewer huge files than one: smaller files instead
+        low, high = int(low * scale), int(high * scale)
+    total = 0
+    for index in range(count):
+        path = root / _file_path(index, shape["depth"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = _content(rng, shape["kind"], rng.randint(low, high))
+        path.write_bytes(data)
+        total += len(data)
+    return count, total
+
+
+def mutate_dataset(root: Path, name: str, share: float = CHANGED_SHARE, seed: int = 0) -> int:
+    # Appends to a reproducible share of the files (at least one), returns how many
+    shape = DATASETS[name]
+    rng = random.Random(f"{name}-{seed}-mutate")
+    paths = sorted(p for p in root.rglob("*") if p.is_file())
+    changed = rng.sample(paths, max(1, int(len(paths) * share)))
+    for path in changed:
+        with open(path, "ab") as f:
+            f.write(_content(rng, shape["kind"], 1024))
+    return len(changed)
+
+
+def _proc_io() -> dict:
+    # Counters of the whole process (all threads); Linux only
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the peak RSS (VmHWM) of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        # Not measured there
+        return 0
+    # Elsewhere: the peak of the whole run (bytes on macOS, kilobytes on Linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def measure(
+    stage: str,
+    run: Callable[[], tuple[int, int]],
+    dataset: str,
+    compress: bool,
+    encrypted: bool,
+    durability: str = DEFAULT_DURABILITY,
+) -> StageResult:
+    # run() does the work and returns (files, bytes) it handled.
+    # Progress output is not measured, it goes to /dev/null
+    _reset_peak_rss()
+    METRICS.reset()
+    io_before = _proc_io()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        files, size = run()
+        seconds = time.perf_counter() - started
+    io_after = _proc_io()
+
+    def delta(key):
+        if key not in io_before or key not in io_after:
+            return None
+        return io_after[key] - io_before[key]
+
+    return StageResult(
+        dataset=dataset,
+        compress=compress,
+        encrypted=encrypted,
+        stage=stage,
+        files=files,
+        bytes=size,
+        seconds=round(seconds, 4),
+        files_per_s=round(files / seconds, 1) if seconds else 0.0,
+        mb_per_s=round(size / (1024**2) / seconds, 2) if seconds else 0.0,
+        peak_rss_kb=_peak_rss_kb(),
+        read_syscalls=delta("syscr"),
+        write_syscalls=delta("syscw"),
+        read_chars=delta("rchar"),
+        write_chars=delta("wchar"),
+        stages=METRICS.snapshot(),
+        durability=durability,
+    )
+
+
+def run_dataset(
+    work_dir: Path,
+    name: str,
+    scale: float = 1.0,
+    seed: int = 0,
+    jobs: int = 1,
+    combinations: Iterable[tuple[bool, Optional[str]]] = COMBINATIONS,
+    durability: str = DEFAULT_DURABILITY,
+) -> list[StageResult]:
+    # Every stage for every combination: scan, backup, rescan and backup after a
+    # small change (stat cache warm), restore of the last version
+    results = []
+    for compress, password in combinations:
+        source = work_dir / "source"
+        storage = work_dir / "storage"
+        restore = work_dir / "restore"
+        for path in (source, storage, restore):
+            shutil.rmtree(path, ignore_errors=True)
+        files, size = generate_dataset(source, name, scale, seed)
+        manager = BackupManager(storage, durability=durability)
+        scans = {}
+
+        def scan(key):
+            cache = manager.get_stat_cache(name)
+            scans[key] = scan_files(source, stat_cache=cache, workers=jobs)
+            cache.save()
+            return scans[key].total_files, scans[key].total_size
+
+        def backup(key):
+            manager.create_backup(
+                scans[key], source, name, compress=compress, password=password, jobs=jobs
+            )
+            return scans[key].total_files, scans[key].total_size
+
+        def restore_last():
+            v_dir = manager._find_target_versions(name)[-1]
+            report = manager.restore_version(
+                name, v_dir.name, restore, password=password, jobs=jobs
+            )
+            if len(report.ok) != report.total:
+                raise RuntimeError(f"Restore of {name} failed: {report}")
+            return report.total, scans["second"].total_size
+
+        def add(stage, run):
+            results.append(
+                measure(stage, run, name, compress, bool(password), durability)
+            )
+            logger.info(
+                f"{name:13} compress={compress!s:5} encrypted={bool(password)!s:5} "
+                f"durability={durability:6} {stage:18} {results[-1].seconds:8.3f}s "
+                f"{results[-1].mb_per_s:9.2f} MB/s"
+            )
+
+        add("scan", lambda: scan("first"))
+        add("backup", lambda: backup("first"))
+        mutate_dataset(source, name, seed=seed)
+        # A new version needs a new timestamp
+        time.sleep(1)
+        add("rescan", lambda: scan("second"))
+        add("backup-incremental", lambda: backup("second"))
+        add("restore", restore_last)
+        manager.close()
+        logger.debug(f"{name}: {files} files, {size} bytes")
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    # Stages that got slower than the baseline by more than the tolerance
+    def key(result):
+        return (
+            result["dataset"],
+            result["compress"],
+            result["encrypted"],
+            result.get("durability", DEFAULT_DURABILITY),
+            result["stage"],
+        )
+
+    old = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = old.get(key(result))
+        if not before or not before["seconds"]:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append(
+                f"{'/'.join(str(part) for part in key(result))}: "
+                f"{before['seconds']:.3f}s -> {result['seconds']:.3f}s (+{(ratio - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Smart-Backup benchmark")
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        choices=sorted(DATASETS),
+        default=list(DATASETS),
+        help="Synthetic trees to measure",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiplies the number of files"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker threads")
+    parser.add_argument(
+        "--durability",
+        nargs="+",
+        choices=DURABILITY_LEVELS,
+        default=[DEFAULT_DURABILITY],
+        help="fsync policies to measure, to see what each one costs",
+    )
+    parser.add_argument(
+        "--out", default="benchmark.json", help="Where the results are written"
+    )
+    parser.add_argument(
+        "--baseline", help="Results of an earlier run to compare with"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=REGRESSION_TOLERANCE,
+        help="Slowdown share reported as a regression",
+    )
+    parser.add_argument(
+        "--work-dir", help="Where the trees are generated (a temporary folder by default)"
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Only the benchmark itself reports
+    for name in ("manager", "scanner", "object_store", "catalog", "stat_cache"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp:
+        for name in args.datasets:
+            for durability in args.durability:
+                results += run_dataset(
+                    Path(tmp) / name,
+                    name,
+                    args.scale,
+                    args.seed,
+                    args.jobs,
+                    durability=durability,
+                )
+
+    rows = [asdict(result) for result in results]
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "scale": args.scale,
+            "seed": args.seed,
+            "jobs": args.jobs,
+            "durability": args.durability,
+        },
+        "results": rows,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(rows, baseline, args.tolerance)
+        for line in regressions:
+            logger.warning(f"Regression: {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
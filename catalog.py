@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+from file_lock import file_lock
+from manifest import manifest_exists, open_manifest
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = "catalog.json"
+# Held while the catalog is read, changed and written back
+CATALOG_LOCK_NAME = "catalog.lock"
+CATALOG_VERSION = 1
+
+# Fields of the manifest "info" block that are copied into the catalog
+SUMMARY_FIELDS = (
+    "timestamp",
+    "comment",
+    "salt",
+    "encryption",
+    "compression_enabled",
+    "total_files",
+    "total_bytes",
+)
+
+
+class VersionCatalog:
+    # Summary of every version of every project in one small file, so listing
+    # versions and reading their settings does not open any manifest.
+    # Several processes may write to one storage (a watch daemon and a manual backup):
+    # every change is read-merge-write under a lock file, and the catalog is read again
+    # whenever the file changed since it was loaded.
+    def __init__(self, backup_base: Path):
+        self.backup_base = backup_base
+        self.path = backup_base / CATALOG_NAME
+        self.lock_path = backup_base / CATALOG_LOCK_NAME
+        self._projects = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        # A rename puts a new inode in place, the size and mtime catch anything else
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _load(self, locked: bool = False) -> dict:
+        stamp = self._file_stamp()
+        if self._projects is not None and stamp == self._stamp:
+            return self._projects
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != CATALOG_VERSION:
+                raise ValueError(f"unknown catalog version {data.get('version')}")
+            self._projects = data["projects"]
+            self._stamp = stamp
+        except FileNotFoundError:
+            self._rebuild() if locked else self.rebuild()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"The version catalog is damaged, rebuilding it: {e}")
+            self._rebuild() if locked else self.rebuild()
+        return self._projects
+
+    def _save(self):
+        if not self.backup_base.exists():
+            return
+        # Written to a temporary file and renamed: readers never see a half-written catalog
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": CATALOG_VERSION, "projects": self._projects},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.path)
+        self._stamp = self._file_stamp()
+
+    def _update(self, change: Callable[[dict], None]):
+        # change edits the projects as they are on disk now, not as this process saw them
+        with self._lock:
+            if not self.backup_base.exists():
+                change(self._load())
+                return
+            with file_lock(self.lock_path):
+                # A copy: readers in other threads may be iterating over the old dict
+                projects = {
+                    p_name: dict(versions)
+                    for p_name, versions in self._load(locked=True).items()
+                }
+                change(projects)
+                self._projects = projects
+                self._save()
+
+    def rebuild(self):
+        with self._lock:
+            if not self.backup_base.exists():
+                self._rebuild()
+                return
+            with file_lock(self.lock_path):
+                self._rebuild()
+
+    def _rebuild(self):
+        # The slow path: read the manifest of every version once
+        projects = {}
+        if self.backup_base.exists():
+            for p_dir in self.backup_base.iterdir():
+                if not p_dir.is_dir() or p_dir.name == "objects":
+                    continue
+                for v_dir in p_dir.iterdir():
+                    if not manifest_exists(v_dir):
+                        continue
+                    try:
+                        info = open_manifest(v_dir).info
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning(f"Skip damaged manifest in {v_dir}: {e}")
+                        continue
+                    projects.setdefault(p_dir.name, {})[v_dir.name] = summarize(info)
+        self._projects = projects
+        try:
+            self._save()
+        except OSError as e:
+            logger.warning(f"The version catalog cannot be saved: {e}")
+
+    def add(self, project_name: str, version_name: str, info: dict):
+        def change(projects):
+            projects.setdefault(project_name, {})[version_name] = summarize(info)
+
+        self._update(change)
+
+    def remove(self, project_name: str, version_name: str):
+        def change(projects):
+            versions = projects.get(project_name, {})
+            versions.pop(version_name, None)
+            if not versions:
+                projects.pop(project_name, None)
+
+        self._update(change)
+
+    def _reconcile(self, projects: dict, project_name: Optional[str]) -> dict:
+        # Version folders made or removed behind the catalog's back (by hand, or by a
+        # writer that lost its update): one listing per project, manifests are opened
+        # only for versions the catalog does not know
+        names = [project_name] if project_name else list(projects)
+        if not project_name and self.backup_base.exists():
+            with os.scandir(self.backup_base) as it:
+                names += [
+                    e.name
+                    for e in it
+                    if e.is_dir() and e.name != "objects" and e.name not in projects
+                ]
+        found, gone = {}, []
+        for p_name in names:
+            try:
+                with os.scandir(self.backup_base / p_name) as it:
+                    on_disk = {e.name for e in it if e.is_dir()}
+            except FileNotFoundError:
+                on_disk = set()
+            known = projects.get(p_name, {})
+            gone += [(p_name, v_name) for v_name in known if v_name not in on_disk]
+            for v_name in on_disk.difference(known):
+                v_dir = self.backup_base / p_name / v_name
+                if not manifest_exists(v_dir):
+                    # Not a version, or one still being written
+                    continue
+                try:
+                    found[(p_name, v_name)] = summarize(open_manifest(v_dir).info)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Skip damaged manifest in {v_dir}: {e}")
+        if not found and not gone:
+            return projects
+
+        logger.info(
+            f"Version catalog: {len(found)} versions added, {len(gone)} missing ones dropped"
+        )
+
+        def change(projects):
+            for (p_name, v_name), summary in found.items():
+                projects.setdefault(p_name, {})[v_name] = summary
+            for p_name, v_name in gone:
+                versions = projects.get(p_name, {})
+                versions.pop(v_name, None)
+                if not versions:
+                    projects.pop(p_name, None)
+
+        self._update(change)
+        return self._load()
+
+    def get(self, project_name: str, version_name: str) -> Optional[dict]:
+        return self._load().get(project_name, {}).get(version_name)
+
+    def find(
+        self,
+        project_name: str = None,
+        date_hint: str = None,
+        since: str = None,
+        until: str = None,
+    ) -> list[tuple[str, str]]:
+        # Version names are timestamps (YYYY-mm-dd_HH-MM-SS), so they compare as dates
+        projects = self._reconcile(self._load(), project_name)
+        names = [project_name] if project_name else list(projects)
+        found = []
+        for p_name in names:
+            for v_name in projects.get(p_name, {}):
+                if date_hint and date_hint not in v_name:
+                    continue
+                if since and v_name < since:
+                    continue
+                if until and v_name[: len(until)] > until:
+                    continue
+                found.append((p_name, v_name))
+        found.sort(key=lambda x: x[1])
+        return found
+
+
+def summarize(info: dict) -> dict:
+    return {key: info[key] for key in SUMMARY_FIELDS if key in info}
@@ -0,0 +1,78 @@
+import zlib
+from typing import BinaryIO, Iterator
+
+# Content-defined chunking. Whether a position is a chunk border depends only on the
+# bytes right before it, so an insert or an edit moves only the nearby borders and the
+# other chunks keep their hashes.
+#
+# A classic rolling hash (FastCDC gear, Rabin) has to run Python code for every byte,
+# which is a few MB/s. Here the hash is evaluated only at anchor bytes ("\n") found by
+# bytes.find: text files break at line ends, binary data has an anchor every 256 bytes
+# on average, and the window hash itself is zlib.crc32, so the scan runs at C speed.
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Files smaller than this are stored whole
+CHUNKING_THRESHOLD = 2 * AVG_SIZE
+
+ANCHOR = b"\n"
+WINDOW = 48
+
+
+def _find_cut(
+    data: bytes,
+    start: int,
+    end: int,
+    min_size: int = MIN_SIZE,
+    avg_size: int = AVG_SIZE,
+    max_size: int = MAX_SIZE,
+) -> int:
+    if end - start <= min_size:
+        return end
+    middle = min(start + avg_size, end)
+    limit = min(start + max_size, end)
+    # Normalized chunking: a stricter mask before the average size, a looser one after it
+    # (12 and 10 bits for the 1 Mb average)
+    mask_strict = (avg_size >> 8) - 1
+    mask_loose = (avg_size >> 10) - 1
+    find = data.find
+    crc32 = zlib.crc32
+    # Nothing can be cut before min_size, so those bytes are not even looked at
+    pos = start + min_size
+    while True:
+        pos = find(ANCHOR, pos, limit)
+        if pos < 0:
+            return limit
+        mask = mask_strict if pos < middle else mask_loose
+        if not crc32(data[pos - WINDOW : pos + 1]) & mask:
+            return pos + 1
+        pos += 1
+
+
+def iter_chunks(
+    f: BinaryIO,
+    min_size: int = MIN_SIZE,
+    avg_size: int = AVG_SIZE,
+    max_size: int = MAX_SIZE,
+) -> Iterator[bytes]:
+    buffer = b""
+    start = 0
+    eof = False
+    while True:
+        # Keep at least max_size bytes buffered so a cut is never forced by the read size.
+        # Small chunks are cut one after another from the same buffer, not copied out of it
+        if not eof and len(buffer) - start < max_size:
+            buffer = buffer[start:]
+            start = 0
+            while not eof and len(buffer) < max_size:
+                block = f.read(READ_SIZE)
+                if not block:
+                    eof = True
+                buffer += block
+        if start >= len(buffer):
+            return
+        cut = _find_cut(buffer, start, len(buffer), min_size, avg_size, max_size)
+        yield buffer[start:cut]
+        start = cut
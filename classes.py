@@ -1,26 +1,124 @@
-from dataclasses import dataclass, field
-from typing import List, Optional
-from pathlib import Path
-
-
-@dataclass
-class ScanResult:
-    files: List[Path]
-    total_size: int
-    total_files: int
-    file_hashes: dict[Path, str] = field(default_factory=dict)
-
-
-@dataclass
-class CopyResult:
-    copied: int
-    skipped: int
-    quantity_versions: int
-    errors: int
-
-
-@dataclass
-class ProgressEvent:
-    processed: int
-    total: Optional[int] = None
-    current_file: str = ""
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional
+from pathlib import Path
+
+
+@dataclass
+class ScanResult:
+    files: List[Path]
+    total_size: int
+    total_files: int
+    file_hashes: dict[Path, Optional[str]] = field(default_factory=dict)
+    # Files left unhashed by the scan (hash None above), hashed while they are stored
+    deferred: dict[Path, os.stat_result] = field(default_factory=dict)
+    sizes: dict[Path, int] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class ScanRecord:
+    # One file of a streaming scan, relative to the scanned folder
+    rel_path: str
+    size: int
+    mtime_ns: int
+    hash: Optional[str]
+    # Only for files left unhashed (defer_hashing): the stat for the stat cache
+    stat: Optional[os.stat_result] = None
+
+
+@dataclass
+class CopyResult:
+    copied: int
+    skipped: int
+    quantity_versions: int
+    errors: int
+    # Files that changed between the scan and the store, left out of the version
+    changed: List[str] = field(default_factory=list)
+
+
+@dataclass
+class SyncReport:
+    uploaded: int = 0
+    uploaded_bytes: int = 0
+    # Objects already in the bucket
+    skipped: int = 0
+    manifests: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+@dataclass
+class RetentionPolicy:
+    # 0 switches a rule off; the newest version of every project is always kept
+    keep_last: int = 0
+    keep_daily: int = 0
+    keep_weekly: int = 0
+
+
+@dataclass
+class PruneReport:
+    dry_run: bool
+    # "project/version" of the versions removed by the retention policy
+    removed_versions: List[str] = field(default_factory=list)
+    kept_versions: int = 0
+    live_objects: int = 0
+    # Objects removed (or, in a dry run, that would be), and the space they take
+    dead_objects: int = 0
+    reclaimable_bytes: int = 0
+    removed_packs: int = 0
+    repacked_packs: int = 0
+
+
+@dataclass
+class VerifyReport:
+    versions: int = 0
+    # Unique objects decoded and checked, and the bytes read from the store for them
+    checked: int = 0
+    checked_bytes: int = 0
+    # Objects left out by the sample
+    sampled_out: int = 0
+    # Encrypted objects that cannot be checked without the password
+    unverifiable: int = 0
+    damaged: List[str] = field(default_factory=list)
+    missing: List[str] = field(default_factory=list)
+
+
+@dataclass
+class StageResult:
+    # One measured stage of a benchmark run
+    dataset: str
+    compress: bool
+    encrypted: bool
+    stage: str
+    files: int
+    bytes: int
+    seconds: float
+    files_per_s: float
+    mb_per_s: float
+    peak_rss_kb: int
+    # Deltas of /proc/self/io: read and write syscalls and the bytes they moved
+    read_syscalls: Optional[int] = None
+    write_syscalls: Optional[int] = None
+    read_chars: Optional[int] = None
+    write_chars: Optional[int] = None
+    # Where the time went: the stage metrics of the run (walk, hash, compress, ...)
+    stages: dict = field(default_factory=dict)
+    durability: str = "batch"
+
+
+@dataclass
+class ProgressEvent:
+    processed: int
+    total: Optional[int] = None
+    current_file: str = ""
+    # While the total is not known yet: how many files were found so far
+    found: Optional[int] = None
+
+
+@dataclass
+class RestoreReport:
+    total: int
+    ok: List[str] = field(default_factory=list)
+    damaged: List[str] = field(default_factory=list)
+    missing_object: List[str] = field(default_factory=list)
+    wrong_password: List[str] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
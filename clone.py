@@ -0,0 +1,62 @@
+import errno
+import logging
+import os
+import shutil
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ioctl_ficlone(2): the new file shares the data blocks of the old one (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+# Errors that mean "not supported here", the next way of copying is tried
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL}
+COPY_BLOCK = 1024 * 1024
+
+
+def clone_file(src: Path, dst: Path, hardlink: bool = False) -> str:
+    # A copy of src at dst made the cheapest way the filesystem allows. Returns how:
+    # "hardlink" (only if asked: both names then share one file), "reflink" (shared
+    # blocks, copied on write), "copy_range" (copied in the kernel) or "copy"
+    dst.unlink(missing_ok=True)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            logger.debug(f"No hardlink for {dst}: {e}")
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+                return "reflink"
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+
+        if hasattr(os, "copy_file_range"):
+            size = os.fstat(f_src.fileno()).st_size
+            try:
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(f_src.fileno(), f_dst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied == size:
+                    return "copy_range"
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+            # Start over with a plain copy
+            f_src.seek(0)
+            f_dst.seek(0)
+            f_dst.truncate()
+
+        shutil.copyfileobj(f_src, f_dst, COPY_BLOCK)
+        return "copy"
@@ -1,19 +1,260 @@
-import boto3
-from pathlib import Path
-
-
-class CloudManager:
-    def __init__(self, endpoint, access_key, secret_key, bucket_name):
-        self.s3 = boto3.client(
-            "s3",
-            endpoint_url=endpoint,
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-        )
-        self.bucket = bucket_name
-
-    def download_object(self, obj_hash: str, local_path: Path):
-        # Downloads a physical file from cloud objects/ to local objects/
-        s3_key = f"objects/{obj_hash[:2]}/{obj_hash}"
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        self.s3.download_file(self.bucket, s3_key, str(local_path))
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from classes import SyncReport
+from catalog import CATALOG_NAME
+from manifest import LEGACY_MANIFEST_NAME, MANIFEST_NAME
+from utils import in_order
+
+logger = logging.getLogger(__name__)
+
+# Objects above this size are sent in parts of this size, several parts at once
+MULTIPART_SIZE = 16 * 1024 * 1024
+PART_CONCURRENCY = 4
+
+# Local cache of the remote objects/ keys: a header, then 32 bytes per key.
+# A loose object is its store hash: it never changes. Any other key (pack files, which
+# grow until they are full) is the sha256 of the key and its size, so a pack that grew
+# after it was uploaded no longer counts as remote
+REMOTE_INDEX_HEADER = b"SBKRIDX1\n"
+# New records are appended in batches of this size, so an interrupted sync resumes
+REMOTE_INDEX_BATCH = 1000
+
+
+def _key_digest(key: str, size: int) -> bytes:
+    parts = key.split("/")
+    if len(parts) == 3 and len(parts[1]) == 2 and len(parts[2]) == 64:
+        return bytes.fromhex(parts[2])
+    return hashlib.sha256(f"{key}:{size}".encode()).digest()
+
+
+class CloudManager:
+    def __init__(
+        self,
+        endpoint,
+        access_key,
+        secret_key,
+        bucket_name,
+        max_connections: int = 64,
+        region_name=None,
+    ):
+        # The pool has to be large enough for every worker and every part in flight
+        self.s3 = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=region_name,
+            config=Config(
+                max_pool_connections=max_connections,
+                retries={"max_attempts": 10, "mode": "adaptive"},
+                tcp_keepalive=True,
+            ),
+        )
+        self.bucket = bucket_name
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_SIZE,
+            multipart_chunksize=MULTIPART_SIZE,
+            max_concurrency=PART_CONCURRENCY,
+        )
+        self._lock = threading.Lock()
+        self._remote = set()
+        self._remote_pending = []
+        self._remote_index_path = None
+
+    def download_object(self, obj_hash: str, local_path: Path):
+        # Downloads a physical file from cloud objects/ to local objects/
+        s3_key = f"objects/{obj_hash[:2]}/{obj_hash}"
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        self.s3.download_file(self.bucket, s3_key, str(local_path))
+
+    def fetch_object(self, store_hash: str, dest: Path, location=None):
+        # One object of the store into dest. A packed object is read with a ranged GET
+        # from the remote pack, the rest of the pack is not downloaded
+        try:
+            if location is None:
+                key = f"objects/{store_hash[:2]}/{store_hash}"
+                self.s3.download_file(
+                    self.bucket, key, str(dest), Config=self.transfer_config
+                )
+                return
+            pack_name, offset, length = location
+            response = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=f"objects/packs/{pack_name}.pack",
+                Range=f"bytes={offset}-{offset + length - 1}",
+            )
+            with open(dest, "wb") as f:
+                for block in response["Body"].iter_chunks(1024 * 1024):
+                    f.write(block)
+            if dest.stat().st_size != length:
+                raise ValueError(f"Remote pack {pack_name} is truncated")
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(f"Object {store_hash} is not in the cloud")
+            raise
+
+    def list_keys(self, prefix: str) -> Iterator[str]:
+        return (key for key, _ in self.list_sizes(prefix))
+
+    def list_sizes(self, prefix: str) -> Iterator[tuple[str, int]]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["Size"]
+
+    def _load_remote_index(self, index_path: Path, refresh: bool):
+        # The remote objects/ listing is paginated (1000 keys per request), so it is
+        # taken once and then kept up to date locally with every upload
+        self._remote_index_path = index_path
+        self._remote_pending = []
+        if not refresh and index_path.exists():
+            data = index_path.read_bytes()
+            if data.startswith(REMOTE_INDEX_HEADER):
+                body = memoryview(data)[len(REMOTE_INDEX_HEADER) :]
+                usable = len(body) - len(body) % 32
+                self._remote = {bytes(body[pos : pos + 32]) for pos in range(0, usable, 32)}
+                return
+
+        logger.info(f"Listing remote objects in {self.bucket}...")
+        self._remote = {
+            _key_digest(key, size) for key, size in self.list_sizes("objects/")
+        }
+        tmp_path = index_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(REMOTE_INDEX_HEADER)
+            f.write(b"".join(self._remote))
+        os.replace(tmp_path, index_path)
+
+    def _mark_remote(self, key: str, size: int):
+        digest = _key_digest(key, size)
+        with self._lock:
+            self._remote.add(digest)
+            self._remote_pending.append(digest)
+            if len(self._remote_pending) >= REMOTE_INDEX_BATCH:
+                self._flush_remote_index()
+
+    def _flush_remote_index(self):
+        # Called with the lock held
+        if not self._remote_pending:
+            return
+        with open(self._remote_index_path, "ab") as f:
+            if f.tell() == 0:
+                f.write(REMOTE_INDEX_HEADER)
+            f.write(b"".join(self._remote_pending))
+        self._remote_pending.clear()
+
+    def is_remote(self, key: str, size: int) -> bool:
+        return _key_digest(key, size) in self._remote
+
+    def _upload(self, local_path: Path, key: str) -> int:
+        # A single PUT or a completed multipart upload: the key appears whole or not at all.
+        # The size is taken first: if the file grows meanwhile, the next sync sends it again
+        size = local_path.stat().st_size
+        self.s3.upload_file(
+            str(local_path), self.bucket, key, Config=self.transfer_config
+        )
+        return size
+
+    def _upload_all(
+        self, items: Iterable[tuple[Path, str]], report: SyncReport, jobs: int
+    ):
+        def collect(key, task: Future):
+            try:
+                size = task.result()
+            except Exception as e:
+                report.errors.append(f"{key}: {e}")
+                return
+            if key.startswith("objects/"):
+                self._mark_remote(key, size)
+            report.uploaded += 1
+            report.uploaded_bytes += size
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            submitted = (
+                (key, pool.submit(self._upload, local_path, key)) for local_path, key in items
+            )
+            for key, task in in_order(submitted, jobs):
+                collect(key, task)
+
+    def sync(self, manager, jobs: int = 16, refresh: bool = False) -> SyncReport:
+        # Pushes the local storage of a BackupManager to the bucket: objects first,
+        # then manifests, then the catalog. A remote version is visible only when its
+        # manifest is, and by then every object it refers to is already there.
+        # A backup may write at the same time: the manifests are picked before any
+        # object goes up, so their objects are all in what is uploaded, and a pack that
+        # is still growing is uploaded again by the next sync
+        report = SyncReport()
+        store = manager.store
+        self._load_remote_index(
+            manager.backup_base / f"remote-{self.bucket}.bin", refresh
+        )
+
+        manifests = []
+        remote_keys = set()
+        listed_projects = set()
+        for p_name, v_name in manager.catalog.find():
+            if p_name not in listed_projects:
+                remote_keys.update(self.list_keys(f"{p_name}/"))
+                listed_projects.add(p_name)
+            v_dir = manager.backup_base / p_name / v_name
+            for name in (MANIFEST_NAME, LEGACY_MANIFEST_NAME):
+                key = f"{p_name}/{v_name}/{name}"
+                if (v_dir / name).exists() and key not in remote_keys:
+                    manifests.append((v_dir / name, key))
+        # After the listing: the objects other processes wrote for those manifests too
+        store.reload()
+
+        def loose_items():
+            for digest in store.loose_hashes():
+                store_hash = digest.hex()
+                # The size of a loose object does not matter, it is not read
+                yield store.loose_path(store_hash), f"objects/{store_hash[:2]}/{store_hash}", 0
+
+        def pack_items(suffix):
+            for name in store.pack_names():
+                local_path = store.packs_path / f"{name}{suffix}"
+                key = f"objects/packs/{name}{suffix}"
+                yield local_path, key, local_path.stat().st_size
+
+        def missing(items):
+            for local_path, key, size in items:
+                if self.is_remote(key, size):
+                    report.skipped += 1
+                else:
+                    yield local_path, key
+
+        try:
+            self._upload_all(missing(loose_items()), report, jobs)
+            # A pack index goes up only after its pack
+            for suffix in (".pack", ".idx"):
+                self._upload_all(missing(pack_items(suffix)), report, jobs)
+        finally:
+            with self._lock:
+                self._flush_remote_index()
+
+        if report.errors:
+            logger.error(
+                f"{len(report.errors)} objects were not uploaded, manifests are held back"
+            )
+            return report
+
+        self._upload_all(manifests, report, jobs)
+        report.manifests = len(manifests) - len(report.errors)
+
+        # The catalog only changes with new versions
+        if manifests and not report.errors and (manager.backup_base / CATALOG_NAME).exists():
+            self._upload_all(
+                [(manager.backup_base / CATALOG_NAME, CATALOG_NAME)], report, 1
+            )
+        return report
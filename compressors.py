@@ -0,0 +1,234 @@
+import lzma
+import math
+import os
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Upper bound for one piece of decompressed output
+OUTPUT_BLOCK = 1024 * 1024
+
+# Probe: a sample from the start and the middle of the file
+SAMPLE_SIZE = 64 * 1024
+# Above this entropy (bits per byte) data is treated as already compressed or encrypted
+MAX_ENTROPY = 7.5
+# If a fast trial compression of the sample saves less than this, the file is stored as is
+MIN_SAVING = 0.1
+
+POLICIES = ("fastest", "balanced", "smallest")
+
+
+class _PushDecoder:
+    # Decoders fed one piece at a time: feed(data) and finish() yield the output
+    def decode(self, pieces: Iterable[bytes]) -> Iterator[bytes]:
+        for data in pieces:
+            yield from self.feed(data)
+        yield from self.finish()
+
+
+class _ZlibDecoder(_PushDecoder):
+    def __init__(self):
+        self._d = zlib.decompressobj()
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        # Bounded output per call keeps memory flat even for highly compressible data
+        while data:
+            out = self._d.decompress(data, OUTPUT_BLOCK)
+            if out:
+                yield out
+            data = self._d.unconsumed_tail
+
+    def finish(self) -> Iterator[bytes]:
+        tail = self._d.flush()
+        if tail:
+            yield tail
+        if not self._d.eof:
+            raise ValueError("Truncated compressed stream")
+
+
+class _BufferedDecoder(_PushDecoder):
+    # lzma and lz4 keep unread input inside and report needs_input
+    def __init__(self, decompressor):
+        self._d = decompressor
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        out = self._d.decompress(data, OUTPUT_BLOCK)
+        if out:
+            yield out
+        while not self._d.eof and not self._d.needs_input:
+            out = self._d.decompress(b"", OUTPUT_BLOCK)
+            if out:
+                yield out
+
+    def finish(self) -> Iterator[bytes]:
+        if not self._d.eof:
+            raise ValueError("Truncated compressed stream")
+        return iter(())
+
+
+class _PieceReader:
+    # read() over pieces of input, for decoders that pull it themselves
+    def __init__(self, pieces: Iterable[bytes]):
+        self._pieces = iter(pieces)
+        self._buffer = b""
+        self.exhausted = False
+
+    def read(self, size: int) -> bytes:
+        while not self._buffer:
+            piece = next(self._pieces, None)
+            if piece is None:
+                self.exhausted = True
+                return b""
+            self._buffer = piece
+        out, self._buffer = self._buffer[:size], self._buffer[size:]
+        return out
+
+
+class _ZstdDecoder:
+    # decompressobj has no output bound: a frame of zeros (a sparse disk image) would
+    # come out as one object of gigabytes. read_to_iter pulls the input as it needs it
+    # and yields at most OUTPUT_BLOCK at a time
+    def decode(self, pieces: Iterable[bytes]) -> Iterator[bytes]:
+        reader = _PieceReader(pieces)
+        yield from zstandard.ZstdDecompressor().read_to_iter(
+            reader, write_size=OUTPUT_BLOCK
+        )
+        # A complete frame ends before the input does
+        if reader.exhausted:
+            raise ValueError("Truncated compressed stream")
+
+
+class _Lz4Encoder:
+    def __init__(self, level: int):
+        self._c = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._c.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        header, self._header = self._header, b""
+        return header + self._c.compress(data)
+
+    def flush(self) -> bytes:
+        header, self._header = self._header, b""
+        return header + self._c.flush()
+
+
+class Codec:
+    def __init__(self, name: str, codec_id: int, default_level: int, encoder, decoder):
+        self.name = name
+        self.id = codec_id
+        self.default_level = default_level
+        self._encoder = encoder
+        self._decoder = decoder
+
+    def encoder(self, level: Optional[int] = None):
+        # An object with compress(data) and flush(), like zlib.compressobj
+        return self._encoder(self.default_level if level is None else level)
+
+    def decoder(self):
+        # An object with decode(pieces), yielding output pieces of at most OUTPUT_BLOCK
+        return self._decoder()
+
+
+CODECS = {
+    "zlib": Codec(
+        "zlib", 1, 6, lambda level: zlib.compressobj(level), _ZlibDecoder
+    ),
+    "lzma": Codec(
+        "lzma",
+        2,
+        6,
+        lambda level: lzma.LZMACompressor(preset=level),
+        lambda: _BufferedDecoder(lzma.LZMADecompressor()),
+    ),
+}
+if zstandard:
+    CODECS["zstd"] = Codec(
+        "zstd",
+        4,
+        3,
+        lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+        _ZstdDecoder,
+    )
+if lz4_frame:
+    CODECS["lz4"] = Codec(
+        "lz4",
+        5,
+        0,
+        _Lz4Encoder,
+        lambda: _BufferedDecoder(lz4_frame.LZ4FrameDecompressor()),
+    )
+
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Codec {name} is not available, is its package installed?")
+
+
+def get_codec_by_id(codec_id: int) -> Codec:
+    codec = CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unknown or unavailable codec {codec_id}")
+    return codec
+
+
+def policy_codec(policy: str) -> tuple[str, int]:
+    # Codec and level for a policy, from what is installed
+    if policy == "fastest":
+        if "lz4" in CODECS:
+            return "lz4", 0
+        if "zstd" in CODECS:
+            return "zstd", 1
+        return "zlib", 1
+    if policy == "smallest":
+        if "zstd" in CODECS:
+            return "zstd", 19
+        return "lzma", 6
+    if policy == "balanced":
+        if "zstd" in CODECS:
+            return "zstd", 3
+        return "zlib", 6
+    raise ValueError(f"Unknown compression policy {policy}")
+
+
+def _entropy(sample: bytes) -> float:
+    total = len(sample)
+    return -sum(
+        count / total * math.log2(count / total) for count in Counter(sample).values()
+    )
+
+
+def is_compressible(sample: bytes) -> bool:
+    # Decides only whether to compress, the codec and level come from the policy:
+    # a trial of every codec would cost as much as compressing most small files
+    if not sample:
+        return False
+    # Cheap check first: random-looking bytes will not compress
+    if _entropy(sample) > MAX_ENTROPY:
+        return False
+    trial = zlib.compress(sample, 1)
+    return len(trial) <= len(sample) * (1 - MIN_SAVING)
+
+
+def probe_file(path: Path) -> bool:
+    with open(path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+        size = os.fstat(f.fileno()).st_size
+        if size > 2 * SAMPLE_SIZE:
+            f.seek(size // 2)
+            sample += f.read(SAMPLE_SIZE)
+    return is_compressible(sample)
@@ -0,0 +1,245 @@
+import logging
+import os
+import stat
+import time
+from pathlib import Path
+
+from classes import ScanRecord
+from crypter import FileCrypter
+from ignore_rules import IgnoreRules
+from manager import BackupManager
+from scanner import iter_scan, walk_files
+from watcher import WHOLE_TREE, open_watcher
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the flush schedule
+FLUSH_INTERVAL = 300
+FLUSH_CHANGES = 1000
+# Two snapshots within one second would share a version directory
+MIN_SNAPSHOT_GAP = 1.0
+
+
+class BackupDaemon:
+    # Continuous incremental backups of one folder. The process keeps what a normal run
+    # has to rebuild every time: the derived key, the object index and catalog of the
+    # manager, and the size, mtime and hash of every file. The watcher collects dirty
+    # paths; a flush stats only those, reads only the files that changed (hashed while
+    # they are stored) and writes a new snapshot.
+    def __init__(
+        self,
+        manager: BackupManager,
+        source_path: Path,
+        project_name: str,
+        rules: IgnoreRules,
+        password=None,
+        forced_salt=None,
+        compress: bool = True,
+        compression_policy: str = "balanced",
+        chunking: bool = False,
+        delta: bool = False,
+        jobs: int = 1,
+        paranoid: bool = False,
+        interval: float = FLUSH_INTERVAL,
+        max_changes: int = FLUSH_CHANGES,
+        poll_interval: float = 60,
+        watcher=None,
+    ):
+        self.manager = manager
+        self.source_path = source_path
+        self.project_name = project_name
+        self.rules = rules
+        self.compress = compress
+        self.compression_policy = compression_policy
+        self.chunking = chunking
+        self.delta = delta
+        self.jobs = jobs
+        # Paranoid: neither the stat cache nor a known size and mtime is trusted,
+        # every file the watcher reports is read and hashed again
+        self.paranoid = paranoid
+        self.interval = interval
+        self.max_changes = max_changes
+        # The key is derived once for the life of the daemon
+        salt_bytes = bytes.fromhex(forced_salt) if forced_salt else None
+        self.crypter = FileCrypter(password, salt=salt_bytes) if password else None
+        # Every file of the tree by relative path
+        self.files: dict[str, ScanRecord] = {}
+        self.dirty: set[str] = set()
+        self.snapshots = 0
+        # Kept up to date with every snapshot, so a normal run after the daemon
+        # does not hash again what the daemon already hashed
+        self.stat_cache = None
+        self._watcher = watcher
+        self._poll_interval = poll_interval
+        self._last_flush = time.monotonic()
+        self._last_snapshot = 0.0
+        self._running = False
+
+    def start(self, stat_cache=None):
+        # The watches are set before the first scan, so nothing changed during it is lost
+        self.stat_cache = stat_cache
+        if self._watcher is None:
+            self._watcher = open_watcher(self.source_path, self.rules, self._poll_interval)
+        records = iter_scan(
+            self.source_path,
+            stat_cache=stat_cache,
+            paranoid=self.paranoid,
+            workers=self.jobs,
+            defer_hashing=True,
+            rules=self.rules,
+        )
+
+        def remember(records):
+            for record in records:
+                self.files[record.rel_path] = record
+                yield record
+
+        self._snapshot(remember(records), "initial")
+
+    def poll(self, timeout: float = 1.0) -> bool:
+        # Collects events for up to timeout seconds and flushes when due.
+        # True if a snapshot was written
+        self.dirty |= self._watcher.wait(timeout)
+        if not self.dirty:
+            self._last_flush = time.monotonic()
+            return False
+        if (
+            len(self.dirty) >= self.max_changes
+            or time.monotonic() - self._last_flush >= self.interval
+        ):
+            return self.flush()
+        return False
+
+    def flush(self) -> bool:
+        dirty, self.dirty = self.dirty, set()
+        self._last_flush = time.monotonic()
+        if self.stat_cache:
+            # Before anything is stat'ed again
+            self.stat_cache.start_scan()
+        changed = 0
+        for rel_path in sorted(dirty):
+            changed += self._apply(rel_path)
+        if not changed:
+            return False
+        self._snapshot(list(self.files.values()), f"{changed} changed")
+        return True
+
+    def _apply(self, rel_path: str) -> int:
+        # Brings self.files up to date for one dirty path, returns how many files changed
+        if rel_path == WHOLE_TREE:
+            return self._rescan("")
+        try:
+            file_stat = os.stat(self.source_path / rel_path)
+        except OSError:
+            file_stat = None
+
+        if file_stat is not None and stat.S_ISDIR(file_stat.st_mode):
+            if self.rules.is_ignored(rel_path, True):
+                return self._drop(rel_path)
+            return self._rescan(rel_path)
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            # Deleted, or moved away: a file or a whole directory
+            return self._drop(rel_path)
+        if self.rules.is_ignored(rel_path):
+            return self._drop(rel_path)
+        return self._update(rel_path, file_stat)
+
+    def _update(self, rel_path: str, file_stat: os.stat_result) -> int:
+        known = self.files.get(rel_path)
+        if (
+            not self.paranoid
+            and known
+            and known.hash
+            and known.size == file_stat.st_size
+            and known.mtime_ns == file_stat.st_mtime_ns
+        ):
+            # Touched but not changed (chmod, an open for writing with no write)
+            return 0
+        # No hash: the backup hashes the file while it stores it
+        self.files[rel_path] = ScanRecord(
+            rel_path=rel_path,
+            size=file_stat.st_size,
+            mtime_ns=file_stat.st_mtime_ns,
+            hash=None,
+            stat=file_stat,
+        )
+        return 1
+
+    def _drop(self, rel_path: str) -> int:
+        prefix = rel_path + os.sep
+        gone = [p for p in self.files if p == rel_path or p.startswith(prefix)]
+        self._forget(gone)
+        return len(gone)
+
+    def _forget(self, gone: list[str]):
+        for p in gone:
+            del self.files[p]
+            if self.stat_cache:
+                self.stat_cache.forget(p)
+
+    def _rescan(self, rel_dir: str) -> int:
+        # A directory that appeared, moved or overflowed the event queue: stat only,
+        # files with the same size and mtime keep their hash
+        changed = 0
+        seen = set()
+        for rel_path, file_stat in walk_files(
+            self.source_path, self.rules, self.jobs, start=rel_dir
+        ):
+            seen.add(rel_path)
+            changed += self._update(rel_path, file_stat)
+        prefix = rel_dir + os.sep if rel_dir else ""
+        gone = [p for p in self.files if p.startswith(prefix) and p not in seen]
+        self._forget(gone)
+        return changed + len(gone)
+
+    def _snapshot(self, records, reason: str):
+        wait = MIN_SNAPSHOT_GAP - (time.monotonic() - self._last_snapshot)
+        if wait > 0:
+            time.sleep(wait)
+        started = time.monotonic()
+        res = self.manager.create_backup(
+            records,
+            self.source_path,
+            self.project_name,
+            comment=f"watch: {reason}",
+            compress=self.compress,
+            chunking=self.chunking,
+            delta=self.delta,
+            jobs=self.jobs,
+            compression_policy=self.compression_policy,
+            crypter=self.crypter,
+            stat_cache=self.stat_cache,
+        )
+        if self.stat_cache:
+            # The files hashed while they were stored are in it now
+            self.stat_cache.save()
+        self._last_snapshot = time.monotonic()
+        self.snapshots += 1
+        # Files that changed again while they were stored go into the next snapshot
+        self.dirty.update(res.changed)
+        logger.info(
+            f"Snapshot ({reason}): {res.copied} new, {res.skipped} unchanged, "
+            f"{res.errors} errors in {self._last_snapshot - started:.1f}s"
+        )
+
+    def run(self):
+        self._running = True
+        try:
+            while self._running:
+                self.poll()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Whatever was collected is not lost on exit
+            if self.dirty:
+                self.flush()
+            self.close()
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        if self._watcher:
+            self._watcher.close()
+        if self.stat_cache:
+            self.stat_cache.save()
@@ -0,0 +1,167 @@
+import hashlib
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from chunker import iter_chunks
+from utils import pread
+
+# Delta objects: a changed file is stored as the difference to its content in the
+# previous version. Contents are cut into small content-defined chunks, so an insert,
+# an edit or an append changes only the chunks around it.
+# The signature of a content lists its chunks. A new content is encoded against the
+# signature of the old one, which is stored as an object of its own, so the old
+# content is never read: chunks found in it become copy instructions, the rest is
+# stored as literal data.
+#   delta:     MAGIC | base size (8 bytes) | instructions
+#   copy:      OP_COPY | offset in the base (8 bytes) | length (4 bytes)
+#   literal:   OP_DATA | length (4 bytes) | data
+#   signature: for every chunk, its digest (DIGEST_SIZE bytes) | length (4 bytes)
+MAGIC = b"SBKD"
+OP_COPY = 1
+OP_DATA = 2
+DIGEST_SIZE = 16
+SIGNATURE_RECORD = DIGEST_SIZE + 4
+
+MIN_SIZE = 2 * 1024
+AVG_SIZE = 8 * 1024
+MAX_SIZE = 64 * 1024
+
+# Files smaller than this are always stored whole
+DELTA_THRESHOLD = 1024 * 1024
+# At most this many deltas follow a full object, the next change stores a full object again
+DELTA_CHAIN = 8
+# A delta with more literal data than this share of the file is replaced by a full object
+DELTA_MAX_LITERAL = 0.5
+# Copies are read from the base in blocks of this size
+COPY_BLOCK = 1024 * 1024
+
+
+def delta_key(base_hash: str, file_hash: str) -> str:
+    # What a delta object is named after, in place of a content hash
+    return f"{base_hash}>{file_hash}"
+
+
+def signature_key(file_hash: str) -> str:
+    return f"{file_hash}:signature"
+
+
+def delta_chunks(f: BinaryIO) -> Iterator[bytes]:
+    return iter_chunks(f, MIN_SIZE, AVG_SIZE, MAX_SIZE)
+
+
+def read_signature(pieces: Iterable[bytes]) -> tuple[dict[bytes, tuple[int, int]], int]:
+    # Chunk digest -> (offset, length) in the content, and the size of the content
+    data = b"".join(pieces)
+    chunks = {}
+    offset = 0
+    for pos in range(0, len(data) - len(data) % SIGNATURE_RECORD, SIGNATURE_RECORD):
+        digest = data[pos : pos + DIGEST_SIZE]
+        length = int.from_bytes(data[pos + DIGEST_SIZE : pos + SIGNATURE_RECORD], "big")
+        chunks.setdefault(digest, (offset, length))
+        offset += length
+    return chunks, offset
+
+
+class DeltaEncoder:
+    # Records the signature of the content passing through. With the signature of a
+    # base, the content comes out as delta instructions against that base, otherwise
+    # as it is (a full object)
+    def __init__(self, base: Optional[tuple[dict, int]] = None):
+        self.base = base
+        self.delta = base is not None
+        self.signature = bytearray()
+        self.size = 0
+        self.literal_bytes = 0
+
+    def encode(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        if not self.delta:
+            for chunk in chunks:
+                self._sign(chunk)
+                yield chunk
+            return
+
+        base_chunks, base_size = self.base
+        yield MAGIC + base_size.to_bytes(8, "big")
+        # Copies of adjacent base chunks are merged into one instruction
+        copy_offset, copy_length = 0, 0
+        for chunk in chunks:
+            found = base_chunks.get(self._sign(chunk))
+            if found and found[1] == len(chunk):
+                if (
+                    copy_length
+                    and copy_offset + copy_length == found[0]
+                    and copy_length + found[1] < 1 << 32
+                ):
+                    copy_length += found[1]
+                    continue
+                if copy_length:
+                    yield _copy(copy_offset, copy_length)
+                copy_offset, copy_length = found
+                continue
+            if copy_length:
+                yield _copy(copy_offset, copy_length)
+                copy_length = 0
+            self.literal_bytes += len(chunk)
+            yield bytes([OP_DATA]) + len(chunk).to_bytes(4, "big") + chunk
+        if copy_length:
+            yield _copy(copy_offset, copy_length)
+
+    def _sign(self, chunk: bytes) -> bytes:
+        digest = hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+        self.signature += digest + len(chunk).to_bytes(4, "big")
+        self.size += len(chunk)
+        return digest
+
+
+def _copy(offset: int, length: int) -> bytes:
+    return bytes([OP_COPY]) + offset.to_bytes(8, "big") + length.to_bytes(4, "big")
+
+
+class _PieceReader:
+    # Exact-size reads over the pieces of a decoded object
+    def __init__(self, pieces: Iterable[bytes]):
+        self._pieces = iter(pieces)
+        self._buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            piece = next(self._pieces, None)
+            if piece is None:
+                break
+            self._buffer += piece
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def apply_delta(pieces: Iterable[bytes], base_fd: int, base_size: int) -> Iterator[bytes]:
+    # The new content from a decoded delta object and the base content, read with pread
+    reader = _PieceReader(pieces)
+    header = reader.read(len(MAGIC) + 8)
+    if header[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a delta object")
+    if int.from_bytes(header[len(MAGIC) :], "big") != base_size:
+        raise ValueError("The delta was made against another base")
+    while op := reader.read(1):
+        if op[0] == OP_COPY:
+            args = reader.read(12)
+            if len(args) != 12:
+                raise ValueError("Truncated delta")
+            offset = int.from_bytes(args[:8], "big")
+            length = int.from_bytes(args[8:], "big")
+            if offset + length > base_size:
+                raise ValueError("Delta copy beyond the end of the base")
+            end = offset + length
+            while offset < end:
+                data = pread(base_fd, min(COPY_BLOCK, end - offset), offset)
+                if not data:
+                    raise ValueError("The base is shorter than expected")
+                offset += len(data)
+                yield data
+        elif op[0] == OP_DATA:
+            length = int.from_bytes(reader.read(4), "big")
+            data = reader.read(length)
+            if len(data) != length:
+                raise ValueError("Truncated delta")
+            yield data
+        else:
+            raise ValueError(f"Unknown delta instruction {op[0]}")
@@ -0,0 +1,32 @@
+import os
+from pathlib import Path
+
+# How much the storage does to survive a crash or a power loss:
+#   none:   no fsync at all, the fastest. A crash may lose the data of objects that the
+#           object index already lists, and every later version would refer to them
+#   batch:  the objects written since the last checkpoint are synced together, their
+#           files first and then every directory once, before the object index or a
+#           manifest refers to them
+#   strict: every object is synced with its directory as soon as it is written
+DURABILITY_LEVELS = ("none", "batch", "strict")
+DEFAULT_DURABILITY = "batch"
+
+
+def fsync_file(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: Path):
+    # Makes the names in a directory durable: new files and renames. Windows cannot
+    # open a directory for this, there NTFS journals the names itself
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,40 @@
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# How often a Windows lock is tried again while another process holds it (seconds)
+RETRY_INTERVAL = 0.05
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False):
+    # An advisory lock on path, held across processes while the block runs: any number
+    # of shared holders or one exclusive holder. Windows has no shared locks there,
+    # every lock is exclusive. Locks are per open file, so do not nest two on one path
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    locked = False
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            while not locked:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    locked = True
+                except OSError:
+                    time.sleep(RETRY_INTERVAL)
+        yield
+    finally:
+        if locked:
+            # Windows wants the region unlocked before the file is closed
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        # Closing the file releases a flock
+        os.close(fd)
@@ -1,13 +1,27 @@
-import hashlib
-from pathlib import Path
-
-def get_file_hash(path: Path, block_size: int = 65536) -> str:
-    sha256 = hashlib.sha256()
-    try:
-        with path.open("rb") as f:
-            for block in iter(lambda: f.read(block_size), b""):
-                sha256.update(block)
-    except (PermissionError, OSError) as e:
-        return None
-        
+import hashlib
+from pathlib import Path
+from time import perf_counter
+from metrics import METRICS
+
+def get_file_hash(path: Path, block_size: int = 65536) -> str:
+    sha256 = hashlib.sha256()
+    read_seconds, hash_seconds, size = 0.0, 0.0, 0
+    try:
+        with path.open("rb") as f:
+            while True:
+                started = perf_counter()
+                block = f.read(block_size)
+                read_done = perf_counter()
+                read_seconds += read_done - started
+                if not block:
+                    break
+                sha256.update(block)
+                hash_seconds += perf_counter() - read_done
+                size += len(block)
+    except (PermissionError, OSError) as e:
+        return None
+    finally:
+        METRICS.add("read", read_seconds, size)
+        METRICS.add("hash", hash_seconds, size)
+        
     return sha256.hexdigest()
\ No newline at end of file
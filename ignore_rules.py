@@ -0,0 +1,207 @@
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Per-project rules, read from the root of the source folder
+IGNORE_FILE_NAME = ".backupignore"
+
+# Default rules: these directories and extensions are never backed up
+IGNORE_DIRS = {
+    "__pycache__",
+    ".git",
+    ".idea",
+    "node_modules",
+    "Cache",
+    "Temp",
+}
+
+IGNORE_EXTENSIONS = {".tmp", ".log", ".bak", ".swp"}
+
+
+def _translate(pattern: str) -> str:
+    # A gitignore glob as a regex over "/"-separated relative paths
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                # Any number of directories, including none
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end + 1
+                continue
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def _compile_rule(line: str, ignore_case: bool) -> Optional[tuple[bool, bool, str]]:
+    # (negated, directories only, regex) or None for blank lines and comments
+    line = line.rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    # A slash anywhere but at the end anchors the pattern to the root,
+    # otherwise it matches a name at any depth
+    anchored = "/" in line
+    regex = _translate(line.lstrip("/"))
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    if ignore_case:
+        regex = f"(?i:{regex})"
+    return negated, dir_only, regex
+
+
+class IgnoreRules:
+    # gitignore-style rules, later rules win and "!" re-includes. A run of rules with
+    # the same sign is compiled into one regex, so a path is checked against a few
+    # regexes however many patterns there are. Matching is by the path relative to
+    # the scanned folder; an ignored directory is not entered at all.
+    def __init__(self, patterns: Iterable[str] = (), ignore_case: bool = False):
+        self._rules = []
+        self._groups = []
+        self.extend(patterns, ignore_case)
+
+    def extend(self, patterns: Iterable[str], ignore_case: bool = False):
+        for line in patterns:
+            rule = _compile_rule(line, ignore_case)
+            if rule:
+                self._rules.append(rule)
+        self._compile()
+
+    def _compile(self):
+        groups = []
+        for negated, dir_only, regex in self._rules:
+            if not groups or groups[-1][0] != negated:
+                groups.append((negated, [], []))
+            groups[-1][2 if dir_only else 1].append(regex)
+
+        def combine(regexes):
+            if not regexes:
+                return None
+            return re.compile("|".join(f"(?:{regex})" for regex in regexes))
+
+        # Checked from the last group back, the first match decides
+        self._groups = [
+            (negated, combine(any_kind), combine(dir_only))
+            for negated, any_kind, dir_only in reversed(groups)
+        ]
+
+    def is_ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        for negated, any_kind, dir_only in self._groups:
+            if (any_kind and any_kind.fullmatch(rel_path)) or (
+                is_dir and dir_only and dir_only.fullmatch(rel_path)
+            ):
+                return not negated
+        return False
+
+
+def _matches(rules: IgnoreRules, rel_path: str) -> bool:
+    # The path itself or one of the directories above it
+    parts = rel_path.split("/")
+    for depth in range(1, len(parts)):
+        if rules.is_ignored("/".join(parts[:depth]), is_dir=True):
+            return True
+    return rules.is_ignored(rel_path)
+
+
+def _literal_prefix(pattern: str) -> str:
+    # Every path an anchored pattern matches starts with its part before the first wildcard
+    pattern = pattern.lstrip("/")
+    for i, c in enumerate(pattern):
+        if c in "*?[\\":
+            return pattern[:i]
+    return pattern
+
+
+class PathFilter:
+    # Picks manifest paths for a partial restore: a path is taken when it is under the
+    # prefix directory (docs takes docs/a.txt, not docs_old/a.txt or docsx.txt),
+    # matches one of the include patterns (any path if there are none) and none of
+    # the exclude patterns. Patterns are gitignore-style as for backups, and a
+    # pattern that matches a directory takes everything below it.
+    # Include patterns anchored to the root narrow the prefix, so fewer manifest blocks are read
+    def __init__(
+        self, prefix: str = "", include: Iterable[str] = (), exclude: Iterable[str] = ()
+    ):
+        include = [p for p in include if p.strip()]
+        exclude = [p for p in exclude if p.strip()]
+        self._include = IgnoreRules(include) if include else None
+        self._exclude = IgnoreRules(exclude) if exclude else None
+        prefix = prefix.replace(os.sep, "/").strip("/")
+        self._directory = prefix
+        anchored = all(
+            not p.startswith("!") and "/" in p.rstrip("/") for p in include
+        )
+        if include and anchored:
+            literal = os.path.commonprefix([_literal_prefix(p) for p in include])
+            if literal.startswith(prefix):
+                prefix = literal
+        # Manifest paths use the separator of the system the backup was made on.
+        # The manifest is read by this plain string prefix, matches() checks the boundary
+        self.prefix = prefix.replace("/", os.sep)
+        self.selects_all = not (prefix or include or exclude)
+
+    def matches(self, rel_path: str) -> bool:
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        directory = self._directory
+        if directory and not (
+            rel_path == directory or rel_path.startswith(directory + "/")
+        ):
+            return False
+        if self._include and not _matches(self._include, rel_path):
+            return False
+        return not (self._exclude and _matches(self._exclude, rel_path))
+
+
+def default_rules() -> IgnoreRules:
+    rules = IgnoreRules(f"{name}/" for name in sorted(IGNORE_DIRS))
+    rules.extend((f"*{ext}" for ext in sorted(IGNORE_EXTENSIONS)), ignore_case=True)
+    return rules
+
+
+def load_rules(folder_path: Path, patterns: Iterable[str] = ()) -> IgnoreRules:
+    # Default rules, then the project's .backupignore, then the given patterns
+    rules = default_rules()
+    ignore_file = folder_path / IGNORE_FILE_NAME
+    if ignore_file.exists():
+        try:
+            rules.extend(ignore_file.read_text(encoding="utf-8").splitlines())
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Cannot read {ignore_file}: {e}")
+    rules.extend(patterns)
+    return rules
@@ -1,186 +1,553 @@
-import logging
-import getpass
-import json
-from pathlib import Path
-from scanner import scan_files
-from manager import BackupManager
-from utils import show_progress
-
-logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
-
-
-def main():
-    print("=== Smart-Backup ===\n")
-    print("1. Create backup")
-    print("2. Restore version")
-    choice = input("\nChoose an action (1/2): ").strip()
-
-    # Общий ввод для обоих режимов
-    dst_input = input("Enter the path for copying: ").strip()
-    backup_base = Path(dst_input)
-    manager = BackupManager(backup_base)
-
-    if choice == "1":
-        src_input = input("Enter the path to the source folder: ").strip()
-        source_path = Path(src_input)
-        if not source_path.exists():
-            print("Error: The source folder was not found!")
-            return
-
-        project_name = (
-            input(f"Specify the name of the directory [{source_path.name}]: ").strip()
-            or source_path.name
-        )
-
-        last_versions = manager._find_target_versions(project_name)
-        old_salt = None
-        last_comp = True
-
-        if last_versions:
-            with open(last_versions[-1] / "manifest.json", "r", encoding="utf-8") as f:
-                last_m = json.load(f)
-
-            last_enc = last_m["info"].get("encryption") is not None
-
-            old_salt = last_m["info"].get("salt")
-            last_comp = last_m["info"].get("compression_enabled", True)
-            last_enc = old_salt is not None
-            print(
-                f"\n[INFO] The previous version of the directory was found '{project_name}'."
-            )
-
-        comment = input("Comment on the version: ").strip()
-
-        compress_yn = (
-            input(
-                f"Do you want to compress the data? (y/n) [{'y' if last_comp else 'n'}]: "
-            ).lower()
-            != "n"
-        )
-
-        pass_input = getpass.getpass(
-            "Write the password (Enter — without password): "
-        ).strip()
-        password = pass_input if pass_input else None
-        current_enc = password is not None
-
-        if last_versions:
-            if last_comp != compress_yn or last_enc != current_enc:
-                print(
-                    f"\n[!] ATTENTION: The parameters are different from the previous version!"
-                )
-                print(f"Was: Compression={last_comp}, Encryption={last_enc}")
-                print(
-                    f"Has become: Compression={compress_yn}, Encryption={current_enc}"
-                )
-
-                if input("\nContinue with the new parameters? (y/n): ").lower() != "y":
-                    print("The operation was canceled by the user.")
-                    return
-
-            if last_enc and current_enc:
-                print(
-                    "[SUCCESS] The access parameters match. The files will use a common database."
-                )
-                if (
-                    input(
-                        "Generate a new security key (Salt)? Deduplication with older versions will be disabled. (y/n): "
-                    ).lower()
-                    == "y"
-                ):
-                    old_salt = None  # This will force the manager to create a new salt.
-                    print(
-                        "A new key will be used. Deduplication with older versions is disabled."
-                    )
-
-            elif not last_enc and current_enc:
-                print("\n[!!!] CRITICAL WARNING [!!!]")
-                print(
-                    "You enable encryption, but previous versions of this project are OPEN in the repository."
-                )
-                print(
-                    "An attacker will be able to read old copies of files without a password."
-                )
-                print(
-                    "\nRecommendation: Create a new folder for this backup or delete the old storage."
-                )
-                if (
-                    input(
-                        "Do you understand the risk and want to continue? (y/n): "
-                    ).lower()
-                    != "y"
-                ):
-                    return
-
-            elif last_enc and not current_enc:
-                print(
-                    "\n[!!!] WARNING: The new backup will be WITHOUT encryption, although it used to be."
-                )
-                if input("Are you sure? (y/n): ").lower() != "y":
-                    return
-
-        print("\n[1/2] Scanning and calculating hashes...")
-        scan_result = scan_files(source_path, progress_callback=show_progress)
-
-        print(f"\n[2/2] Creating a snapshot...")
-        res = manager.create_backup(
-            scan_result,
-            source_path,
-            project_name,
-            comment,
-            compress=compress_yn,
-            password=password,
-            forced_salt=old_salt,
-        )
-        print(f"\n Ready! New ones: {res.copied}, From the database: {res.skipped}")
-
-    elif choice == "2":
-        proj_query = (
-            input("Directory name (Enter to search everywhere): ").strip() or None
-        )
-        date_query = (
-            input("Part of the date/name of the version (Enter for latest): ").strip()
-            or None
-        )
-
-        found = manager._find_target_versions(proj_query, date_query)
-
-        if not found:
-            print("Versions not found.")
-            return
-
-        target_v = found[-1]
-        print(f"\nVersion selected: {target_v.parent.name} / {target_v.name}")
-
-        with open(target_v / "manifest.json", "r", encoding="utf-8") as f:
-            m_data = json.load(f)
-
-        password = None
-        if m_data["info"].get("salt"):
-            password = getpass.getpass(
-                "This backup is encrypted. Enter the password: "
-            ).strip()
-
-        target_path = Path(input("Where to restore it?: ").strip())
-
-        print("\nRecovery mode:")
-        print("1. Full (original files)")
-        print("2. Technical (as in storage: compression/cipher")
-        mode = input("Choose (1/2) [1]: ").strip() or "1"
-
-        full_clean = mode == "1"
-
-        manager.restore_version(
-            target_v.parent.name,
-            target_v.name,
-            target_path,
-            password=password,
-            decrypt_data=full_clean,
-            decompress_data=full_clean,
-        )
-
-        print(f"\nRecovery in {target_path} is complete!")
-
-
-if __name__ == "__main__":
-    main()
+import argparse
+import logging
+import getpass
+import signal
+from pathlib import Path
+from scanner import iter_scan
+from ignore_rules import load_rules
+from cloud_manager import CloudManager
+from object_cache import CACHE_BYTES
+from daemon import BackupDaemon, FLUSH_CHANGES, FLUSH_INTERVAL
+from manager import BackupManager
+from compressors import POLICIES
+from durability import DEFAULT_DURABILITY, DURABILITY_LEVELS
+from classes import RetentionPolicy
+from pruner import prune
+from verifier import verify
+from metrics import METRICS
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Smart-Backup")
+    parser.add_argument(
+        "--paranoid",
+        action="store_true",
+        help="Ignore the stat cache and rehash every file",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker threads for hashing, storing and restoring files",
+    )
+    parser.add_argument(
+        "--chunking",
+        action="store_true",
+        help="Split large files into content-defined chunks for sub-file deduplication",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Store changed large files as deltas against their previous version",
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Append small objects to pack files instead of one file per object",
+    )
+    parser.add_argument(
+        "--durability",
+        choices=DURABILITY_LEVELS,
+        default=DEFAULT_DURABILITY,
+        help="fsync policy: none (fastest, a crash may lose stored objects), batch "
+        "(objects synced together before anything refers to them) or strict "
+        "(every object synced as it is written)",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Hash new and changed files while storing them, so each is read once",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="gitignore-style pattern of files or directories to skip (repeatable), "
+        "added to the defaults and the project's .backupignore",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="gitignore-style pattern to back up even if an earlier rule skips it",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running: watch the folder and write a snapshot of the changes "
+        "every --interval seconds or after --max-changes changed paths",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=FLUSH_INTERVAL,
+        help="Watch mode: seconds between snapshots of collected changes",
+    )
+    parser.add_argument(
+        "--max-changes",
+        type=int,
+        default=FLUSH_CHANGES,
+        help="Watch mode: write a snapshot early once this many paths changed",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Cloud sync: list the bucket again instead of trusting the local listing",
+    )
+    parser.add_argument(
+        "--cloud",
+        action="store_true",
+        help="Restore: download objects missing from the local storage from S3",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_BYTES // (1024 * 1024),
+        help="Restore from the cloud: size of the local object cache in Mb",
+    )
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="Restore: only files under this directory (or this file) of the version",
+    )
+    parser.add_argument(
+        "--restore-include",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Restore: only files matching this gitignore-style pattern (repeatable)",
+    )
+    parser.add_argument(
+        "--restore-exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Restore: leave out files matching this gitignore-style pattern (repeatable)",
+    )
+    parser.add_argument(
+        "--hardlink",
+        action="store_true",
+        help="Restore: hardlink files with the same content to one file instead of "
+        "copying them (a change to one of them changes all)",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="Restore: only list the paths, sizes and hashes of the version",
+    )
+    parser.add_argument(
+        "--keep-last",
+        type=int,
+        default=0,
+        help="Prune: keep the newest N versions of the project",
+    )
+    parser.add_argument(
+        "--keep-daily",
+        type=int,
+        default=0,
+        help="Prune: keep the newest version of each of the last N days",
+    )
+    parser.add_argument(
+        "--keep-weekly",
+        type=int,
+        default=0,
+        help="Prune: keep the newest version of each of the last N weeks",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Prune: only report what would be removed",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        default=100,
+        help="Verify: check this percentage of the objects, picked at random",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Verify: read at most this many Mb per second from the storage",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write the time, bytes and calls of every stage to this JSON file",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write the stage metrics as a Prometheus textfile (node_exporter collector)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=POLICIES,
+        default="balanced",
+        help="Compression policy: codec and level used for compressible files",
+    )
+    return parser.parse_args()
+
+
+def ask_cloud() -> CloudManager:
+    endpoint = input("S3 endpoint URL (Enter for AWS): ").strip() or None
+    bucket = input("Bucket name: ").strip()
+    access_key = input("Access key: ").strip()
+    secret_key = getpass.getpass("Secret key: ").strip()
+    return CloudManager(endpoint, access_key, secret_key, bucket)
+
+
+def run(args):
+    print("=== Smart-Backup ===\n")
+    print("1. Create backup")
+    print("2. Restore version")
+    print("3. Sync storage to the cloud (S3)")
+    print("4. Prune old versions and unused objects")
+    print("5. Verify stored data (no restore)")
+    choice = input("\nChoose an action (1/2/3/4/5): ").strip()
+
+    # Общий ввод для обоих режимов
+    dst_input = input("Enter the path for copying: ").strip()
+    backup_base = Path(dst_input)
+    manager = BackupManager(backup_base, packed=args.packed, durability=args.durability)
+
+    if choice == "1":
+        src_input = input("Enter the path to the source folder: ").strip()
+        source_path = Path(src_input)
+        if not source_path.exists():
+            print("Error: The source folder was not found!")
+            return
+
+        project_name = (
+            input(f"Specify the name of the directory [{source_path.name}]: ").strip()
+            or source_path.name
+        )
+
+        last_versions = manager._find_target_versions(project_name)
+        old_salt = None
+        last_comp = True
+
+        if last_versions:
+            last_info = manager.get_version_info(last_versions[-1])
+
+            last_enc = last_info.get("encryption") is not None
+
+            old_salt = last_info.get("salt")
+            last_comp = last_info.get("compression_enabled", True)
+            last_enc = old_salt is not None
+            print(
+                f"\n[INFO] The previous version of the directory was found '{project_name}'."
+            )
+
+        comment = input("Comment on the version: ").strip()
+
+        compress_yn = (
+            input(
+                f"Do you want to compress the data? (y/n) [{'y' if last_comp else 'n'}]: "
+            ).lower()
+            != "n"
+        )
+
+        pass_input = getpass.getpass(
+            "Write the password (Enter — without password): "
+        ).strip()
+        password = pass_input if pass_input else None
+        current_enc = password is not None
+
+        if last_versions:
+            if last_comp != compress_yn or last_enc != current_enc:
+                print(
+                    f"\n[!] ATTENTION: The parameters are different from the previous version!"
+                )
+                print(f"Was: Compression={last_comp}, Encryption={last_enc}")
+                print(
+                    f"Has become: Compression={compress_yn}, Encryption={current_enc}"
+                )
+
+                if input("\nContinue with the new parameters? (y/n): ").lower() != "y":
+                    print("The operation was canceled by the user.")
+                    return
+
+            if last_enc and current_enc:
+                print(
+                    "[SUCCESS] The access parameters match. The files will use a common database."
+                )
+                if (
+                    input(
+                        "Generate a new security key (Salt)? Deduplication with older versions will be disabled. (y/n): "
+                    ).lower()
+                    == "y"
+                ):
+                    old_salt = None  # This will force the manager to create a new salt.
+                    print(
+                        "A new key will be used. Deduplication with older versions is disabled."
+                    )
+
+            elif not last_enc and current_enc:
+                print("\n[!!!] CRITICAL WARNING [!!!]")
+                print(
+                    "You enable encryption, but previous versions of this project are OPEN in the repository."
+                )
+                print(
+                    "An attacker will be able to read old copies of files without a password."
+                )
+                print(
+                    "\nRecommendation: Create a new folder for this backup or delete the old storage."
+                )
+                if (
+                    input(
+                        "Do you understand the risk and want to continue? (y/n): "
+                    ).lower()
+                    != "y"
+                ):
+                    return
+
+            elif last_enc and not current_enc:
+                print(
+                    "\n[!!!] WARNING: The new backup will be WITHOUT encryption, although it used to be."
+                )
+                if input("Are you sure? (y/n): ").lower() != "y":
+                    return
+
+        stat_cache = manager.get_stat_cache(project_name)
+        rules = load_rules(
+            source_path, args.exclude + [f"!{pattern}" for pattern in args.include]
+        )
+
+        if args.watch:
+            daemon = BackupDaemon(
+                manager,
+                source_path,
+                project_name,
+                rules,
+                password=password,
+                forced_salt=old_salt,
+                compress=compress_yn,
+                compression_policy=args.compression,
+                chunking=args.chunking,
+                delta=args.delta,
+                jobs=args.jobs,
+                paranoid=args.paranoid,
+                interval=args.interval,
+                max_changes=args.max_changes,
+            )
+            signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+            print("\nWatching for changes, Ctrl+C to stop...")
+            daemon.start(stat_cache)
+            daemon.run()
+            manager.close()
+            print(f"\n Stopped after {daemon.snapshots} snapshots")
+            return
+
+        # The scan is streamed into the backup: storing starts with the first file
+        print("\nScanning and creating a snapshot...")
+        records = iter_scan(
+            source_path,
+            stat_cache=stat_cache,
+            paranoid=args.paranoid,
+            workers=args.jobs,
+            defer_hashing=args.fused,
+            rules=rules,
+        )
+        res = manager.create_backup(
+            records,
+            source_path,
+            project_name,
+            comment,
+            compress=compress_yn,
+            password=password,
+            forced_salt=old_salt,
+            chunking=args.chunking,
+            jobs=args.jobs,
+            compression_policy=args.compression,
+            stat_cache=stat_cache,
+            delta=args.delta,
+        )
+        stat_cache.save()
+        manager.close()
+        print(f"\n Ready! New ones: {res.copied}, From the database: {res.skipped}")
+        if res.changed:
+            print(f" Changed during the backup and not saved: {len(res.changed)}")
+            for rel_path in res.changed[:5]:
+                print(f"   {rel_path}")
+
+    elif choice == "2":
+        proj_query = (
+            input("Directory name (Enter to search everywhere): ").strip() or None
+        )
+        date_query = (
+            input(
+                "Part of the date/name of the version, or a range FROM..TO (Enter for latest): "
+            ).strip()
+            or None
+        )
+
+        if date_query and ".." in date_query:
+            since, until = (part.strip() or None for part in date_query.split("..", 1))
+            found = manager._find_target_versions(proj_query, since=since, until=until)
+        else:
+            found = manager._find_target_versions(proj_query, date_query)
+
+        if not found:
+            print("Versions not found.")
+            return
+
+        target_v = found[-1]
+        print(f"\nVersion selected: {target_v.parent.name} / {target_v.name}")
+
+        if args.list:
+            # From the manifest alone: no password, no object is decoded
+            count, total_size = 0, 0
+            for rel_path, info in manager.list_version(
+                target_v.parent.name,
+                target_v.name,
+                args.prefix,
+                args.restore_include,
+                args.restore_exclude,
+            ):
+                size = info.get("size")
+                count += 1
+                total_size += size or 0
+                print(f"{'?' if size is None else size:>14}  {info['hash'][:16]}  {rel_path}")
+            manager.close()
+            print(f"\n{count} files, {total_size / (1024**2):.2f} Mb")
+            return
+
+        password = None
+        if manager.get_version_info(target_v).get("salt"):
+            password = getpass.getpass(
+                "This backup is encrypted. Enter the password: "
+            ).strip()
+
+        target_path = Path(input("Where to restore it?: ").strip())
+
+        print("\nRecovery mode:")
+        print("1. Full (original files)")
+        print("2. Technical (as in storage: compression/cipher")
+        mode = input("Choose (1/2) [1]: ").strip() or "1"
+
+        full_clean = mode == "1"
+        cloud = ask_cloud() if args.cloud else None
+
+        report = manager.restore_version(
+            target_v.parent.name,
+            target_v.name,
+            target_path,
+            password=password,
+            decrypt_data=full_clean,
+            decompress_data=full_clean,
+            jobs=args.jobs,
+            cloud=cloud,
+            cache_bytes=args.cache_size * 1024 * 1024,
+            prefix=args.prefix,
+            include=args.restore_include,
+            exclude=args.restore_exclude,
+            hardlink=args.hardlink,
+        )
+        manager.close()
+
+        print("\n\n=== The results of the restoration ===")
+        print(f"Successfully:   {len(report.ok)} / {report.total}")
+        for title, paths in (
+            ("Damaged", report.damaged),
+            ("Missing objects", report.missing_object),
+            ("Wrong password", report.wrong_password),
+            ("Errors", report.errors),
+        ):
+            if paths:
+                print(f"{title}: {len(paths)}")
+                for p in paths[:5]:
+                    print(f"  {p}")
+
+        if report.wrong_password and not report.ok:
+            print("\n[!!!] Invalid password, nothing was restored.")
+            return
+
+        print(f"\nRecovery in {target_path} is complete!")
+
+    elif choice == "3":
+        cloud = ask_cloud()
+        report = cloud.sync(manager, jobs=max(args.jobs, 8), refresh=args.refresh)
+        manager.close()
+        print(
+            f"\nUploaded: {report.uploaded} ({report.uploaded_bytes / (1024**2):.2f} Mb), "
+            f"already there: {report.skipped}, new versions: {report.manifests}"
+        )
+        for err in report.errors[:5]:
+            print(f"  {err}")
+        if report.errors:
+            print("\n[!] Some uploads failed, run the sync again to resume.")
+
+    elif choice == "4":
+        proj_query = input("Directory name (Enter for all): ").strip() or None
+        policy = RetentionPolicy(
+            keep_last=args.keep_last,
+            keep_daily=args.keep_daily,
+            keep_weekly=args.keep_weekly,
+        )
+        report = prune(
+            manager, policy, proj_query, dry_run=args.dry_run, jobs=args.jobs
+        )
+        manager.close()
+
+        verb = "Would remove" if report.dry_run else "Removed"
+        print(f"\n{verb} versions: {len(report.removed_versions)}, kept: {report.kept_versions}")
+        for name in report.removed_versions[:5]:
+            print(f"  {name}")
+        print(
+            f"{verb} objects: {report.dead_objects} "
+            f"({report.reclaimable_bytes / (1024**2):.2f} Mb), in use: {report.live_objects}"
+        )
+        if report.removed_packs or report.repacked_packs:
+            print(f"Packs dropped: {report.removed_packs}, rewritten: {report.repacked_packs}")
+
+    elif choice == "5":
+        proj_query = input("Directory name (Enter for all): ").strip() or None
+        version_query = input("Version name (Enter for all): ").strip() or None
+        password = (
+            getpass.getpass("Password (Enter to skip encrypted objects): ").strip()
+            or None
+        )
+        report = verify(
+            manager,
+            proj_query,
+            version_query,
+            password=password,
+            sample_percent=args.sample,
+            bytes_per_second=args.rate * 1024 * 1024 if args.rate else None,
+            jobs=args.jobs,
+        )
+        manager.close()
+
+        print(
+            f"\nVersions: {report.versions}, objects checked: {report.checked} "
+            f"({report.checked_bytes / (1024**2):.2f} Mb)"
+        )
+        if report.sampled_out:
+            print(f"Left out by the sample: {report.sampled_out}")
+        if report.unverifiable:
+            print(f"Encrypted, not checked without the password: {report.unverifiable}")
+        for title, problems in (("Damaged", report.damaged), ("Missing", report.missing)):
+            if problems:
+                print(f"{title}: {len(problems)}")
+                for problem in problems[:5]:
+                    print(f"  {problem}")
+        if not report.damaged and not report.missing:
+            print("No problems found.")
+
+
+def main():
+    args = parse_args()
+    try:
+        run(args)
+    finally:
+        # Where the time went, also for an interrupted run
+        if args.metrics_json:
+            METRICS.write_json(Path(args.metrics_json))
+        if args.metrics_prom:
+            METRICS.write_prometheus(Path(args.metrics_prom))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,297 +1,1270 @@
-import json
-import logging
-import zlib
-import hashlib
-import os
-from crypter import FileCrypter
-from datetime import datetime
-from pathlib import Path
-from classes import ScanResult, ProgressEvent, CopyResult
-from utils import show_progress
-from hasher import get_file_hash
-
-logger = logging.getLogger(__name__)
-
-NON_COMPRESSIBLE = {
-    ".zip",
-    ".7z",
-    ".rar",
-    ".gz",
-    ".tar",  # Archives
-    ".mp4",
-    ".mkv",
-    ".avi",
-    ".mov",  # Movie
-    ".mp3",
-    ".wav",
-    ".flac",  # Audio
-    ".jpg",
-    ".jpeg",
-    ".png",  # Photo
-    ".docx",
-    ".xlsx",
-    ".pptx",  # Docs MS Office
-    ".pdf",
-}
-
-
-class BackupManager:
-    def __init__(self, backup_base_path: Path):
-        self.backup_base = backup_base_path
-        self.objects_path = self.backup_base / "objects"
-
-    def _get_object_path(
-        self,
-        file_hash: str,
-        encrypted: bool = False,
-        compressed: bool = False,
-        salt: str = "",
-    ) -> Path:
-        meta = (
-            f"{'enc' if encrypted else 'raw'}_{'zip' if compressed else 'nozip'}_{salt}"
-        )
-        store_hash = hashlib.sha256((file_hash + meta).encode()).hexdigest()
-        return self.objects_path / store_hash[:2] / store_hash
-
-    def _add_padding(self, data: bytes, block_size: int = 256) -> bytes:
-        data_len = len(data).to_bytes(4, byteorder="big")
-        pad_len = block_size - (len(data) + 4) % block_size
-        padding = os.urandom(pad_len)
-        return data_len + data + padding
-
-    def _remove_padding(self, padded_data: bytes) -> bytes:
-        if len(padded_data) < 4:
-            return padded_data
-        data_len = int.from_bytes(padded_data[:4], byteorder="big")
-        return padded_data[4 : 4 + data_len]
-
-    def create_backup(
-        self,
-        scan_result: ScanResult,
-        source_path: Path,
-        project_name: str,
-        comment: str = "",
-        compress: bool = True,
-        password=None,
-        forced_salt=None,
-    ) -> CopyResult:
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        snapshot_dir = self.backup_base / project_name / timestamp
-        snapshot_dir.mkdir(parents=True, exist_ok=True)
-        salt_bytes = bytes.fromhex(forced_salt) if forced_salt else None
-        crypter = FileCrypter(password, salt=salt_bytes) if password else None
-
-        copied_count, skipped_count, errors = 0, 0, 0
-        manifest_files = {}
-
-        for path, f_hash in scan_result.file_hashes.items():
-            should_compress = compress and (path.suffix.lower() not in NON_COMPRESSIBLE)
-            current_salt = crypter.salt.hex() if crypter else ""
-            obj_path = self._get_object_path(
-                f_hash,
-                encrypted=bool(password),
-                compressed=should_compress,
-                salt=current_salt,
-            )
-
-            if not obj_path.exists():
-                try:
-                    obj_path.parent.mkdir(parents=True, exist_ok=True)
-
-                    # Read original
-                    with open(path, "rb") as f_in:
-                        data = f_in.read()
-
-                    # Compress if "on"
-                    if should_compress:
-                        data = zlib.compress(data, level=6)
-
-                    if should_compress or crypter:
-                        data = self._add_padding(data)
-
-                    if crypter:
-                        data = crypter.encrypt(data)
-
-                    # Save result
-                    with open(obj_path, "wb") as f_out:
-                        f_out.write(data)
-
-                    copied_count += 1
-                except Exception as e:
-                    logger.error(f"Failed to process {path}: {e}")
-                    errors += 1
-                    continue
-            else:
-                skipped_count += 1
-
-            rel_path = path.relative_to(source_path)
-            # Important: write flag "compressed" in the manifest for each file
-            manifest_files[str(rel_path)] = {
-                "hash": f_hash,
-                "compressed": should_compress,
-            }
-
-            show_progress(
-                ProgressEvent(
-                    processed=copied_count + skipped_count,
-                    total=scan_result.total_files,
-                    current_file=path.name,
-                )
-            )
-
-        manifest = {
-            "info": {
-                "timestamp": timestamp,
-                "salt": crypter.salt.hex() if crypter else None,
-                "encryption": "ChaCha20-Poly1305" if crypter else None,
-                "comment": comment,
-                "total_files": scan_result.total_files,
-                "compression_enabled": compress,  # A common flag for the entire version
-            },
-            "files": manifest_files,
-        }
-
-        with open(snapshot_dir / "manifest.json", "w", encoding="utf-8") as f:
-            json.dump(manifest, f, indent=4, ensure_ascii=False)
-
-        print()
-        return CopyResult(
-            copied=copied_count,
-            skipped=skipped_count,
-            errors=errors,
-            quantity_versions=0,
-        )
-
-    def restore_version(
-        self,
-        project_name: str,
-        version_name: str,
-        target_path: Path,
-        password=None,
-        decrypt_data=True,
-        decompress_data=True,
-    ):
-        # 1. Path for safe restore
-        safe_restore_path = target_path / f"{project_name}_{version_name}"
-        safe_restore_path.mkdir(parents=True, exist_ok=True)
-
-        manifest_path = self.backup_base / project_name / version_name / "manifest.json"
-        with open(manifest_path, "r", encoding="utf-8") as f:
-            manifest = json.load(f)
-
-        salt_hex = manifest["info"].get("salt")
-        crypter = (
-            FileCrypter(password, bytes.fromhex(salt_hex))
-            if salt_hex and password
-            else None
-        )
-
-        total_files = manifest["info"]["total_files"]
-        success_count = 0
-        error_list = []
-        print(f"\n[RESTORE] Restoring {total_files} files to: {safe_restore_path}")
-
-        for i, (rel_path_str, info) in enumerate(manifest["files"].items(), 1):
-            file_hash = info["hash"]
-            is_compressed = info.get("compressed", False)
-            is_encrypted = bool(salt_hex)
-            obj_path = self._get_object_path(
-                file_hash,
-                encrypted=is_encrypted,
-                compressed=is_compressed,
-                salt=salt_hex or "",
-            )
-            dest_path = safe_restore_path / rel_path_str
-
-            try:
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-
-                # Read data from "objects"
-                with open(obj_path, "rb") as f_in:
-                    data = f_in.read()
-
-                if decrypt_data and crypter:
-                    try:
-                        data = crypter.decrypt(data)
-                    except Exception:
-                        raise PermissionError(f"Invalid password for {rel_path_str}")
-
-                if (decrypt_data or not salt_hex) and decompress_data:
-                    if info.get("compressed") or salt_hex:
-                        try:
-                            data = self._remove_padding(data)
-                        except:
-                            pass
-
-                # AUTO—DECOMPRESSION: if there is a compression flag in the manifest, decompress
-                if decompress_data and info.get("compressed"):
-                    try:
-                        data = zlib.decompress(data)
-                    except:
-                        logger.error(f"Decompression error {rel_path_str}")
-
-                # Write clean data
-                final_path = (
-                    dest_path
-                    if (decrypt_data and decompress_data)
-                    else dest_path.with_suffix(dest_path.suffix + ".raw")
-                )
-                with open(final_path, "wb") as f_out:
-                    f_out.write(data)
-
-                success_count += 1
-
-                # --- VERIFY ---
-                if decrypt_data and decompress_data:
-                    if get_file_hash(final_path) != info["hash"]:
-                        print(f"ALARM: {rel_path_str} damaged!")
-
-                show_progress(
-                    ProgressEvent(
-                        processed=i, total=total_files, current_file=rel_path_str
-                    )
-                )
-
-            except PermissionError as e:
-                print(f"\n[!!!] {e}")
-                return
-            except Exception as e:
-                error_list.append(f"{rel_path_str}: {e}")
-
-        print(f"\n\n=== The results of the restoration ===")
-        print(f"Successfully:   {success_count} / {total_files}")
-        if error_list:
-            print(f"Errors:    {len(error_list)}")
-            print("Error details are saved in the log.")
-            for err in error_list[:5]:
-                logger.error(err)
-
-    def _find_target_versions(
-        self, project_name: str = None, date_hint: str = None
-    ) -> list[Path]:
-        versions = []
-        # If path is not exist, we will refund empty list
-        if not self.backup_base.exists():
-            return []
-
-        search_dirs = (
-            [self.backup_base / project_name]
-            if project_name
-            else [
-                d
-                for d in self.backup_base.iterdir()
-                if d.is_dir() and d.name != "objects"
-            ]
-        )
-
-        for p_dir in search_dirs:
-            if not p_dir.exists():
-                continue
-            for v_dir in p_dir.iterdir():
-                if v_dir.is_dir() and (v_dir / "manifest.json").exists():
-                    if date_hint and date_hint not in v_dir.name:
-                        continue
-                    versions.append(v_dir)
-
-        versions.sort(key=lambda x: x.name)
-        return versions
+import logging
+import os
+import zlib
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from time import perf_counter
+from cryptography.exceptions import InvalidTag
+from crypter import FileCrypter
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+from classes import ScanResult, ScanRecord, ProgressEvent, CopyResult, RestoreReport
+from utils import in_order, show_progress
+from chunker import CHUNKING_THRESHOLD, iter_chunks
+from clone import clone_file
+from delta import (
+    DELTA_CHAIN,
+    DELTA_MAX_LITERAL,
+    DELTA_THRESHOLD,
+    DeltaEncoder,
+    apply_delta,
+    delta_chunks,
+    delta_key,
+    read_signature,
+    signature_key,
+)
+from object_format import (
+    STREAM_FORMAT,
+    add_padding,
+    remove_padding,
+    read_blocks,
+    encode_stream,
+    decode_stream,
+)
+from object_store import ObjectStore
+from object_cache import CACHE_BYTES, ObjectCache, Prefetcher
+from compressors import (
+    SAMPLE_SIZE,
+    get_codec,
+    is_compressible,
+    policy_codec,
+    probe_file,
+)
+from catalog import VersionCatalog
+from manifest import ManifestWriter, open_manifest
+from ignore_rules import PathFilter
+from stat_cache import StatCache, CACHE_FILE_NAME
+from file_lock import file_lock
+from metrics import METRICS
+from durability import DEFAULT_DURABILITY
+
+logger = logging.getLogger(__name__)
+
+NON_COMPRESSIBLE = {
+    ".zip",
+    ".7z",
+    ".rar",
+    ".gz",
+    ".tar",  # Archives
+    ".mp4",
+    ".mkv",
+    ".avi",
+    ".mov",  # Movie
+    ".mp3",
+    ".wav",
+    ".flac",  # Audio
+    ".jpg",
+    ".jpeg",
+    ".png",  # Photo
+    ".docx",
+    ".xlsx",
+    ".pptx",  # Docs MS Office
+    ".pdf",
+}
+
+
+def is_plain_object(info: dict, salt_hex) -> bool:
+    # Objects of the old format without compression and encryption are the content as
+    # it is, like the plain objects written today: they are read block by block.
+    # Only compressed or encrypted objects of the old format must be read whole
+    return (
+        info.get("format", 1) != STREAM_FORMAT
+        and not info.get("compressed")
+        and not salt_hex
+    )
+
+
+# Restoring from the cloud: how far ahead of the decoder objects are downloaded,
+# and the least number of download workers
+PREFETCH_ENTRIES = 64
+PREFETCH_JOBS = 8
+# Backups hold it shared and prune exclusive: prune never deletes objects that a
+# running backup has found in the store and decided not to write
+STORE_LOCK_NAME = "store.lock"
+
+
+def get_store_hash(
+    file_hash: str,
+    encrypted: bool = False,
+    compressed: bool = False,
+    salt: str = "",
+    fmt: int = 1,
+    codec: str = "zlib",
+) -> str:
+    # zlib keeps the old "zip" name, so objects of older versions are still shared
+    zip_name = "zip" if codec == "zlib" else f"zip-{codec}"
+    meta = f"{'enc' if encrypted else 'raw'}_{zip_name if compressed else 'nozip'}_{salt}"
+    # Stream objects get their own names, so they never collide with old whole-file ones
+    if fmt > 1:
+        meta += f"_v{fmt}"
+    return hashlib.sha256((file_hash + meta).encode()).hexdigest()
+
+
+def get_entry_objects(info: dict, salt_hex) -> list[tuple[str, Optional[str]]]:
+    # The objects of one manifest entry in the order a restore reads them, with the sha256
+    # of the content each one decodes to (None for deltas and signatures). A chunked file
+    # is made of several, a delta of the full object it starts from and the deltas of
+    # its chain. The signature of a file stored in delta mode comes last
+    def store_hash_of(key):
+        return get_store_hash(
+            key,
+            encrypted=bool(salt_hex),
+            compressed=info.get("compressed", False),
+            salt=salt_hex or "",
+            fmt=info.get("format", 1),
+            codec=info.get("codec", "zlib"),
+        )
+
+    if "delta" in info:
+        chain = info["delta"] + [info["hash"]]
+        objects = [(store_hash_of(chain[0]), chain[0])]
+        objects += [
+            (store_hash_of(delta_key(base_hash, obj_hash)), None)
+            for base_hash, obj_hash in zip(chain, chain[1:])
+        ]
+    else:
+        objects = [
+            (store_hash_of(obj_hash), obj_hash)
+            for obj_hash in info.get("chunks", [info["hash"]])
+        ]
+    if info.get("signature"):
+        objects.append((store_hash_of(signature_key(info["hash"])), None))
+    return objects
+
+
+def get_entry_store_hashes(info: dict, salt_hex, signature: bool = True) -> list[str]:
+    objects = get_entry_objects(info, salt_hex)
+    if info.get("signature") and not signature:
+        objects = objects[:-1]
+    return [store_hash for store_hash, _ in objects]
+
+
+def select_entries(manifest, path_filter: PathFilter) -> Iterator[tuple[str, dict]]:
+    for rel_path, info in manifest.items(path_filter.prefix):
+        if path_filter.matches(rel_path):
+            yield rel_path, info
+
+
+class FileChangedError(Exception):
+    # A file changed between the scan and the moment it was stored
+    pass
+
+
+class BackupManager:
+    def __init__(
+        self,
+        backup_base_path: Path,
+        packed: bool = False,
+        durability: str = DEFAULT_DURABILITY,
+    ):
+        self.backup_base = backup_base_path
+        self.objects_path = self.backup_base / "objects"
+        # All object reads and writes go through the store: loose files and pack files
+        self.store = ObjectStore(self.objects_path, packed=packed, durability=durability)
+        self.catalog = VersionCatalog(self.backup_base)
+        # Objects being written right now by the worker threads of create_backup
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def get_stat_cache(self, project_name: str) -> StatCache:
+        # The cache lives next to the snapshots of the project
+        return StatCache(self.backup_base / project_name / CACHE_FILE_NAME)
+
+    def close(self):
+        self.store.close()
+
+    def store_lock(self, shared: bool = False):
+        self.backup_base.mkdir(parents=True, exist_ok=True)
+        return file_lock(self.backup_base / STORE_LOCK_NAME, shared=shared)
+
+    def _get_store_hash(
+        self,
+        file_hash: str,
+        encrypted: bool = False,
+        compressed: bool = False,
+        salt: str = "",
+        fmt: int = 1,
+        codec: str = "zlib",
+    ) -> str:
+        return get_store_hash(file_hash, encrypted, compressed, salt, fmt, codec)
+
+    def _get_object_path(
+        self,
+        file_hash: str,
+        encrypted: bool = False,
+        compressed: bool = False,
+        salt: str = "",
+        fmt: int = 1,
+    ) -> Path:
+        # Where the object lives when it is stored loose
+        return self.store.loose_path(
+            self._get_store_hash(file_hash, encrypted, compressed, salt, fmt)
+        )
+
+    def _add_padding(self, data: bytes, block_size: int = 256) -> bytes:
+        return add_padding(data, block_size)
+
+    def _remove_padding(self, padded_data: bytes) -> bytes:
+        return remove_padding(padded_data)
+
+    def _object_exists(self, store_hash: str) -> bool:
+        # An object that another worker is still writing counts once it is complete
+        started = perf_counter()
+        with self._inflight_lock:
+            event = self._inflight.get(store_hash)
+        if event:
+            event.wait()
+        exists = self.store.exists(store_hash)
+        METRICS.add("exists", perf_counter() - started)
+        return exists
+
+    def _claim_object(self, store_hash: str) -> bool:
+        # True if the caller has to write the object. Two files with the same content
+        # never write the same object at the same time: the second one waits for the first
+        while True:
+            with self._inflight_lock:
+                event = self._inflight.get(store_hash)
+                if event is None:
+                    self._inflight[store_hash] = threading.Event()
+                    break
+            event.wait()
+        if self.store.exists(store_hash):
+            self._release_object(store_hash)
+            return False
+        return True
+
+    def _release_object(self, store_hash: str):
+        with self._inflight_lock:
+            self._inflight.pop(store_hash).set()
+
+    def _encode_object(self, blocks, codec_name, level, crypter, fmt):
+        # Read, compress, pad and encrypt chunk by chunk: memory does not grow with file size
+        if fmt == STREAM_FORMAT:
+            codec = get_codec(codec_name) if codec_name else None
+            return encode_stream(blocks, codec, crypter, level)
+        return blocks
+
+    def _write_object(
+        self, store_hash: str, blocks, codec_name, level, crypter, fmt
+    ):
+        self.store.write(
+            store_hash, self._encode_object(blocks, codec_name, level, crypter, fmt)
+        )
+
+    def _load_known_chunks(self, project_name: str, crypter) -> dict:
+        # Entries of chunked files of the latest version, by file hash. Only valid with the same salt
+        versions = self._find_target_versions(project_name)
+        if not versions:
+            return {}
+        salt_hex = crypter.salt.hex() if crypter else None
+        if self.get_version_info(versions[-1]).get("salt") != salt_hex:
+            return {}
+        return {
+            info["hash"]: info
+            for _, info in open_manifest(versions[-1]).items()
+            if "chunks" in info
+        }
+
+    def _load_previous_manifest(self, project_name: str, crypter):
+        # The latest version, whose entries are the bases of deltas. Only valid with the same salt
+        versions = self._find_target_versions(project_name)
+        if not versions:
+            return None
+        salt_hex = crypter.salt.hex() if crypter else None
+        if self.get_version_info(versions[-1]).get("salt") != salt_hex:
+            return None
+        return open_manifest(versions[-1])
+
+    def _store_file(
+        self,
+        path: Path,
+        f_hash: str,
+        compress: bool,
+        crypter,
+        chunking: bool = False,
+        known_chunks: dict = None,
+        compression_policy: str = "balanced",
+        scan_stat: os.stat_result = None,
+        delta: bool = False,
+        base_entry_of=None,
+    ) -> tuple[dict, int]:
+        # Returns the manifest entry of the file and the number of objects written.
+        # f_hash is None for a file that was not hashed by the scan: it is hashed here,
+        # from the same reads that feed the object, and checked against scan_stat.
+        # In delta mode base_entry_of() gives the entry of the file in the previous version
+        current_salt = crypter.salt.hex() if crypter else ""
+
+        # Codecs an existing object may use, best first; None means stored as is.
+        # zlib is kept as a fallback so objects of older versions are still found
+        candidates = [None]
+        level = None
+        if compress and path.suffix.lower() not in NON_COMPRESSIBLE:
+            policy_name, level = policy_codec(compression_policy)
+            candidates = list(dict.fromkeys([policy_name, "zlib", None]))
+
+        def fmt_of(codec_name):
+            # Plain copies are stored as is, everything else as a stream object
+            return STREAM_FORMAT if (codec_name or crypter) else 1
+
+        def store_hash_of(obj_hash, codec_name):
+            return self._get_store_hash(
+                obj_hash,
+                encrypted=bool(crypter),
+                compressed=bool(codec_name),
+                salt=current_salt,
+                fmt=fmt_of(codec_name),
+                codec=codec_name or "zlib",
+            )
+
+        def entry_of(codec_name):
+            # Important: write flag "compressed" in the manifest for each file
+            entry = {"hash": f_hash, "compressed": bool(codec_name)}
+            if codec_name:
+                entry["codec"] = codec_name
+            if fmt_of(codec_name) == STREAM_FORMAT:
+                entry["format"] = STREAM_FORMAT
+            return entry
+
+        def choose_codec(sample=None):
+            # Incompressible data (media, archives, encrypted files) is not compressed at all
+            if not candidates[0]:
+                return None
+            if sample is not None:
+                return candidates[0] if is_compressible(sample) else None
+            return candidates[0] if probe_file(path) else None
+
+        def check_unchanged(spooled, read_hash, file_stat):
+            # The content read for storing must be the content the scan recorded
+            problem = None
+            if f_hash is not None and read_hash != f_hash:
+                problem = "changed after it was hashed"
+            elif scan_stat is not None and (
+                file_stat.st_size != scan_stat.st_size
+                or file_stat.st_mtime_ns != scan_stat.st_mtime_ns
+            ):
+                problem = "changed while it was stored"
+            if problem:
+                if spooled:
+                    self.store.discard_spool(spooled)
+                raise FileChangedError(f"{path} {problem}")
+
+        new_objects = 0
+        if chunking and path.stat().st_size >= CHUNKING_THRESHOLD:
+            # An unchanged file reuses the chunk list of the previous version without reading it
+            known = (known_chunks or {}).get(f_hash) if f_hash else None
+            if known:
+                known_codec = (
+                    known.get("codec", "zlib") if known.get("compressed") else None
+                )
+                if known_codec in candidates and all(
+                    self._object_exists(store_hash_of(h, known_codec))
+                    for h in known["chunks"]
+                ):
+                    entry = entry_of(known_codec)
+                    entry["chunks"] = known["chunks"]
+                    return entry, 0
+
+            codec_name = choose_codec()
+            fmt = fmt_of(codec_name)
+
+            # Every chunk is an object of its own, shared chunks are stored once
+            chunk_hashes = []
+            file_sha256 = hashlib.sha256()
+            with open(path, "rb") as f_in:
+                for chunk in iter_chunks(f_in):
+                    started = perf_counter()
+                    file_sha256.update(chunk)
+                    chunk_hash = hashlib.sha256(chunk).hexdigest()
+                    METRICS.add("hash", perf_counter() - started, len(chunk))
+                    chunk_hashes.append(chunk_hash)
+                    store_hash = store_hash_of(chunk_hash, codec_name)
+                    if self._claim_object(store_hash):
+                        try:
+                            self._write_object(
+                                store_hash, [chunk], codec_name, level, crypter, fmt
+                            )
+                        finally:
+                            self._release_object(store_hash)
+                        new_objects += 1
+                file_stat = os.fstat(f_in.fileno())
+            # Chunks are named by their own hashes, only the entry would be wrong
+            check_unchanged(None, file_sha256.hexdigest(), file_stat)
+            f_hash = file_sha256.hexdigest()
+            entry = entry_of(codec_name)
+            entry["chunks"] = chunk_hashes
+            return entry, new_objects
+
+        if delta and path.stat().st_size >= DELTA_THRESHOLD:
+            return self._store_delta_file(
+                path,
+                f_hash,
+                base_entry_of() if base_entry_of else None,
+                candidates,
+                level,
+                crypter,
+                store_hash_of,
+                entry_of,
+                choose_codec,
+                check_unchanged,
+            )
+
+        if f_hash:
+            # Content already stored with any acceptable codec is not probed or read again
+            for codec_name in candidates:
+                if self._object_exists(store_hash_of(f_hash, codec_name)):
+                    return entry_of(codec_name), 0
+
+            codec_name = choose_codec()
+            store_hash = store_hash_of(f_hash, codec_name)
+            if not self._claim_object(store_hash):
+                return entry_of(codec_name), 0
+            try:
+                with open(path, "rb") as f_in:
+                    spooled, read_hash, file_stat = self._spool_file(
+                        f_in,
+                        read_blocks(f_in),
+                        codec_name,
+                        level,
+                        crypter,
+                        fmt_of(codec_name),
+                        "verify",
+                    )
+                check_unchanged(spooled, read_hash, file_stat)
+                self.store.commit_spool(store_hash, spooled)
+            finally:
+                self._release_object(store_hash)
+            return entry_of(codec_name), 1
+
+        # Single read: the file is hashed while it is encoded into a temporary object,
+        # which gets its name once the hash is known
+        with open(path, "rb") as f_in:
+            blocks = read_blocks(f_in)
+            first = next(blocks, b"")
+            codec_name = choose_codec(first[:SAMPLE_SIZE])
+            spooled, read_hash, file_stat = self._spool_file(
+                f_in,
+                chain([first], blocks),
+                codec_name,
+                level,
+                crypter,
+                fmt_of(codec_name),
+            )
+        check_unchanged(spooled, read_hash, file_stat)
+        f_hash = read_hash
+
+        for existing_codec in candidates:
+            if self._object_exists(store_hash_of(f_hash, existing_codec)):
+                self.store.discard_spool(spooled)
+                return entry_of(existing_codec), 0
+        store_hash = store_hash_of(f_hash, codec_name)
+        if not self._claim_object(store_hash):
+            self.store.discard_spool(spooled)
+            return entry_of(codec_name), 0
+        try:
+            self.store.commit_spool(store_hash, spooled)
+        finally:
+            self._release_object(store_hash)
+        return entry_of(codec_name), 1
+
+    def _store_delta_file(
+        self,
+        path: Path,
+        f_hash,
+        base_entry,
+        candidates,
+        level,
+        crypter,
+        store_hash_of,
+        entry_of,
+        choose_codec,
+        check_unchanged,
+    ) -> tuple[dict, int]:
+        # Delta mode: a changed file is stored as a delta against its content in the
+        # previous version, at most DELTA_CHAIN deltas after a full object. Every content
+        # also gets a signature object, which the next version encodes its delta against
+        salt_hex = crypter.salt.hex() if crypter else None
+
+        def fmt_of(codec_name):
+            return STREAM_FORMAT if (codec_name or crypter) else 1
+
+        def entry_for(codec_name):
+            # f_hash of a file left unhashed by the scan is only known here
+            entry = entry_of(codec_name)
+            entry["hash"] = f_hash
+            return entry
+
+        def signature_hash_of(obj_hash, codec_name):
+            return store_hash_of(signature_key(obj_hash), codec_name)
+
+        chain, base_codec = [], None
+        if base_entry and base_entry.get("signature") and "chunks" not in base_entry:
+            base_codec = (
+                base_entry.get("codec", "zlib") if base_entry.get("compressed") else None
+            )
+            if base_codec in candidates and all(
+                self._object_exists(store_hash)
+                for store_hash in get_entry_store_hashes(base_entry, salt_hex)
+            ):
+                chain = base_entry.get("delta", []) + [base_entry["hash"]]
+
+        def stored_entry():
+            # The content is stored already: unchanged since the previous version, or
+            # the same as another file
+            if chain and f_hash == chain[-1]:
+                return dict(base_entry)
+            for codec_name in candidates:
+                if self._object_exists(store_hash_of(f_hash, codec_name)):
+                    entry = entry_for(codec_name)
+                    if self._object_exists(signature_hash_of(f_hash, codec_name)):
+                        entry["signature"] = True
+                    return entry
+            return None
+
+        if f_hash and (entry := stored_entry()):
+            return entry, 0
+
+        base_signature = None
+        if chain and len(chain) <= DELTA_CHAIN:
+            try:
+                with self.store.open(signature_hash_of(chain[-1], base_codec)) as f_in:
+                    base_signature = read_signature(
+                        self._read_object(f_in, fmt_of(base_codec), crypter, True, path)
+                    )
+            except (OSError, ValueError, PermissionError) as e:
+                logger.warning(f"No delta for {path}, its base signature is unusable: {e}")
+
+        def spool(base):
+            encoder = DeltaEncoder(base)
+            codec_name = base_codec if encoder.delta else choose_codec()
+            with open(path, "rb") as f_in:
+                spooled, read_hash, file_stat = self._spool_file(
+                    f_in,
+                    delta_chunks(f_in),
+                    codec_name,
+                    level,
+                    crypter,
+                    fmt_of(codec_name),
+                    "verify" if f_hash else "hash",
+                    encoder.encode,
+                )
+            check_unchanged(spooled, read_hash, file_stat)
+            return encoder, codec_name, spooled, read_hash
+
+        encoder, codec_name, spooled, f_hash = spool(base_signature)
+        if encoder.delta and encoder.literal_bytes > DELTA_MAX_LITERAL * encoder.size:
+            # Mostly new data: a full object, which starts a new chain
+            self.store.discard_spool(spooled)
+            encoder, codec_name, spooled, f_hash = spool(None)
+
+        if entry := stored_entry():
+            self.store.discard_spool(spooled)
+            return entry, 0
+
+        store_hash = store_hash_of(
+            delta_key(chain[-1], f_hash) if encoder.delta else f_hash, codec_name
+        )
+        new_objects = 0
+        if self._claim_object(store_hash):
+            try:
+                self.store.commit_spool(store_hash, spooled)
+            finally:
+                self._release_object(store_hash)
+            new_objects += 1
+        else:
+            self.store.discard_spool(spooled)
+
+        sig_hash = signature_hash_of(f_hash, codec_name)
+        if self._claim_object(sig_hash):
+            try:
+                self._write_object(
+                    sig_hash,
+                    [bytes(encoder.signature)],
+                    codec_name,
+                    level,
+                    crypter,
+                    fmt_of(codec_name),
+                )
+            finally:
+                self._release_object(sig_hash)
+
+        entry = entry_for(codec_name)
+        entry["signature"] = True
+        if encoder.delta:
+            entry["delta"] = chain
+        return entry, new_objects
+
+    def _spool_file(
+        self,
+        f_in,
+        blocks,
+        codec_name,
+        level,
+        crypter,
+        fmt,
+        hash_stage="hash",
+        encoder=None,
+    ):
+        # Encodes the blocks read from f_in into a spooled object. Returns the spool,
+        # the sha256 of the data read and the file stat taken after the last read.
+        # The sha256 is a "verify" when the scan hashed the file already. An encoder
+        # turns the blocks into what is stored (delta mode)
+        sha256 = hashlib.sha256()
+
+        def hashed():
+            for block in blocks:
+                started = perf_counter()
+                sha256.update(block)
+                METRICS.add(hash_stage, perf_counter() - started, len(block))
+                yield block
+
+        spooled = self.store.spool(
+            self._encode_object(
+                encoder(hashed()) if encoder else hashed(), codec_name, level, crypter, fmt
+            )
+        )
+        return spooled, sha256.hexdigest(), os.fstat(f_in.fileno())
+
+    def create_backup(
+        self,
+        scan_result: Union[ScanResult, Iterable[ScanRecord]],
+        source_path: Path,
+        project_name: str,
+        comment: str = "",
+        compress: bool = True,
+        password=None,
+        forced_salt=None,
+        chunking: bool = False,
+        jobs: int = 1,
+        compression_policy: str = "balanced",
+        stat_cache: StatCache = None,
+        crypter: FileCrypter = None,
+        delta: bool = False,
+    ) -> CopyResult:
+        with self.store_lock(shared=True):
+            # A prune that ran since the store was loaded (by a long-running process)
+            # may have deleted objects it still lists
+            self.store.refresh()
+            return self._create_backup(
+                scan_result,
+                source_path,
+                project_name,
+                comment=comment,
+                compress=compress,
+                password=password,
+                forced_salt=forced_salt,
+                chunking=chunking,
+                jobs=jobs,
+                compression_policy=compression_policy,
+                stat_cache=stat_cache,
+                crypter=crypter,
+                delta=delta,
+            )
+
+    def _create_backup(
+        self,
+        scan_result: Union[ScanResult, Iterable[ScanRecord]],
+        source_path: Path,
+        project_name: str,
+        comment: str = "",
+        compress: bool = True,
+        password=None,
+        forced_salt=None,
+        chunking: bool = False,
+        jobs: int = 1,
+        compression_policy: str = "balanced",
+        stat_cache: StatCache = None,
+        crypter: FileCrypter = None,
+        delta: bool = False,
+    ) -> CopyResult:
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        snapshot_dir = self.backup_base / project_name / timestamp
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        # A ready crypter (a long-running process) skips the key derivation
+        if crypter is None and password:
+            salt_bytes = bytes.fromhex(forced_salt) if forced_salt else None
+            crypter = FileCrypter(password, salt=salt_bytes)
+
+        copied_count, skipped_count, errors = 0, 0, 0
+        changed = []
+        manifest_writer = ManifestWriter(
+            snapshot_dir, durable=self.store.durability != "none"
+        )
+        known_chunks = self._load_known_chunks(project_name, crypter) if chunking else {}
+        # Entries are looked up by path, only for files large enough for a delta
+        previous = self._load_previous_manifest(project_name, crypter) if delta else None
+
+        # A ScanResult knows its totals up front, a stream of ScanRecord (iter_scan)
+        # is stored while the walk goes on and its totals grow as records arrive
+        streaming = not isinstance(scan_result, ScanResult)
+        found_files, found_bytes = 0, 0
+
+        def scan_items():
+            # (path, hash or None, stat of a file left unhashed by the scan, size, record)
+            nonlocal found_files, found_bytes
+            if not streaming:
+                found_files, found_bytes = scan_result.total_files, scan_result.total_size
+                for path, f_hash in scan_result.file_hashes.items():
+                    yield (
+                        path,
+                        f_hash,
+                        scan_result.deferred.get(path),
+                        scan_result.sizes.get(path),
+                        None,
+                    )
+                return
+            for record in scan_result:
+                found_files += 1
+                found_bytes += record.size
+                path = source_path / record.rel_path
+                yield path, record.hash, record.stat, record.size, record
+
+        def store(path, f_hash, scan_stat):
+            base_entry_of = None
+            if previous:
+                base_entry_of = partial(previous.get, str(path.relative_to(source_path)))
+            return self._store_file(
+                path,
+                f_hash,
+                compress,
+                crypter,
+                chunking,
+                known_chunks,
+                compression_policy,
+                scan_stat,
+                delta,
+                base_entry_of,
+            )
+
+        def collect(path, scan_stat, size, record, task):
+            nonlocal copied_count, skipped_count, errors
+            try:
+                if isinstance(task, Future):
+                    entry, new_objects = task.result()
+                else:
+                    entry, new_objects = task()
+            except FileChangedError as e:
+                # Not stored: the recorded hash and the content would not match
+                logger.warning(f"Skip {path}: {e}")
+                changed.append(str(path.relative_to(source_path)))
+                errors += 1
+                return
+            except Exception as e:
+                logger.error(f"Failed to process {path}: {e}")
+                errors += 1
+                return
+
+            if new_objects:
+                copied_count += 1
+            else:
+                skipped_count += 1
+
+            # The size lets a version be listed without decoding any object
+            if size is not None:
+                entry["size"] = size
+            rel_path = path.relative_to(source_path)
+            manifest_writer.add(str(rel_path), entry)
+
+            # Files hashed while they were stored: the scan gets their hashes now
+            if scan_stat is not None:
+                if streaming:
+                    record.hash = entry["hash"]
+                    record.stat = None
+                else:
+                    scan_result.file_hashes[path] = entry["hash"]
+                if stat_cache:
+                    stat_cache.update(str(rel_path), scan_stat, entry["hash"])
+
+            show_progress(
+                ProgressEvent(
+                    processed=copied_count + skipped_count,
+                    total=None if streaming else found_files,
+                    current_file=path.name,
+                    found=found_files if streaming else None,
+                )
+            )
+
+        # Files are stored on a thread pool (zlib, ChaCha20 and file I/O release the GIL),
+        # results are taken in scan order, so the manifest is the same as in the serial mode
+        pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+        def submit_all():
+            for path, f_hash, scan_stat, size, record in scan_items():
+                if pool:
+                    task = pool.submit(store, path, f_hash, scan_stat)
+                else:
+                    task = partial(store, path, f_hash, scan_stat)
+                yield path, scan_stat, size, record, task
+
+        try:
+            for item in in_order(submit_all(), jobs):
+                collect(*item)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+        # The objects are durable and the object index complete before the manifest
+        # refers to the new objects
+        self.store.flush()
+
+        info = {
+            "timestamp": timestamp,
+            "salt": crypter.salt.hex() if crypter else None,
+            "encryption": "ChaCha20-Poly1305" if crypter else None,
+            "comment": comment,
+            "total_files": found_files,
+            "total_bytes": found_bytes,
+            "compression_enabled": compress,  # A common flag for the entire version
+            "compression_policy": compression_policy if compress else None,
+        }
+        manifest_writer.write(info)
+        self.catalog.add(project_name, timestamp, info)
+
+        print()
+        return CopyResult(
+            copied=copied_count,
+            skipped=skipped_count,
+            errors=errors,
+            quantity_versions=0,
+            changed=changed,
+        )
+
+    def restore_version(
+        self,
+        project_name: str,
+        version_name: str,
+        target_path: Path,
+        password=None,
+        decrypt_data=True,
+        decompress_data=True,
+        jobs: int = 1,
+        cloud=None,
+        cache_bytes: int = CACHE_BYTES,
+        prefix: str = "",
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+        hardlink: bool = False,
+    ) -> RestoreReport:
+        # 1. Path for safe restore
+        safe_restore_path = target_path / f"{project_name}_{version_name}"
+        safe_restore_path.mkdir(parents=True, exist_ok=True)
+
+        manifest = open_manifest(self.backup_base / project_name / version_name)
+
+        salt_hex = manifest.info.get("salt")
+        crypter = (
+            FileCrypter(password, bytes.fromhex(salt_hex))
+            if salt_hex and password
+            else None
+        )
+
+        # A partial restore reads only the manifest blocks under the prefix and
+        # decodes only the objects of the selected files
+        path_filter = PathFilter(prefix, include, exclude)
+        if path_filter.selects_all:
+            total_files = manifest.info["total_files"]
+        else:
+            total_files = sum(1 for _ in select_entries(manifest, path_filter))
+        report = RestoreReport(total=total_files)
+        logger.info(f"Restoring {total_files} files to: {safe_restore_path}")
+
+        # With a cloud, objects missing here are downloaded into a local cache, the
+        # prefetcher keeps PREFETCH_ENTRIES manifest entries ahead of the decoder
+        prefetcher = (
+            Prefetcher(
+                self.store,
+                cloud,
+                ObjectCache(self.objects_path / "cache", cache_bytes),
+                jobs=max(jobs, PREFETCH_JOBS),
+            )
+            if cloud
+            else None
+        )
+        open_object = prefetcher.open if prefetcher else self.store.open
+        ahead = select_entries(manifest, path_filter)
+        prefetched = 0
+
+        # Files with the same content are decoded once: the first one is restored from
+        # the objects, the others are cloned from it. Content hash (or, for a raw restore,
+        # the objects) -> (path of the first file, future of its status)
+        first_copies = {}
+
+        def restore(rel_path_str, info, source, done):
+            status = "errors"
+            try:
+                status, message = self._restore_entry(
+                    rel_path_str,
+                    info,
+                    safe_restore_path,
+                    crypter,
+                    salt_hex,
+                    decrypt_data,
+                    decompress_data,
+                    open_object,
+                    source,
+                    hardlink,
+                )
+                return status, message
+            finally:
+                if done is not None:
+                    done.set_result(status)
+
+        def prefetch_until(position):
+            nonlocal prefetched
+            while prefetched < position:
+                entry = next(ahead, None)
+                if entry is None:
+                    return
+                prefetched += 1
+                for store_hash in self._get_entry_store_hashes(entry[1], salt_hex):
+                    prefetcher.prefetch(store_hash)
+
+        processed = 0
+
+        def collect(rel_path_str, info, task) -> bool:
+            nonlocal processed
+            status, message = task.result() if isinstance(task, Future) else task()
+            if prefetcher:
+                for store_hash in self._get_entry_store_hashes(info, salt_hex):
+                    prefetcher.release(store_hash)
+            getattr(report, status).append(message or rel_path_str)
+            processed += 1
+            show_progress(
+                ProgressEvent(
+                    processed=processed,
+                    total=total_files,
+                    current_file=rel_path_str,
+                )
+            )
+            # A wrong password before anything was restored: all other files will fail too
+            return status == "wrong_password" and not report.ok
+
+        # Objects are decoded on a thread pool, results are taken in manifest order
+        pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+        def submit_all():
+            submitted = 0
+            for rel_path_str, info in select_entries(manifest, path_filter):
+                submitted += 1
+                if prefetcher:
+                    prefetch_until(submitted + PREFETCH_ENTRIES)
+                if decrypt_data and decompress_data:
+                    content_key = info["hash"]
+                else:
+                    content_key = tuple(self._get_entry_store_hashes(info, salt_hex))
+                source = first_copies.get(content_key)
+                done = None
+                if source is None:
+                    done = Future()
+                    first_copies[content_key] = (
+                        self._final_path(
+                            safe_restore_path, rel_path_str, decrypt_data and decompress_data
+                        ),
+                        done,
+                    )
+                if pool:
+                    task = pool.submit(restore, rel_path_str, info, source, done)
+                else:
+                    task = partial(restore, rel_path_str, info, source, done)
+                yield rel_path_str, info, task
+
+        try:
+            for item in in_order(submit_all(), jobs):
+                stop = collect(*item)
+                if stop:
+                    break
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+            if prefetcher:
+                prefetcher.close()
+
+        if prefetcher and prefetcher.downloaded:
+            logger.info(f"{prefetcher.downloaded} objects were downloaded from the cloud")
+        if stop:
+            logger.error("Invalid password, the restore was stopped")
+        for err in report.errors[:5]:
+            logger.error(err)
+        return report
+
+    def list_version(
+        self,
+        project_name: str,
+        version_name: str,
+        prefix: str = "",
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+    ) -> Iterator[tuple[str, dict]]:
+        # Paths and entries (hash, size) of a version from its manifest, no object is read
+        manifest = open_manifest(self.backup_base / project_name / version_name)
+        return select_entries(manifest, PathFilter(prefix, include, exclude))
+
+    def _restore_entry(
+        self,
+        rel_path_str: str,
+        info: dict,
+        safe_restore_path: Path,
+        crypter,
+        salt_hex,
+        decrypt_data,
+        decompress_data,
+        open_object,
+        source=None,
+        hardlink: bool = False,
+    ) -> tuple[str, str]:
+        # Returns the RestoreReport field for the file and an optional message.
+        # source is the first file with the same content: the file is cloned from it
+        fmt = info.get("format", 1)
+        store_hashes = self._get_entry_store_hashes(info, salt_hex)
+        dest_path = safe_restore_path / rel_path_str
+        final_path = self._final_path(
+            safe_restore_path, rel_path_str, decrypt_data and decompress_data
+        )
+
+        if source is not None:
+            first_path, first_done = source
+            # The first file was queued earlier, it is being restored or done already
+            if first_done.result() == "ok":
+                try:
+                    dest_path.parent.mkdir(parents=True, exist_ok=True)
+                    clone_file(first_path, final_path, hardlink)
+                    return "ok", None
+                except OSError as e:
+                    logger.warning(f"Cannot copy {first_path} to {final_path}: {e}")
+
+        try:
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+            if "delta" in info and decrypt_data and decompress_data:
+                restored_hash = self._restore_delta(
+                    store_hashes,
+                    final_path,
+                    fmt,
+                    crypter,
+                    rel_path_str,
+                    open_object,
+                )
+            elif (
+                fmt == STREAM_FORMAT
+                or "chunks" in info
+                or "delta" in info
+                or is_plain_object(info, salt_hex)
+            ):
+                restored_hash = self._restore_objects(
+                    store_hashes,
+                    final_path,
+                    fmt,
+                    crypter if decrypt_data else None,
+                    decompress_data,
+                    rel_path_str,
+                    open_object,
+                )
+            else:
+                restored_hash = self._restore_legacy_object(
+                    store_hashes[0],
+                    final_path,
+                    info,
+                    crypter,
+                    salt_hex,
+                    decrypt_data,
+                    decompress_data,
+                    rel_path_str,
+                    open_object,
+                )
+        except PermissionError:
+            return "wrong_password", None
+        except FileNotFoundError:
+            # The destination folder exists, only an object can be missing here
+            return "missing_object", None
+        except Exception as e:
+            return "errors", f"{rel_path_str}: {e}"
+
+        # --- VERIFY --- the hash was computed while writing, the file is not read again
+        if decrypt_data and decompress_data and restored_hash != info["hash"]:
+            return "damaged", None
+        return "ok", None
+
+    def _final_path(self, safe_restore_path: Path, rel_path_str: str, decoded: bool) -> Path:
+        dest_path = safe_restore_path / rel_path_str
+        return dest_path if decoded else dest_path.with_suffix(dest_path.suffix + ".raw")
+
+    def _get_entry_store_hashes(self, info: dict, salt_hex) -> list[str]:
+        # A restore never reads the signature
+        return get_entry_store_hashes(info, salt_hex, signature=False)
+
+    def _read_object(
+        self, f_in, fmt: int, crypter, decompress_data, rel_path_str
+    ) -> Iterator[bytes]:
+        if fmt == STREAM_FORMAT:
+            pieces = decode_stream(f_in, crypter, decompress_data)
+        else:
+            pieces = read_blocks(f_in)
+        try:
+            yield from pieces
+        except InvalidTag:
+            raise PermissionError(f"Invalid password for {rel_path_str}")
+
+    def _restore_objects(
+        self,
+        store_hashes: list[str],
+        final_path: Path,
+        fmt: int,
+        crypter,
+        decompress_data,
+        rel_path_str,
+        open_object,
+    ) -> str:
+        # Decoded frame by frame straight into the destination file, hashed on the way
+        sha256 = hashlib.sha256()
+        with open(final_path, "wb") as f_out:
+            for store_hash in store_hashes:
+                with open_object(store_hash) as f_in:
+                    for piece in self._read_object(
+                        f_in, fmt, crypter, decompress_data, rel_path_str
+                    ):
+                        self._write_piece(f_out, sha256, piece)
+        return sha256.hexdigest()
+
+    def _write_piece(self, f_out, sha256, piece: bytes):
+        started = perf_counter()
+        sha256.update(piece)
+        hashed = perf_counter()
+        f_out.write(piece)
+        METRICS.add("verify", hashed - started, len(piece))
+        METRICS.add("write", perf_counter() - hashed, len(piece))
+
+    def _restore_delta(
+        self,
+        store_hashes: list[str],
+        final_path: Path,
+        fmt: int,
+        crypter,
+        rel_path_str,
+        open_object,
+    ) -> str:
+        # The full object is decoded into a temporary file, each delta of the chain is
+        # applied to the content before it; only the last content goes to the destination
+        sha256 = hashlib.sha256()
+        tmp_paths = [final_path.with_name(f".{final_path.name}.{i}.tmp") for i in (0, 1)]
+        try:
+            with open(tmp_paths[0], "wb") as f_out, open_object(store_hashes[0]) as f_in:
+                for piece in self._read_object(f_in, fmt, crypter, True, rel_path_str):
+                    f_out.write(piece)
+            base_path = tmp_paths[0]
+            for i, store_hash in enumerate(store_hashes[1:], start=1):
+                last = i == len(store_hashes) - 1
+                out_path = final_path if last else tmp_paths[i % 2]
+                with open(base_path, "rb") as f_base, open(out_path, "wb") as f_out:
+                    with open_object(store_hash) as f_in:
+                        pieces = apply_delta(
+                            self._read_object(f_in, fmt, crypter, True, rel_path_str),
+                            f_base.fileno(),
+                            os.fstat(f_base.fileno()).st_size,
+                        )
+                        for piece in pieces:
+                            if last:
+                                self._write_piece(f_out, sha256, piece)
+                            else:
+                                f_out.write(piece)
+                base_path = out_path
+        finally:
+            for tmp_path in tmp_paths:
+                tmp_path.unlink(missing_ok=True)
+        return sha256.hexdigest()
+
+    def _restore_legacy_object(
+        self,
+        store_hash: str,
+        final_path: Path,
+        info: dict,
+        crypter,
+        salt_hex,
+        decrypt_data,
+        decompress_data,
+        rel_path_str,
+        open_object,
+    ) -> str:
+        # Whole-file objects written before the stream format: read data from "objects"
+        with open_object(store_hash) as f_in:
+            data = f_in.read()
+        data = self._decode_legacy_object(
+            data, info, crypter, salt_hex, decrypt_data, decompress_data, rel_path_str
+        )
+
+        # Write clean data
+        with open(final_path, "wb") as f_out:
+            f_out.write(data)
+        return hashlib.sha256(data).hexdigest()
+
+    def _decode_legacy_object(
+        self,
+        data: bytes,
+        info: dict,
+        crypter,
+        salt_hex,
+        decrypt_data,
+        decompress_data,
+        rel_path_str,
+    ) -> bytes:
+        if decrypt_data and crypter:
+            try:
+                data = crypter.decrypt(data)
+            except Exception:
+                raise PermissionError(f"Invalid password for {rel_path_str}")
+
+        if (decrypt_data or not salt_hex) and decompress_data:
+            if info.get("compressed") or salt_hex:
+                try:
+                    data = self._remove_padding(data)
+                except:
+                    pass
+
+        # AUTO—DECOMPRESSION: if there is a compression flag in the manifest, decompress
+        if decompress_data and info.get("compressed"):
+            try:
+                data = zlib.decompress(data)
+            except:
+                logger.error(f"Decompression error {rel_path_str}")
+        return data
+
+    def _find_target_versions(
+        self,
+        project_name: str = None,
+        date_hint: str = None,
+        since: str = None,
+        until: str = None,
+    ) -> list[Path]:
+        # If path is not exist, we will refund empty list
+        if not self.backup_base.exists():
+            return []
+
+        # Answered from the catalog, no manifest is opened
+        return [
+            self.backup_base / p_name / v_name
+            for p_name, v_name in self.catalog.find(
+                project_name, date_hint, since, until
+            )
+        ]
+
+    def get_version_info(self, version_dir: Path) -> dict:
+        # Summary of a version (salt, flags, totals) from the catalog
+        info = self.catalog.get(version_dir.parent.name, version_dir.name)
+        if info is None:
+            info = open_manifest(version_dir).info
+        return info
+
+    def rebuild_catalog(self):
+        self.catalog.rebuild()
@@ -0,0 +1,188 @@
+import bisect
+import heapq
+import json
+import os
+import zlib
+from itertools import islice
+from operator import itemgetter
+from pathlib import Path
+from typing import Iterator, Optional
+
+from durability import fsync_dir
+
+# Manifest format 2: entries sorted by path, grouped into blocks of JSON lines.
+#   MAGIC | flags (1 byte) | blocks | footer | footer offset (8 bytes) | footer length (4 bytes)
+# Each block is [path, entry] lines, zlib-compressed if FLAG_COMPRESSED is set.
+# The footer holds the version info and, for every block, its first path, offset,
+# length and entry count. A single path is found by a binary search over the blocks
+# and one block read; a full pass reads the blocks one by one.
+MANIFEST_NAME = "manifest.dat"
+LEGACY_MANIFEST_NAME = "manifest.json"
+MAGIC = b"SBKMAN2\n"
+FLAG_COMPRESSED = 1
+BLOCK_ENTRIES = 1000
+TRAILER_SIZE = 12
+# Entries are sorted in memory in runs of this size. A longer manifest spills sorted
+# runs to temporary files and merges them, so memory does not grow with the file count
+RUN_ENTRIES = 100_000
+
+
+def manifest_exists(version_dir: Path) -> bool:
+    return (version_dir / MANIFEST_NAME).exists() or (
+        version_dir / LEGACY_MANIFEST_NAME
+    ).exists()
+
+
+def open_manifest(version_dir: Path):
+    if (version_dir / MANIFEST_NAME).exists():
+        return Manifest(version_dir / MANIFEST_NAME)
+    return LegacyManifest(version_dir / LEGACY_MANIFEST_NAME)
+
+
+class ManifestWriter:
+    # durable: the manifest and the version folder are synced once written
+    def __init__(self, version_dir: Path, compress: bool = True, durable: bool = False):
+        self.path = version_dir / MANIFEST_NAME
+        self.compress = compress
+        self.durable = durable
+        self._entries = []
+        self._runs = []
+
+    def add(self, rel_path: str, entry: dict):
+        self._entries.append((rel_path, entry))
+        if len(self._entries) >= RUN_ENTRIES:
+            self._spill()
+
+    def _spill(self):
+        self._entries.sort(key=itemgetter(0))
+        run_path = self.path.with_name(f"{MANIFEST_NAME}.run{len(self._runs)}")
+        with open(run_path, "w", encoding="utf-8") as f:
+            f.writelines(_json_line(item) for item in self._entries)
+        self._runs.append(run_path)
+        self._entries = []
+
+    @staticmethod
+    def _read_run(run_path: Path) -> Iterator[list]:
+        with open(run_path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _pack(self, data: bytes) -> bytes:
+        return zlib.compress(data, 6) if self.compress else data
+
+    def write(self, info: dict):
+        self._entries.sort(key=itemgetter(0))
+        entries = heapq.merge(
+            *(self._read_run(run_path) for run_path in self._runs),
+            self._entries,
+            key=itemgetter(0),
+        )
+        blocks = []
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + bytes([FLAG_COMPRESSED if self.compress else 0]))
+            while group := list(islice(entries, BLOCK_ENTRIES)):
+                lines = "".join(_json_line(item) for item in group)
+                payload = self._pack(lines.encode("utf-8"))
+                blocks.append([group[0][0], f.tell(), len(payload), len(group)])
+                f.write(payload)
+
+            footer = self._pack(
+                json.dumps(
+                    {"info": info, "blocks": blocks}, ensure_ascii=False
+                ).encode("utf-8")
+            )
+            footer_offset = f.tell()
+            f.write(footer)
+            f.write(footer_offset.to_bytes(8, "big") + len(footer).to_bytes(4, "big"))
+            if self.durable:
+                f.flush()
+                os.fsync(f.fileno())
+        # Readers never see a half-written manifest
+        os.replace(tmp_path, self.path)
+        if self.durable:
+            # The new name, and the new version folder in the project folder
+            fsync_dir(self.path.parent)
+            fsync_dir(self.path.parent.parent)
+        for run_path in self._runs:
+            run_path.unlink()
+        self._runs = []
+
+
+def _json_line(item) -> str:
+    return json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+class Manifest:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(len(MAGIC) + 1)
+            if header[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a manifest")
+            self.compressed = bool(header[len(MAGIC)] & FLAG_COMPRESSED)
+            f.seek(-TRAILER_SIZE, os.SEEK_END)
+            trailer = f.read(TRAILER_SIZE)
+            footer_offset = int.from_bytes(trailer[:8], "big")
+            footer_length = int.from_bytes(trailer[8:], "big")
+            f.seek(footer_offset)
+            footer = json.loads(self._unpack(f.read(footer_length)))
+        self.info = footer["info"]
+        self._blocks = footer["blocks"]
+        self._first_paths = [block[0] for block in self._blocks]
+
+    def _unpack(self, data: bytes) -> bytes:
+        return zlib.decompress(data) if self.compressed else data
+
+    def __len__(self) -> int:
+        return sum(block[3] for block in self._blocks)
+
+    def _read_block(self, f, index: int) -> list:
+        _, offset, length, _ = self._blocks[index]
+        f.seek(offset)
+        data = self._unpack(f.read(length)).decode("utf-8")
+        return [json.loads(line) for line in data.splitlines()]
+
+    def items(self, prefix: str = "") -> Iterator[tuple[str, dict]]:
+        # Streams the entries in path order, one block in memory at a time.
+        # Paths with a prefix are next to each other: only their blocks are read.
+        # A plain string prefix: PathFilter keeps docs_old/ out of docs
+        start = max(bisect.bisect_right(self._first_paths, prefix) - 1, 0)
+        with open(self.path, "rb") as f:
+            for index in range(start, len(self._blocks)):
+                for rel_path, entry in self._read_block(f, index):
+                    if rel_path.startswith(prefix):
+                        yield rel_path, entry
+                    elif rel_path > prefix:
+                        return
+
+    def get(self, rel_path: str) -> Optional[dict]:
+        index = bisect.bisect_right(self._first_paths, rel_path) - 1
+        if index < 0:
+            return None
+        with open(self.path, "rb") as f:
+            block = self._read_block(f, index)
+        paths = [item[0] for item in block]
+        pos = bisect.bisect_left(paths, rel_path)
+        if pos < len(block) and paths[pos] == rel_path:
+            return block[pos][1]
+        return None
+
+
+class LegacyManifest:
+    # manifest.json of older versions behind the same interface
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.info = data["info"]
+        self._files = data["files"]
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def items(self, prefix: str = "") -> Iterator[tuple[str, dict]]:
+        return (item for item in self._files.items() if item[0].startswith(prefix))
+
+    def get(self, rel_path: str) -> Optional[dict]:
+        return self._files.get(rel_path)
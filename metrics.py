@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+# Stages of a backup (walk to write) and of a restore (read to verify), in pipeline order
+STAGES = (
+    "walk",
+    "stat",
+    "read",
+    "hash",
+    "exists",
+    "compress",
+    "pad",
+    "encrypt",
+    "write",
+    "sync",
+    "decrypt",
+    "decompress",
+    "verify",
+)
+
+# Counters of one stage: seconds, calls, bytes in, bytes out
+_SECONDS, _CALLS, _BYTES_IN, _BYTES_OUT = range(4)
+
+PROMETHEUS_PREFIX = "smart_backup_stage"
+
+
+class StageMetrics:
+    # Time, call count and bytes in/out of every stage of a run. Each thread adds to
+    # counters of its own, without a lock; snapshot() sums the counters of all threads.
+    # The seconds of a stage are summed over threads, so with several workers they
+    # add up to more than the wall-clock time of the run.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = []
+        self._generation = 0
+
+    def _own(self) -> dict:
+        counters = getattr(self._local, "counters", None)
+        if counters is None or self._local.generation != self._generation:
+            counters = {}
+            with self._lock:
+                self._counters.append(counters)
+                self._local.generation = self._generation
+            self._local.counters = counters
+        return counters
+
+    def add(
+        self,
+        stage: str,
+        seconds: float = 0.0,
+        bytes_in: int = 0,
+        bytes_out: int = 0,
+        calls: int = 1,
+    ):
+        counters = self._own()
+        values = counters.get(stage)
+        if values is None:
+            values = counters[stage] = [0.0, 0, 0, 0]
+        values[_SECONDS] += seconds
+        values[_CALLS] += calls
+        values[_BYTES_IN] += bytes_in
+        values[_BYTES_OUT] += bytes_out
+
+    def reset(self):
+        # Counters of threads still running are dropped on their next add()
+        with self._lock:
+            self._counters = []
+            self._generation += 1
+
+    def snapshot(self) -> dict[str, dict]:
+        totals = {}
+        with self._lock:
+            all_counters = list(self._counters)
+        for counters in all_counters:
+            for stage, values in list(counters.items()):
+                total = totals.setdefault(stage, [0.0, 0, 0, 0])
+                for i, value in enumerate(values):
+                    total[i] += value
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        return {
+            stage: {
+                "seconds": round(values[_SECONDS], 6),
+                "calls": values[_CALLS],
+                "bytes_in": values[_BYTES_IN],
+                "bytes_out": values[_BYTES_OUT],
+            }
+            for stage, values in sorted(
+                totals.items(), key=lambda item: order.get(item[0], len(order))
+            )
+        }
+
+    def bytes_in(self, stage: str) -> int:
+        # A single counter, cheap enough for the progress line
+        with self._lock:
+            all_counters = list(self._counters)
+        return sum(
+            counters[stage][_BYTES_IN] for counters in all_counters if stage in counters
+        )
+
+    def write_json(self, path: Path):
+        _write_atomic(path, json.dumps({"stages": self.snapshot()}, indent=2) + "\n")
+
+    def write_prometheus(self, path: Path):
+        # Text exposition format, for the node_exporter textfile collector
+        snapshot = self.snapshot()
+        lines = []
+        for name, key, help_text in (
+            ("seconds_total", "seconds", "Time spent in the stage, summed over threads"),
+            ("calls_total", "calls", "Number of times the stage ran"),
+            ("bytes_in_total", "bytes_in", "Bytes that went into the stage"),
+            ("bytes_out_total", "bytes_out", "Bytes that came out of the stage"),
+        ):
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for stage, values in snapshot.items():
+                lines.append(f'{metric}{{stage="{stage}"}} {values[key]}')
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path: Path, text: str):
+    # The collector must never read a half-written file
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Counters of the current run, shared by all modules
+METRICS = StageMetrics()
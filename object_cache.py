@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+logger = logging.getLogger(__name__)
+
+# Default size of the local cache of downloaded objects
+CACHE_BYTES = 1024 * 1024 * 1024
+
+
+class ObjectCache:
+    # Objects downloaded from the cloud, kept on local disk under their store hash.
+    # Over max_bytes the least recently used ones are dropped, except pinned objects
+    # that a restore still needs.
+    def __init__(self, cache_dir: Path, max_bytes: int = CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._pins = Counter()
+        self._size = 0
+        self._lock = threading.Lock()
+        if cache_dir.exists():
+            # What earlier runs left, oldest first
+            files = [p for p in cache_dir.iterdir() if len(p.name) == 64]
+            for path in sorted(files, key=lambda p: p.stat().st_mtime_ns):
+                size = path.stat().st_size
+                self._entries[path.name] = size
+                self._size += size
+
+    def get(self, store_hash: str):
+        with self._lock:
+            if store_hash not in self._entries:
+                return None
+            self._entries.move_to_end(store_hash)
+        return self.cache_dir / store_hash
+
+    def add(self, store_hash: str, fill: Callable[[Path], None]) -> Path:
+        # fill writes the object to the given path; it appears in the cache only when complete
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / store_hash
+        tmp_path = self.cache_dir / f"{store_hash}.{os.urandom(4).hex()}.tmp"
+        try:
+            fill(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        with self._lock:
+            if store_hash not in self._entries:
+                self._size += path.stat().st_size
+            self._entries[store_hash] = path.stat().st_size
+            self._evict()
+        return path
+
+    def _evict(self):
+        # Called with the lock held
+        for store_hash in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if self._pins[store_hash]:
+                continue
+            self._size -= self._entries.pop(store_hash)
+            # An object opened by a reader stays readable until it is closed
+            (self.cache_dir / store_hash).unlink(missing_ok=True)
+
+    def pin(self, store_hash: str):
+        with self._lock:
+            self._pins[store_hash] += 1
+
+    def unpin(self, store_hash: str):
+        with self._lock:
+            if self._pins[store_hash] > 1:
+                self._pins[store_hash] -= 1
+            else:
+                del self._pins[store_hash]
+            self._evict()
+
+
+class Prefetcher:
+    # Objects missing from the local store are downloaded ahead of the restore, on a pool
+    # of download workers, into the cache. Every store hash is downloaded once: a second
+    # request waits for the same download, later ones find it in the cache.
+    def __init__(self, store, cloud, cache: ObjectCache, jobs: int = 8):
+        self.store = store
+        self.cloud = cloud
+        self.cache = cache
+        self.downloaded = 0
+        self._pool = ThreadPoolExecutor(max_workers=jobs)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, store_hash: str):
+        # Pinned until release(): the restore of the file that needs it is done
+        if self.store.is_local(store_hash):
+            return
+        self.cache.pin(store_hash)
+        self._fetch(store_hash)
+
+    def release(self, store_hash: str):
+        if not self.store.is_local(store_hash):
+            self.cache.unpin(store_hash)
+
+    def _fetch(self, store_hash: str) -> Future:
+        with self._lock:
+            future = self._inflight.get(store_hash)
+            if future is None:
+                future = self._pool.submit(self._download, store_hash)
+                self._inflight[store_hash] = future
+                future.add_done_callback(lambda _: self._done(store_hash))
+            return future
+
+    def _done(self, store_hash: str):
+        with self._lock:
+            self._inflight.pop(store_hash, None)
+
+    def _download(self, store_hash: str) -> Path:
+        path = self.cache.get(store_hash)
+        if path is not None:
+            return path
+        # An object known to be in a pack is read with a range request from the remote pack
+        location = self.store.pack_location(store_hash)
+        path = self.cache.add(
+            store_hash,
+            lambda dest: self.cloud.fetch_object(store_hash, dest, location),
+        )
+        with self._lock:
+            self.downloaded += 1
+        return path
+
+    def open(self, store_hash: str) -> BinaryIO:
+        try:
+            return self.store.open(store_hash)
+        except FileNotFoundError:
+            pass
+        return open(self._fetch(store_hash).result(), "rb")
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,214 @@
+import os
+from time import perf_counter
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from compressors import Codec, get_codec_by_id
+from crypter import FileCrypter
+from metrics import METRICS
+
+# Streaming object layout (format 2):
+#   header: MAGIC | flags (1 byte) | codec id (1 byte) | object salt (32 bytes, encrypted only)
+#   frames: length (4 bytes, big endian) | payload
+# Every frame except the last one carries exactly FRAME_SIZE bytes of (compressed) data.
+# The last frame carries the tail with padding, so only it reveals the real size.
+# Encrypted frames use a key derived from the object salt (crypter.object_aead),
+# nonce = zeros | frame index | final flag and the header as AAD,
+# so frames cannot be reordered, dropped or cut off at a frame boundary.
+MAGIC = b"SBK2"
+STREAM_FORMAT = 2
+FLAG_COMPRESSED = 1
+FLAG_ENCRYPTED = 2
+OBJECT_SALT_SIZE = 32
+FRAME_SIZE = 1024 * 1024
+READ_BLOCK = 1024 * 1024
+PAD_BLOCK = 256
+
+
+def add_padding(data: bytes, block_size: int = PAD_BLOCK) -> bytes:
+    data_len = len(data).to_bytes(4, byteorder="big")
+    pad_len = block_size - (len(data) + 4) % block_size
+    padding = os.urandom(pad_len)
+    return data_len + data + padding
+
+
+def remove_padding(padded_data: bytes) -> bytes:
+    if len(padded_data) < 4:
+        return padded_data
+    data_len = int.from_bytes(padded_data[:4], byteorder="big")
+    return padded_data[4 : 4 + data_len]
+
+
+def read_blocks(f: BinaryIO, block_size: int = READ_BLOCK) -> Iterator[bytes]:
+    while True:
+        started = perf_counter()
+        block = f.read(block_size)
+        METRICS.add("read", perf_counter() - started, len(block))
+        if not block:
+            return
+        yield block
+
+
+class _Inputs:
+    # The pieces a decoder pulls, with the bytes and the time it took to produce them
+    def __init__(self, pieces: Iterable[bytes]):
+        self._pieces = iter(pieces)
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        started = perf_counter()
+        try:
+            piece = next(self._pieces)
+        finally:
+            self.seconds += perf_counter() - started
+        self.bytes += len(piece)
+        return piece
+
+
+def _timed(stage: str, pieces: Iterable[bytes], inputs: _Inputs) -> Iterator[bytes]:
+    # Times a decoder step by step: neither what the consumer does between steps nor
+    # reading and decrypting its input is counted
+    pieces = iter(pieces)
+    seconds, bytes_out = 0.0, 0
+    while True:
+        started = perf_counter()
+        piece = next(pieces, None)
+        seconds += perf_counter() - started
+        if piece is None:
+            break
+        bytes_out += len(piece)
+        yield piece
+    METRICS.add(stage, seconds - inputs.seconds, inputs.bytes, bytes_out)
+
+
+def _nonce(index: int, final: bool) -> bytes:
+    return bytes(7) + index.to_bytes(4, byteorder="big") + (b"\x01" if final else b"\x00")
+
+
+def encode_stream(
+    blocks: Iterable[bytes],
+    codec: Optional[Codec],
+    crypter: Optional[FileCrypter] = None,
+    level: Optional[int] = None,
+) -> Iterator[bytes]:
+    flags = FLAG_COMPRESSED if codec else 0
+    if crypter:
+        flags |= FLAG_ENCRYPTED
+    header = MAGIC + bytes([flags, codec.id if codec else 0])
+    aead = None
+    if crypter:
+        object_salt = os.urandom(OBJECT_SALT_SIZE)
+        aead = crypter.object_aead(object_salt)
+        header += object_salt
+    yield header
+
+    def frame(payload: bytes, index: int, final: bool) -> bytes:
+        if aead:
+            started = perf_counter()
+            size = len(payload)
+            payload = aead.encrypt(_nonce(index, final), payload, header)
+            METRICS.add("encrypt", perf_counter() - started, size, len(payload))
+        return len(payload).to_bytes(4, byteorder="big") + payload
+
+    def compress(block: bytes) -> bytes:
+        started = perf_counter()
+        out = compressor.compress(block)
+        METRICS.add("compress", perf_counter() - started, len(block), len(out))
+        return out
+
+    compressor = codec.encoder(level) if codec else None
+    buffer = bytearray()
+    index = 0
+    for block in blocks:
+        buffer += compress(block) if compressor else block
+        # Whatever is left over always goes into the final, padded frame
+        while len(buffer) > FRAME_SIZE:
+            yield frame(bytes(buffer[:FRAME_SIZE]), index, False)
+            del buffer[:FRAME_SIZE]
+            index += 1
+
+    if compressor:
+        started = perf_counter()
+        tail = compressor.flush()
+        METRICS.add("compress", perf_counter() - started, 0, len(tail))
+        buffer += tail
+    while len(buffer) > FRAME_SIZE:
+        yield frame(bytes(buffer[:FRAME_SIZE]), index, False)
+        del buffer[:FRAME_SIZE]
+        index += 1
+
+    started = perf_counter()
+    padded = add_padding(bytes(buffer))
+    METRICS.add("pad", perf_counter() - started, len(buffer), len(padded))
+    yield frame(padded, index, True)
+
+
+def _read_frame(f: BinaryIO) -> Optional[bytes]:
+    started = perf_counter()
+    size_bytes = f.read(4)
+    if not size_bytes:
+        return None
+    if len(size_bytes) < 4:
+        raise ValueError("Truncated frame header")
+    size = int.from_bytes(size_bytes, byteorder="big")
+    payload = f.read(size)
+    if len(payload) != size:
+        raise ValueError("Truncated frame")
+    METRICS.add("read", perf_counter() - started, 4 + size)
+    return payload
+
+
+def decode_stream(
+    f: BinaryIO,
+    crypter: Optional[FileCrypter] = None,
+    decompress: bool = True,
+) -> Iterator[bytes]:
+    # Without a crypter an encrypted object is passed through as it is stored
+    header = f.read(len(MAGIC) + 2)
+    if header[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a stream object")
+    flags, codec = header[len(MAGIC)], header[len(MAGIC) + 1]
+    encrypted = bool(flags & FLAG_ENCRYPTED)
+    compressed = bool(flags & FLAG_COMPRESSED)
+    if encrypted:
+        object_salt = f.read(OBJECT_SALT_SIZE)
+        header += object_salt
+
+    if encrypted and crypter is None:
+        yield header
+        yield from read_blocks(f)
+        return
+    aead = crypter.object_aead(object_salt) if encrypted else None
+
+    decompressor = get_codec_by_id(codec).decoder() if compressed and decompress else None
+
+    def payloads() -> Iterator[bytes]:
+        index = 0
+        payload = _read_frame(f)
+        if payload is None:
+            raise ValueError("Stream object has no frames")
+        while payload is not None:
+            # One frame look-ahead: the last frame in the file is the final one
+            next_payload = _read_frame(f)
+            final = next_payload is None
+            if encrypted:
+                started = perf_counter()
+                size = len(payload)
+                payload = aead.decrypt(_nonce(index, final), payload, header)
+                METRICS.add("decrypt", perf_counter() - started, size, len(payload))
+            if final:
+                payload = remove_padding(payload)
+            if payload:
+                yield payload
+            payload = next_payload
+            index += 1
+
+    if decompressor is None:
+        yield from payloads()
+        return
+    # The decoder pulls the frames it needs, its output comes in bounded pieces
+    inputs = _Inputs(payloads())
+    yield from _timed("decompress", decompressor.decode(inputs), inputs)
@@ -0,0 +1,485 @@
+import io
+import logging
+import os
+import threading
+from itertools import chain
+from pathlib import Path
+from time import perf_counter
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from durability import DEFAULT_DURABILITY, DURABILITY_LEVELS, fsync_dir, fsync_file
+from metrics import METRICS
+from utils import pread
+
+logger = logging.getLogger(__name__)
+
+# Objects smaller than this (as stored: compressed, padded, encrypted) go into pack files
+PACK_THRESHOLD = 64 * 1024
+# A new pack file is started once the current one is larger than this
+PACK_MAX_SIZE = 256 * 1024 * 1024
+
+# Pack index record: store hash (32 bytes) | offset (8 bytes) | length (4 bytes)
+INDEX_RECORD_SIZE = 44
+
+# Object index: a header, then the store hashes (32 bytes each) of all stored objects
+OBJECT_INDEX_NAME = "index.bin"
+OBJECT_INDEX_HEADER = b"SBKIDX1\n"
+# New index records are appended in batches of this size
+INDEX_BATCH_SIZE = 1000
+# A counter raised whenever objects are deleted: a store loaded before that reloads
+GENERATION_NAME = "generation"
+
+
+class ObjectStore:
+    # Content-addressed storage of objects under their store hash.
+    # Large objects are loose files: objects/<2 hex>/<hash>.
+    # In packed mode small objects are appended to objects/packs/pack-<id>.pack,
+    # and pack-<id>.idx maps every store hash to its place in the pack.
+    # objects/index.bin lists every stored object, so "do we have it?" is answered
+    # from memory instead of a stat per object.
+    # An object is listed in index.bin or a pack index only once it is as durable as
+    # the durability level asks (see durability.py)
+    def __init__(
+        self, objects_path: Path, packed: bool = False, durability: str = DEFAULT_DURABILITY
+    ):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level {durability}")
+        self.objects_path = objects_path
+        self.durability = durability
+        self.packs_path = objects_path / "packs"
+        # Objects being written before their name is known
+        self.tmp_path = objects_path / "tmp"
+        self.packed = packed
+        self._pack_index = {}
+        self._lock = threading.Lock()
+        self._pack_name = None
+        self._pack_file = None
+        self._index_file = None
+        self._pack_size = 0
+        self._read_fds = {}
+        self.index_path = objects_path / OBJECT_INDEX_NAME
+        self._index = set()
+        self._index_pending = []
+        # Batch durability: loose objects renamed into place and pack index records
+        # written since the last sync
+        self._unsynced = []
+        self._pack_records = []
+        # Directories that got the files of a new pack and were not synced yet
+        self._unsynced_dirs = []
+        self.generation_path = objects_path / GENERATION_NAME
+        self._generation = self._read_generation()
+        self._load_pack_indexes()
+        self._load_index()
+
+    def _read_generation(self) -> int:
+        try:
+            return int(self.generation_path.read_text())
+        except (OSError, ValueError):
+            return 0
+
+    def refresh(self):
+        # Another process (a prune) may have deleted objects since the indexes were read,
+        # a long-running writer would then skip objects that are gone. Reads them again,
+        # and drops the current pack: it may have been repacked and deleted
+        generation = self._read_generation()
+        if generation == self._generation:
+            return
+        logger.info("Objects were deleted by another process, reloading the object index")
+        self._generation = generation
+        self.reload()
+
+    def _load_pack_indexes(self):
+        # Packs are readable even when new objects are written loose
+        if not self.packs_path.exists():
+            return
+        for idx_path in sorted(self.packs_path.glob("pack-*.idx")):
+            pack_name = idx_path.stem
+            data = idx_path.read_bytes()
+            # A record cut by a crash is ignored, its object is simply written again
+            usable = len(data) - len(data) % INDEX_RECORD_SIZE
+            for pos in range(0, usable, INDEX_RECORD_SIZE):
+                record = data[pos : pos + INDEX_RECORD_SIZE]
+                self._pack_index[record[:32].hex()] = (
+                    pack_name,
+                    int.from_bytes(record[32:40], "big"),
+                    int.from_bytes(record[40:44], "big"),
+                )
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+
+        if data is None or not data.startswith(OBJECT_INDEX_HEADER):
+            logger.info("The object index is missing or damaged, rebuilding it")
+            self.rebuild_index()
+            return
+
+        body = memoryview(data)[len(OBJECT_INDEX_HEADER) :]
+        # A record cut by a crash is dropped, the object is written again if needed
+        usable = len(body) - len(body) % 32
+        self._index = {bytes(body[pos : pos + 32]) for pos in range(0, usable, 32)}
+        self._index.update(bytes.fromhex(h) for h in self._pack_index)
+
+    def reload(self):
+        # Reads the indexes again, with the objects other processes wrote since.
+        # The current pack is closed: the next object starts a new one
+        with self._lock:
+            self._flush_index()
+            self._close_pack()
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
+            self._pack_index = {}
+        self._load_pack_indexes()
+        self._load_index()
+
+    def rebuild_index(self):
+        # Everything under objects/: loose files and the pack indexes
+        index = {bytes.fromhex(h) for h in self._pack_index}
+        if self.objects_path.exists():
+            for sub_dir in self.objects_path.iterdir():
+                if len(sub_dir.name) != 2 or not sub_dir.is_dir():
+                    continue
+                for obj_path in sub_dir.iterdir():
+                    if len(obj_path.name) == 64:
+                        index.add(bytes.fromhex(obj_path.name))
+
+        with self._lock:
+            self._index = index
+            self._index_pending.clear()
+            self._save_index()
+
+    def _save_index(self):
+        # Called with the lock held: the whole index, written to a temporary file and renamed
+        if not self.objects_path.exists():
+            return
+        tmp_path = self.index_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(OBJECT_INDEX_HEADER)
+                f.write(b"".join(self._index))
+                if self.durability != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+            if self.durability != "none":
+                fsync_dir(self.objects_path)
+        except OSError as e:
+            # Read-only storage: the index is kept in memory only
+            logger.warning(f"The object index cannot be saved: {e}")
+
+    def _add_to_index(self, store_hash: str):
+        digest = bytes.fromhex(store_hash)
+        with self._lock:
+            self._index.add(digest)
+            self._index_pending.append(digest)
+            # Strict durability: every record is on disk with its object, like pack records
+            if len(self._index_pending) >= INDEX_BATCH_SIZE or self.durability == "strict":
+                self._flush_index()
+
+    def _flush_index(self):
+        # Called with the lock held. Records are only added after their objects are written,
+        # and synced at every batch: an object missing from the index is stored again
+        self._sync()
+        if not self._index_pending:
+            return
+        with open(self.index_path, "ab") as f:
+            new_file = f.tell() == 0
+            if new_file:
+                f.write(OBJECT_INDEX_HEADER)
+            f.write(b"".join(self._index_pending))
+            if self.durability != "none":
+                started = perf_counter()
+                f.flush()
+                os.fsync(f.fileno())
+                if new_file:
+                    fsync_dir(self.objects_path)
+                METRICS.add("sync", perf_counter() - started)
+        self._index_pending.clear()
+
+    def flush(self):
+        with self._lock:
+            self._flush_index()
+
+    def _sync(self, force: bool = False):
+        # Called with the lock held. Batch durability: the loose objects written since the
+        # last sync and then their directories, each once, then the pack data before the
+        # pack index records that point into it. force syncs at any durability level
+        sync = force or self.durability == "batch"
+        started = perf_counter()
+        if sync:
+            for obj_path in self._unsynced:
+                fsync_file(obj_path)
+            if self._unsynced:
+                # objects/ too: it holds the names of new subdirectories
+                for dir_path in {obj_path.parent for obj_path in self._unsynced}:
+                    fsync_dir(dir_path)
+                fsync_dir(self.objects_path)
+            if self._pack_file:
+                os.fsync(self._pack_file.fileno())
+            self._sync_pack_dirs()
+        self._unsynced.clear()
+        if self._pack_records:
+            self._index_file.write(b"".join(self._pack_records))
+            self._index_file.flush()
+            self._pack_records.clear()
+        if sync and self._index_file:
+            os.fsync(self._index_file.fileno())
+        if sync:
+            METRICS.add("sync", perf_counter() - started)
+
+    def loose_hashes(self) -> Iterator[bytes]:
+        # Store hashes of the objects that are files of their own, not in a pack
+        with self._lock:
+            index = list(self._index)
+        packed = self._pack_index
+        for digest in index:
+            if digest.hex() not in packed:
+                yield digest
+
+    def loose_objects(self) -> Iterator[tuple[bytes, int, int]]:
+        # (store hash, size, mtime_ns) of every loose object file, from the directory listing
+        if not self.objects_path.exists():
+            return
+        with os.scandir(self.objects_path) as it:
+            sub_dirs = sorted(e.path for e in it if len(e.name) == 2 and e.is_dir())
+        for sub_dir in sub_dirs:
+            with os.scandir(sub_dir) as it:
+                for entry in it:
+                    if len(entry.name) == 64:
+                        st = entry.stat()
+                        yield bytes.fromhex(entry.name), st.st_size, st.st_mtime_ns
+
+    def pack_contents(self) -> dict[str, list[tuple[bytes, int]]]:
+        # (store hash, length) of the objects of every pack but the one being written
+        with self._lock:
+            records = list(self._pack_index.items())
+            current = self._pack_name
+        packs = {}
+        for store_hash, (pack_name, _, length) in records:
+            if pack_name != current:
+                packs.setdefault(pack_name, []).append((bytes.fromhex(store_hash), length))
+        return packs
+
+    def remove(self, digests: set[bytes], packs: Iterable[str] = ()):
+        # Deletes loose objects and whole packs, then writes the object index without them
+        packs = set(packs)
+        gone = set(digests)
+        with self._lock:
+            # Raised first: after a crash in the middle other stores still reload
+            self._generation = self._read_generation() + 1
+            tmp_path = self.generation_path.with_suffix(".tmp")
+            tmp_path.write_text(str(self._generation))
+            os.replace(tmp_path, self.generation_path)
+            for pack_name in packs:
+                fd = self._read_fds.pop(pack_name, None)
+                if fd is not None:
+                    os.close(fd)
+            for store_hash, location in list(self._pack_index.items()):
+                if location[0] in packs:
+                    del self._pack_index[store_hash]
+                    gone.add(bytes.fromhex(store_hash))
+        for pack_name in packs:
+            # The index goes first: an index never points into a missing pack
+            (self.packs_path / f"{pack_name}.idx").unlink(missing_ok=True)
+            (self.packs_path / f"{pack_name}.pack").unlink(missing_ok=True)
+        for digest in digests:
+            self.loose_path(digest.hex()).unlink(missing_ok=True)
+        with self._lock:
+            self._flush_index()
+            self._index -= gone
+            self._save_index()
+
+    def repack(self, pack_name: str, keep: set[bytes]):
+        # The objects of a pack that are in keep are copied to the current pack,
+        # then the old pack is removed
+        with self._lock:
+            records = [
+                (store_hash, location)
+                for store_hash, location in self._pack_index.items()
+                if location[0] == pack_name
+            ]
+        fd = self._get_read_fd(pack_name)
+        for store_hash, (_, offset, length) in records:
+            if bytes.fromhex(store_hash) not in keep:
+                continue
+            data = pread(fd, length, offset)
+            if len(data) != length:
+                raise ValueError(f"Pack {pack_name} is truncated")
+            self._append_to_pack(store_hash, data)
+        with self._lock:
+            # The copies are on disk before the originals go away
+            self._sync(force=True)
+        self.remove(set(), [pack_name])
+
+    def pack_names(self) -> list[str]:
+        if not self.packs_path.exists():
+            return []
+        return sorted(idx_path.stem for idx_path in self.packs_path.glob("pack-*.idx"))
+
+    def loose_path(self, store_hash: str) -> Path:
+        return self.objects_path / store_hash[:2] / store_hash
+
+    def exists(self, store_hash: str) -> bool:
+        return bytes.fromhex(store_hash) in self._index
+
+    def pack_location(self, store_hash: str) -> Optional[tuple[str, int, int]]:
+        # (pack name, offset, length), or None for a loose object
+        return self._pack_index.get(store_hash)
+
+    def is_local(self, store_hash: str) -> bool:
+        # The object can be read here: the index may list objects whose files are gone
+        location = self._pack_index.get(store_hash)
+        if location is None:
+            return self.loose_path(store_hash).exists()
+        return (self.packs_path / f"{location[0]}.pack").exists()
+
+    def open(self, store_hash: str) -> BinaryIO:
+        location = self._pack_index.get(store_hash)
+        if location is None:
+            return open(self.loose_path(store_hash), "rb")
+        pack_name, offset, length = location
+        # pread does not move a shared file position, so workers can read one pack at once
+        data = pread(self._get_read_fd(pack_name), length, offset)
+        if len(data) != length:
+            raise ValueError(f"Pack {pack_name} is truncated")
+        return io.BytesIO(data)
+
+    def _get_read_fd(self, pack_name: str) -> int:
+        with self._lock:
+            fd = self._read_fds.get(pack_name)
+            if fd is None:
+                fd = os.open(self.packs_path / f"{pack_name}.pack", os.O_RDONLY)
+                self._read_fds[pack_name] = fd
+            return fd
+
+    def write(self, store_hash: str, pieces: Iterable[bytes]):
+        self.commit_spool(store_hash, self.spool(pieces))
+
+    def spool(self, pieces: Iterable[bytes]) -> tuple[Optional[bytes], Optional[Path]]:
+        # Writes an object whose name may not be known yet (its hash is computed on the
+        # way). Returns (data, None) for a small object in packed mode, kept in memory,
+        # and (None, temporary file) otherwise. Finish with commit_spool or discard_spool
+        buffer = bytearray()
+        pieces = iter(pieces)
+        if self.packed:
+            for piece in pieces:
+                buffer += piece
+                if len(buffer) > PACK_THRESHOLD:
+                    break
+            else:
+                return bytes(buffer), None
+
+        self.tmp_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.tmp_path / f"{os.urandom(8).hex()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f_out:
+                # Only the writes are timed, the pieces are encoded on the way
+                for piece in chain([buffer], pieces):
+                    started = perf_counter()
+                    f_out.write(piece)
+                    METRICS.add("write", perf_counter() - started, len(piece))
+                if self.durability == "strict":
+                    started = perf_counter()
+                    f_out.flush()
+                    os.fsync(f_out.fileno())
+                    METRICS.add("sync", perf_counter() - started)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        return None, tmp_path
+
+    def commit_spool(self, store_hash: str, spooled: tuple):
+        data, tmp_path = spooled
+        if tmp_path is None:
+            self._append_to_pack(store_hash, data)
+        else:
+            # A loose object appears under its name only when it is complete
+            obj_path = self.loose_path(store_hash)
+            new_dir = not obj_path.parent.exists()
+            obj_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, obj_path)
+            if self.durability == "strict":
+                started = perf_counter()
+                fsync_dir(obj_path.parent)
+                if new_dir:
+                    fsync_dir(self.objects_path)
+                METRICS.add("sync", perf_counter() - started)
+            elif self.durability == "batch":
+                with self._lock:
+                    self._unsynced.append(obj_path)
+        self._add_to_index(store_hash)
+
+    def discard_spool(self, spooled: tuple):
+        if spooled[1] is not None:
+            spooled[1].unlink(missing_ok=True)
+
+    def _append_to_pack(self, store_hash: str, data: bytes):
+        started = perf_counter()
+        with self._lock:
+            if self._pack_file is None or self._pack_size > PACK_MAX_SIZE:
+                # Pending records of the old pack go to its index first
+                self._sync()
+                self._open_new_pack()
+            offset = self._pack_size
+            self._pack_file.write(data)
+            self._pack_file.flush()
+            self._pack_size += len(data)
+            if self.durability == "strict":
+                os.fsync(self._pack_file.fileno())
+            # The index record goes after the data, so it never points past the pack end
+            record = (
+                bytes.fromhex(store_hash)
+                + offset.to_bytes(8, "big")
+                + len(data).to_bytes(4, "big")
+            )
+            if self.durability == "batch":
+                # Written with the next sync, after the pack data is on disk
+                self._pack_records.append(record)
+            else:
+                self._index_file.write(record)
+                self._index_file.flush()
+                if self.durability == "strict":
+                    os.fsync(self._index_file.fileno())
+            self._pack_index[store_hash] = (self._pack_name, offset, len(data))
+        METRICS.add("write", perf_counter() - started, len(data))
+
+    def _open_new_pack(self):
+        self._close_pack()
+        new_dir = not self.packs_path.exists()
+        self.packs_path.mkdir(parents=True, exist_ok=True)
+        self._pack_name = f"pack-{os.urandom(8).hex()}"
+        self._pack_file = open(self.packs_path / f"{self._pack_name}.pack", "ab")
+        self._index_file = open(self.packs_path / f"{self._pack_name}.idx", "ab")
+        self._pack_size = 0
+        logger.debug(f"New pack file {self._pack_name}")
+        # The names of the new files (and of packs/ itself, in objects/) are durable
+        # before any index record or manifest refers to the pack
+        self._unsynced_dirs = [self.packs_path, self.objects_path] if new_dir else [self.packs_path]
+        if self.durability != "none":
+            started = perf_counter()
+            self._sync_pack_dirs()
+            METRICS.add("sync", perf_counter() - started)
+
+    def _sync_pack_dirs(self):
+        for dir_path in self._unsynced_dirs:
+            fsync_dir(dir_path)
+        self._unsynced_dirs = []
+
+    def _close_pack(self):
+        if self._pack_file:
+            self._pack_file.close()
+            self._index_file.close()
+        self._pack_file = None
+        self._index_file = None
+
+    def close(self):
+        with self._lock:
+            self._flush_index()
+            self._close_pack()
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
@@ -0,0 +1,193 @@
+import logging
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from classes import PruneReport, RetentionPolicy
+from manager import BackupManager, get_entry_store_hashes
+from manifest import manifest_exists, open_manifest
+from utils import in_order
+
+logger = logging.getLogger(__name__)
+
+# Objects and packs written less than this many seconds ago are never removed:
+# a backup running at the same time may not have written its manifest yet
+PRUNE_GRACE = 3600
+# A pack is rewritten without its dead objects once they take this share of it
+REPACK_RATIO = 0.5
+# How many manifests each marking worker may have queued
+PENDING_PER_JOB = 2
+
+
+def _bucket(v_name: str, weekly: bool):
+    # Version names are timestamps (YYYY-mm-dd_HH-MM-SS); any other name is its own bucket
+    try:
+        day = datetime.strptime(v_name[:10], "%Y-%m-%d")
+    except ValueError:
+        return v_name
+    return day.isocalendar()[:2] if weekly else day.date()
+
+
+def select_versions(v_names: list[str], policy: RetentionPolicy) -> set[str]:
+    # The versions the policy keeps: the newest N, the newest of each of the last
+    # D days and of each of the last W weeks. A policy with no rules keeps everything
+    if not (policy.keep_last or policy.keep_daily or policy.keep_weekly):
+        return set(v_names)
+    newest = sorted(v_names, reverse=True)
+    keep = set(newest[: max(1, policy.keep_last)])
+    for count, weekly in ((policy.keep_daily, False), (policy.keep_weekly, True)):
+        buckets = set()
+        for v_name in newest:
+            if len(buckets) >= count:
+                break
+            bucket = _bucket(v_name, weekly)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(v_name)
+    return keep
+
+
+def _list_versions(backup_base: Path) -> dict[str, list[str]]:
+    # Read from disk, not from the catalog: a version missing from the catalog
+    # still keeps its objects alive
+    projects = {}
+    for p_dir in sorted(backup_base.iterdir()):
+        if not p_dir.is_dir() or p_dir.name == "objects":
+            continue
+        versions = [v_dir.name for v_dir in p_dir.iterdir() if manifest_exists(v_dir)]
+        if versions:
+            projects[p_dir.name] = sorted(versions)
+    return projects
+
+
+def _mark_version(version_dir: str) -> bytes:
+    # Store hashes of every object of one version, as concatenated 32-byte digests.
+    # Runs in a worker process: manifest parsing and hashing are CPU-bound
+    manifest = open_manifest(Path(version_dir))
+    salt_hex = manifest.info.get("salt")
+    digests = set()
+    for _, info in manifest.items():
+        for store_hash in get_entry_store_hashes(info, salt_hex):
+            digests.add(bytes.fromhex(store_hash))
+    return b"".join(digests)
+
+
+def mark_live(version_dirs: list[Path], jobs: int = 1) -> set[bytes]:
+    # Live objects as a set of binary digests (not hex strings), filled one manifest at
+    # a time. A manifest that cannot be read stops the prune: its objects are unknown
+    live = set()
+
+    def merge(digests: bytes):
+        live.update(digests[pos : pos + 32] for pos in range(0, len(digests), 32))
+
+    if jobs <= 1 or len(version_dirs) <= 1:
+        for v_dir in version_dirs:
+            merge(_mark_version(str(v_dir)))
+        return live
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        submitted = ((pool.submit(_mark_version, str(v_dir)),) for v_dir in version_dirs)
+        for (task,) in in_order(submitted, jobs, PENDING_PER_JOB):
+            merge(task.result())
+    return live
+
+
+def prune(
+    manager: BackupManager,
+    policy: RetentionPolicy,
+    project_name: Optional[str] = None,
+    dry_run: bool = False,
+    jobs: int = 1,
+    grace: float = PRUNE_GRACE,
+) -> PruneReport:
+    # Removes the versions the policy does not keep (of one project or of all), then
+    # every object no remaining version refers to. Versions go first: a crash in
+    # between only leaves unreferenced objects, collected by the next prune.
+    # It holds the store lock exclusively, so it waits for running backups and they
+    # wait for it: a backup that finds an old object and skips writing it is not
+    # protected by the grace period. A dry run only reads and shares the lock
+    with manager.store_lock(shared=dry_run):
+        manager.store.refresh()
+        return _prune(manager, policy, project_name, dry_run, jobs, grace)
+
+
+def _prune(
+    manager: BackupManager,
+    policy: RetentionPolicy,
+    project_name: Optional[str],
+    dry_run: bool,
+    jobs: int,
+    grace: float,
+) -> PruneReport:
+    report = PruneReport(dry_run=dry_run)
+    backup_base = manager.backup_base
+    store = manager.store
+    store.flush()
+
+    remaining = []
+    for p_name, v_names in _list_versions(backup_base).items():
+        keep = (
+            select_versions(v_names, policy)
+            if project_name in (None, p_name)
+            else set(v_names)
+        )
+        for v_name in v_names:
+            if v_name in keep:
+                remaining.append(backup_base / p_name / v_name)
+            else:
+                report.removed_versions.append(f"{p_name}/{v_name}")
+    report.kept_versions = len(remaining)
+
+    started = time.monotonic()
+    live = mark_live(remaining, jobs)
+    report.live_objects = len(live)
+    logger.info(
+        f"{len(live)} live objects in {len(remaining)} versions "
+        f"({time.monotonic() - started:.1f}s)"
+    )
+
+    if not dry_run:
+        for name in report.removed_versions:
+            p_name, v_name = name.split("/")
+            manager.catalog.remove(p_name, v_name)
+            shutil.rmtree(backup_base / p_name / v_name)
+
+    cutoff_ns = time.time_ns() - int(grace * 1e9)
+    dead = set()
+    for digest, size, mtime_ns in store.loose_objects():
+        if digest not in live and mtime_ns < cutoff_ns:
+            dead.add(digest)
+            report.reclaimable_bytes += size
+    report.dead_objects = len(dead)
+
+    drop, rewrite = [], []
+    for pack_name, objects in store.pack_contents().items():
+        try:
+            pack_stat = (store.packs_path / f"{pack_name}.pack").stat()
+        except FileNotFoundError:
+            # Only its index is here (the pack itself is in the cloud)
+            continue
+        if pack_stat.st_mtime_ns >= cutoff_ns:
+            continue
+        dead_objects = [length for digest, length in objects if digest not in live]
+        if len(dead_objects) == len(objects):
+            drop.append(pack_name)
+            report.reclaimable_bytes += pack_stat.st_size
+        elif sum(dead_objects) >= REPACK_RATIO * pack_stat.st_size:
+            rewrite.append(pack_name)
+            report.reclaimable_bytes += sum(dead_objects)
+        else:
+            continue
+        report.dead_objects += len(dead_objects)
+    report.removed_packs = len(drop)
+    report.repacked_packs = len(rewrite)
+
+    if not dry_run:
+        for pack_name in rewrite:
+            store.repack(pack_name, live)
+        store.remove(dead, drop)
+    return report
+
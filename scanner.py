@@ -1,70 +1,215 @@
-from pathlib import Path
-from classes import ScanResult, ProgressEvent
-from typing import Optional, Callable
-from hasher import get_file_hash
-import logging
-
-IGNORE_DIRS = {
-    "__pycache__",
-    ".git",
-    ".idea",
-    "node_modules",
-    "Cache",
-    "Temp",
-}
-
-IGNORE_EXTENSIONS = {".tmp", ".log", ".bak", ".swp"}
-
-logger = logging.getLogger(__name__)
-
-
-def scan_files(
-    folder_path: Path,
-    progress_callback: Optional[Callable[[ProgressEvent], None]] = None,
-) -> ScanResult:
-
-    files = []
-    total_size = 0
-    file_data_map = {}
-
-    if not folder_path.exists() or not folder_path.is_dir():
-        logger.error(f"The directory {folder_path} is not found or not is dir.")
-        raise ValueError("Invalid directory path")
-
-    for root, dirs, filenames in folder_path.walk():
-        dirs[:] = [dir for dir in dirs if dir not in IGNORE_DIRS]
-        for name in filenames:
-            path = root / name
-
-            if path.suffix.lower() in IGNORE_EXTENSIONS:
-                continue
-
-            try:
-                file_stat = path.stat()
-                file_hash = get_file_hash(path)
-                if file_hash:
-                    files.append(path)
-                    total_size += file_stat.st_size
-                    file_data_map[path] = file_hash
-
-                if progress_callback:
-                    progress_callback(
-                        ProgressEvent(processed=len(files), current_file=path.name)
-                    )
-
-            except (PermissionError, OSError) as e:
-                logger.warning(f"Skip file {path}: {e}")
-                continue
-
-    result = ScanResult(
-        files=files,
-        total_files=len(files),
-        total_size=total_size,
-        file_hashes=file_data_map,
-    )
-
-    print()
-    logger.info(
-        f"Scanning files is completed, total files: {len(files)} / volume: {total_size / (1024**2):.2f} Mb"
-    )
-    return result
+import os
+import stat
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from classes import ScanResult, ScanRecord, ProgressEvent
+from typing import Optional, Callable, Iterator
+from hasher import get_file_hash
+from ignore_rules import IgnoreRules, default_rules
+from stat_cache import StatCache
+from metrics import METRICS
+from utils import in_order
+from time import perf_counter
+import logging
+
+# How many files each hashing worker may have queued ahead of the walk
+PENDING_PER_WORKER = 16
+# How many directories each walking worker may list ahead of the walk
+PREFETCH_PER_WORKER = 4
+
+logger = logging.getLogger(__name__)
+
+
+def _list_dir(
+    folder_path: Path, rel_dir: str, rules: IgnoreRules
+) -> tuple[list[tuple[str, os.stat_result]], list[str]]:
+    # One directory: its files with their stat and its subdirectories, sorted by name.
+    # Ignored entries are dropped before any stat, ignored directories are never entered
+    files, subdirs = [], []
+    started = perf_counter()
+    try:
+        with os.scandir(folder_path / rel_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        logger.warning(f"Skip directory {folder_path / rel_dir}: {e}")
+        return files, subdirs
+    METRICS.add("walk", perf_counter() - started)
+
+    for entry in entries:
+        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+        try:
+            # The type comes from the directory listing, no stat is needed for it
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if rules.is_ignored(rel_path, is_dir):
+                continue
+            if is_dir:
+                subdirs.append(rel_path)
+                continue
+            started = perf_counter()
+            file_stat = entry.stat()
+            METRICS.add("stat", perf_counter() - started)
+        except OSError as e:
+            logger.warning(f"Skip file {entry.path}: {e}")
+            continue
+        # Sockets, pipes and links to directories have no content to back up
+        if stat.S_ISREG(file_stat.st_mode):
+            files.append((rel_path, file_stat))
+    return files, subdirs
+
+
+def walk_files(
+    folder_path: Path,
+    rules: Optional[IgnoreRules] = None,
+    workers: int = 1,
+    start: str = "",
+) -> Iterator[tuple[str, os.stat_result]]:
+    # (relative path, stat) of every file, depth first: the files of a directory in
+    # name order, then its subdirectories in name order. With workers > 1 the next
+    # directories of the walk are listed ahead on a thread pool, so independent
+    # subtrees are read in parallel while the order stays the same.
+    # start walks only one subdirectory, paths stay relative to folder_path
+    rules = rules or default_rules()
+    prefetch = max(1, workers) * PREFETCH_PER_WORKER
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    # Directories still to walk, the next one last: [relative path, listing future]
+    stack = [[start, None]]
+    try:
+        while stack:
+            if pool:
+                for item in stack[-prefetch:]:
+                    if item[1] is None:
+                        item[1] = pool.submit(_list_dir, folder_path, item[0], rules)
+            rel_dir, listing = stack.pop()
+            if listing:
+                files, subdirs = listing.result()
+            else:
+                files, subdirs = _list_dir(folder_path, rel_dir, rules)
+            yield from files
+            stack.extend([rel_path, None] for rel_path in reversed(subdirs))
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+
+def iter_scan(
+    folder_path: Path,
+    stat_cache: Optional[StatCache] = None,
+    paranoid: bool = False,
+    workers: int = 1,
+    defer_hashing: bool = False,
+    rules: Optional[IgnoreRules] = None,
+) -> Iterator[ScanRecord]:
+    # Yields one record per file in walk order, as soon as its hash is known.
+    # Nothing is kept for the whole tree, so memory does not grow with the file count.
+    # With defer_hashing, files not found in the stat cache are not read here:
+    # their records have no hash and keep the stat, create_backup hashes them while storing
+
+    if not folder_path.exists() or not folder_path.is_dir():
+        logger.error(f"The directory {folder_path} is not found or not is dir.")
+        raise ValueError("Invalid directory path")
+
+    def collect(item) -> Optional[ScanRecord]:
+        rel_path, file_stat, file_hash = item
+        if isinstance(file_hash, Future):
+            file_hash = file_hash.result()
+            if file_hash and stat_cache:
+                stat_cache.update(rel_path, file_stat, file_hash)
+            if not file_hash:
+                # The file could not be read
+                return None
+        return ScanRecord(
+            rel_path=rel_path,
+            size=file_stat.st_size,
+            mtime_ns=file_stat.st_mtime_ns,
+            hash=file_hash,
+            stat=None if file_hash else file_stat,
+        )
+
+    # Hashing goes to this pool, walk_files lists directories ahead on its own
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def submit_all():
+        # (rel_path, stat, hash or future) in walk order
+        for rel_path, file_stat in walk_files(folder_path, rules, workers):
+            path = folder_path / rel_path
+            file_hash = None
+
+            # The cached hash is reused only if size, mtime, inode and ctime match
+            if stat_cache and not paranoid:
+                file_hash = stat_cache.lookup(rel_path, file_stat)
+
+            if not file_hash and not defer_hashing:
+                if pool:
+                    file_hash = pool.submit(get_file_hash, path)
+                else:
+                    file_hash = get_file_hash(path)
+                    if not file_hash:
+                        continue
+                    if stat_cache:
+                        stat_cache.update(rel_path, file_stat, file_hash)
+
+            yield rel_path, file_stat, file_hash
+
+    try:
+        # Results are taken strictly in walk order, so the order is deterministic
+        for item in in_order(submit_all(), workers, PENDING_PER_WORKER):
+            record = collect(item)
+            if record:
+                yield record
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    if stat_cache and not paranoid:
+        logger.info(
+            f"Stat cache: {stat_cache.hits} unchanged files, {stat_cache.misses} "
+            + ("to hash while storing" if defer_hashing else "hashed")
+        )
+
+
+def scan_files(
+    folder_path: Path,
+    progress_callback: Optional[Callable[[ProgressEvent], None]] = None,
+    stat_cache: Optional[StatCache] = None,
+    paranoid: bool = False,
+    workers: int = 1,
+    defer_hashing: bool = False,
+    rules: Optional[IgnoreRules] = None,
+) -> ScanResult:
+    # The whole tree in memory; iter_scan is the streaming form of the same scan
+    files = []
+    total_size = 0
+    file_data_map = {}
+    deferred = {}
+    sizes = {}
+
+    for record in iter_scan(
+        folder_path, stat_cache, paranoid, workers, defer_hashing, rules
+    ):
+        path = folder_path / record.rel_path
+        files.append(path)
+        total_size += record.size
+        file_data_map[path] = record.hash
+        sizes[path] = record.size
+        if record.hash is None:
+            deferred[path] = record.stat
+
+        if progress_callback:
+            progress_callback(
+                ProgressEvent(processed=len(files), current_file=path.name)
+            )
+
+    result = ScanResult(
+        files=files,
+        total_files=len(files),
+        total_size=total_size,
+        file_hashes=file_data_map,
+        deferred=deferred,
+        sizes=sizes,
+    )
+
+    print()
+    logger.info(
+        f"Scanning files is completed, total files: {len(files)} / volume: {total_size / (1024**2):.2f} Mb"
+    )
+    return result
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = "stat_cache.json"
+CACHE_VERSION = 1
+
+
+class StatCache:
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.fresh = {}
+        self.scan_started_ns = time.time_ns()
+        # Time of the scan that produced the cache. Files modified at or after it
+        # are "racy": they could have changed again within the same mtime tick.
+        self.saved_scan_ns = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not self.cache_path.exists():
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != CACHE_VERSION:
+                logger.info(f"Stat cache {self.cache_path} has another version, ignored.")
+                return
+            self.entries = data.get("files", {})
+            self.saved_scan_ns = data.get("scan_started_ns", 0)
+        except (OSError, ValueError) as e:
+            # A broken cache only costs a full rehash
+            logger.warning(f"Stat cache {self.cache_path} is damaged, ignored: {e}")
+            self.entries = {}
+
+    @staticmethod
+    def _stat_key(file_stat: os.stat_result) -> list:
+        return [
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+            file_stat.st_ino,
+            file_stat.st_ctime_ns,
+        ]
+
+    def lookup(self, rel_path: str, file_stat: os.stat_result) -> Optional[str]:
+        entry = self.entries.get(rel_path)
+        if (
+            entry
+            and entry[:4] == self._stat_key(file_stat)
+            and file_stat.st_mtime_ns < self.saved_scan_ns
+        ):
+            self.hits += 1
+            self.fresh[rel_path] = entry
+            return entry[4]
+        self.misses += 1
+        return None
+
+    def update(self, rel_path: str, file_stat: os.stat_result, file_hash: str):
+        self.fresh[rel_path] = self._stat_key(file_stat) + [file_hash]
+
+    def forget(self, rel_path: str):
+        self.fresh.pop(rel_path, None)
+
+    def start_scan(self):
+        # A long-running process (the watch daemon) looks at the tree again: the hashes
+        # recorded from now on are racy only for files modified after this moment
+        self.scan_started_ns = time.time_ns()
+
+    def save(self):
+        # Only the files seen by the last scan are kept, deleted files drop out
+        data = {
+            "version": CACHE_VERSION,
+            "scan_started_ns": self.scan_started_ns,
+            "files": self.fresh,
+        }
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.cache_path)
@@ -1,83 +1,1229 @@
-import shutil
-import unittest
-import sys
-from pathlib import Path
-
-sys.path.append(str(Path(__file__).parent.parent))
-from manager import BackupManager
-from scanner import scan_files
-
-
-class TestBackupSystem(unittest.TestCase):
-    def setUp(self):
-        # Creating temporary folders for tests
-        self.base_path = Path(__file__).parent.parent
-        self.test_dir = self.base_path / "test_sandbox"
-        self.source = self.test_dir / "source"
-        self.storage = self.test_dir / "storage"
-        self.restore = self.test_dir / "restore"
-
-        for p in [self.source, self.storage, self.restore]:
-            if p.exists():
-                shutil.rmtree(p)
-            p.mkdir(parents=True)
-
-        # Creating test-file
-        self.file_content = b"Secret data inside a file"
-        (self.source / "secret.txt").write_bytes(self.file_content)
-
-    def test_full_cycle(self):
-        manager = BackupManager(self.storage)
-
-        # 1. Creating a backup with compression and password
-        scan_res = scan_files(self.source)
-        manager.create_backup(
-            scan_res, self.source, "ProjectX", compress=True, password="123"
-        )
-
-        # We find the created version
-        ver_dir = manager._find_target_versions("ProjectX")[0]
-
-        # 2. Restoring
-        manager.restore_version(
-            "ProjectX",
-            ver_dir.name,
-            self.restore,
-            password="123",
-            decrypt_data=True,
-            decompress_data=True,
-        )
-
-        # Checking the result
-        restored_file = self.restore / f"ProjectX_{ver_dir.name}" / "secret.txt"
-        self.assertTrue(restored_file.exists())
-        self.assertEqual(restored_file.read_bytes(), self.file_content)
-        print("\n[✓] The Compression + Password test has been passed!")
-
-    def test_salt_change_isolation(self):
-        manager = BackupManager(self.storage)
-
-        # We make two backups with different salts
-        scan_res = scan_files(self.source)
-
-        # Version 1
-        manager.create_backup(scan_res, self.source, "ProjectX", password="123")
-
-        # Version 2 (changing the salt by forcibly passing "None" to "forced_salt")
-        manager.create_backup(
-            scan_res, self.source, "ProjectX", password="123", forced_salt=None
-        )
-
-        # There should be 2 files in the objects folder
-        objects = list(self.storage.glob("objects/*/*"))
-        self.assertEqual(len(objects), 2)
-        print(f"[✓] Salt isolation test passed (objects): {len(objects)})")
-
-    def tearDown(self):
-        # We remove the garbage after the test
-        # shutil.rmtree(self.test_dir)
-        pass
-
-
-if __name__ == "__main__":
-    unittest.main()
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import tracemalloc
+import unittest
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+import object_format
+from compressors import CODECS, OUTPUT_BLOCK, get_codec, policy_codec
+from crypter import FileCrypter
+from hasher import get_file_hash
+from classes import ProgressEvent, RetentionPolicy
+from manager import BackupManager
+import manager as manager_module
+import manifest as manifest_module
+import object_store as object_store_module
+from manifest import ManifestWriter, open_manifest
+from metrics import METRICS
+from object_store import ObjectStore
+from benchmark import compare, generate_dataset, run_dataset
+from daemon import BackupDaemon
+from pruner import prune, select_versions
+from ignore_rules import IgnoreRules, default_rules, load_rules
+from scanner import iter_scan, scan_files, walk_files
+from utils import ProgressRenderer, in_order, pread
+from verifier import verify
+from watcher import WHOLE_TREE, InotifyWatcher, PollingWatcher
+
+
+class TestBackupSystem(unittest.TestCase):
+    def setUp(self):
+        # Creating temporary folders for tests
+        self.base_path = Path(__file__).parent.parent
+        self.test_dir = self.base_path / "test_sandbox"
+        self.source = self.test_dir / "source"
+        self.storage = self.test_dir / "storage"
+        self.restore = self.test_dir / "restore"
+
+        for p in [self.source, self.storage, self.restore]:
+            if p.exists():
+                shutil.rmtree(p)
+            p.mkdir(parents=True)
+
+        # Creating test-file
+        self.file_content = b"Secret data inside a file"
+        (self.source / "secret.txt").write_bytes(self.file_content)
+
+    def test_full_cycle(self):
+        manager = BackupManager(self.storage)
+
+        # 1. Creating a backup with compression and password
+        scan_res = scan_files(self.source)
+        manager.create_backup(
+            scan_res, self.source, "ProjectX", compress=True, password="123"
+        )
+
+        # We find the created version
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+
+        # 2. Restoring
+        manager.restore_version(
+            "ProjectX",
+            ver_dir.name,
+            self.restore,
+            password="123",
+            decrypt_data=True,
+            decompress_data=True,
+        )
+
+        # Checking the result
+        restored_file = self.restore / f"ProjectX_{ver_dir.name}" / "secret.txt"
+        self.assertTrue(restored_file.exists())
+        self.assertEqual(restored_file.read_bytes(), self.file_content)
+        print("\n[✓] The Compression + Password test has been passed!")
+
+    def test_salt_change_isolation(self):
+        manager = BackupManager(self.storage)
+
+        # We make two backups with different salts
+        scan_res = scan_files(self.source)
+
+        # Version 1
+        manager.create_backup(scan_res, self.source, "ProjectX", password="123")
+
+        # Version 2 (changing the salt by forcibly passing "None" to "forced_salt")
+        manager.create_backup(
+            scan_res, self.source, "ProjectX", password="123", forced_salt=None
+        )
+
+        # There should be 2 files in the objects folder
+        objects = list(self.storage.glob("objects/*/*"))
+        self.assertEqual(len(objects), 2)
+        print(f"[✓] Salt isolation test passed (objects): {len(objects)})")
+
+    def test_stat_cache_skips_unchanged_files(self):
+        manager = BackupManager(self.storage)
+
+        cache = manager.get_stat_cache("ProjectX")
+        first = scan_files(self.source, stat_cache=cache)
+        cache.save()
+
+        # Second scan: the unchanged file is taken from the cache
+        (self.source / "new.txt").write_bytes(b"Another file")
+        cache = manager.get_stat_cache("ProjectX")
+        second = scan_files(self.source, stat_cache=cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        secret = self.source / "secret.txt"
+        self.assertEqual(first.file_hashes[secret], second.file_hashes[secret])
+
+        # Paranoid mode rehashes everything
+        cache = manager.get_stat_cache("ProjectX")
+        scan_files(self.source, stat_cache=cache, paranoid=True)
+        self.assertEqual(cache.hits, 0)
+        print("[✓] Stat cache test passed")
+
+    def test_parallel_scan_matches_serial(self):
+        for i in range(20):
+            sub = self.source / f"dir{i % 3}"
+            sub.mkdir(exist_ok=True)
+            (sub / f"file{i}.bin").write_bytes(bytes([i]) * (i * 1000))
+
+        serial = scan_files(self.source)
+        parallel = scan_files(self.source, workers=4)
+
+        self.assertEqual(serial.files, parallel.files)
+        self.assertEqual(serial.file_hashes, parallel.file_hashes)
+        self.assertEqual(serial.total_size, parallel.total_size)
+        print("[✓] Parallel scan test passed")
+
+    def test_stream_format_multiple_frames(self):
+        crypter = FileCrypter("123")
+        data = os.urandom(5000) + b"A" * 20000
+        old_frame_size = object_format.FRAME_SIZE
+        object_format.FRAME_SIZE = 1024
+        try:
+            encoded = b"".join(
+                object_format.encode_stream(
+                    [data[:7000], data[7000:]], get_codec("zlib"), crypter
+                )
+            )
+            decoded = b"".join(object_format.decode_stream(io.BytesIO(encoded), crypter))
+            self.assertEqual(decoded, data)
+
+            # Dropping the last frame must not go unnoticed
+            frames = object_format.encode_stream([data], None, crypter)
+            encoded = b"".join(list(frames)[:-1])
+            with self.assertRaises(Exception):
+                b"".join(object_format.decode_stream(io.BytesIO(encoded), crypter))
+        finally:
+            object_format.FRAME_SIZE = old_frame_size
+        print("[✓] Stream format test passed")
+
+    def test_plain_objects_are_streamed(self):
+        # Media files are stored as they are: restoring one must not read it whole
+        movie = os.urandom(16 * 1024 * 1024)
+        (self.source / "movie.mkv").write_bytes(movie)
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", compress=True)
+        v_name = manager._find_target_versions("ProjectX")[0].name
+
+        tracemalloc.start()
+        try:
+            report = manager.restore_version("ProjectX", v_name, self.restore)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(report.ok), 2)
+        self.assertEqual((self.restore / f"ProjectX_{v_name}" / "movie.mkv").read_bytes(), movie)
+        self.assertLess(peak, 8 * 1024 * 1024)
+
+        tracemalloc.start()
+        try:
+            report = verify(manager, "ProjectX")
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual((report.checked, report.damaged), (2, []))
+        self.assertLess(peak, 8 * 1024 * 1024)
+        print("[✓] Plain object streaming test passed")
+
+    def test_legacy_objects_stay_readable(self):
+        manager = BackupManager(self.storage)
+        crypter = FileCrypter("123")
+        f_hash = get_file_hash(self.source / "secret.txt")
+
+        # An object and a manifest in the old whole-file format
+        obj_path = manager._get_object_path(
+            f_hash, encrypted=True, compressed=True, salt=crypter.salt.hex()
+        )
+        obj_path.parent.mkdir(parents=True)
+        data = manager._add_padding(zlib.compress(self.file_content, level=6))
+        obj_path.write_bytes(crypter.encrypt(data))
+
+        version_dir = self.storage / "Legacy" / "2020-01-01_00-00-00"
+        version_dir.mkdir(parents=True)
+        manifest = {
+            "info": {"salt": crypter.salt.hex(), "total_files": 1},
+            "files": {"secret.txt": {"hash": f_hash, "compressed": True}},
+        }
+        (version_dir / "manifest.json").write_text(json.dumps(manifest))
+
+        manager.restore_version("Legacy", version_dir.name, self.restore, password="123")
+        restored_file = self.restore / f"Legacy_{version_dir.name}" / "secret.txt"
+        self.assertEqual(restored_file.read_bytes(), self.file_content)
+        print("[✓] Legacy object test passed")
+
+    def test_chunking_stores_only_changed_chunks(self):
+        manager = BackupManager(self.storage)
+        big_file = self.source / "dump.db"
+        data = bytearray(os.urandom(6 * 1024 * 1024))
+        big_file.write_bytes(data)
+
+        manager.create_backup(
+            scan_files(self.source), self.source, "ProjectX", password="123", chunking=True
+        )
+        objects_before = len(list(self.storage.glob("objects/*/*")))
+        self.assertGreater(objects_before, 3)
+
+        # A one-byte change in the middle of the file
+        data[3 * 1024 * 1024] ^= 0xFF
+        big_file.write_bytes(data)
+        first_ver = manager._find_target_versions("ProjectX")[-1]
+        salt = open_manifest(first_ver).info["salt"]
+        manager.create_backup(
+            scan_files(self.source),
+            self.source,
+            "ProjectX",
+            password="123",
+            forced_salt=salt,
+            chunking=True,
+        )
+        objects_after = len(list(self.storage.glob("objects/*/*")))
+        self.assertLessEqual(objects_after - objects_before, 2)
+
+        ver_dir = manager._find_target_versions("ProjectX")[-1]
+        manager.restore_version("ProjectX", ver_dir.name, self.restore, password="123")
+        restored_file = self.restore / f"ProjectX_{ver_dir.name}" / "dump.db"
+        self.assertEqual(restored_file.read_bytes(), bytes(data))
+        print("[✓] Chunking test passed")
+
+    def test_delta_stores_only_the_change(self):
+        manager = BackupManager(self.storage)
+        crypter = FileCrypter("123")
+        export = self.source / "export.csv"
+        data = b"".join(b"%d,user%d,%d\n" % (i, i % 50, i * 7) for i in range(150000))
+        contents = [data, data + b"1,appended,2\n" * 1000]
+        edited = bytearray(contents[1])
+        edited[len(data) // 2 : len(data) // 2 + 10] = b"**edited**"
+        contents += [bytes(edited), bytes(edited) + b"3,appended,4\n" * 1000]
+
+        def stored_bytes():
+            return sum(p.stat().st_size for p in self.storage.glob("objects/*/*"))
+
+        old_chain = manager_module.DELTA_CHAIN
+        manager_module.DELTA_CHAIN = 2
+        sizes = []
+        try:
+            for day, content in enumerate(contents, start=1):
+                export.write_bytes(content)
+                before = stored_bytes()
+                manager.create_backup(
+                    scan_files(self.source), self.source, "ProjectX", crypter=crypter, delta=True
+                )
+                sizes.append(stored_bytes() - before)
+                v_dir = manager._find_target_versions("ProjectX")[-1]
+                v_dir.rename(v_dir.with_name(f"2020-01-0{day}_00-00-00"))
+                manager.rebuild_catalog()
+        finally:
+            manager_module.DELTA_CHAIN = old_chain
+
+        # A full object, two deltas, then a full object again: the chain is bounded
+        chains = [
+            len(open_manifest(v_dir).get("export.csv").get("delta", []))
+            for v_dir in manager._find_target_versions("ProjectX")
+        ]
+        self.assertEqual(chains, [0, 1, 2, 0])
+        self.assertLess(max(sizes[1], sizes[2]) * 4, sizes[0])
+
+        for v_dir, content in zip(manager._find_target_versions("ProjectX"), contents):
+            report = manager.restore_version("ProjectX", v_dir.name, self.restore, password="123")
+            self.assertEqual(len(report.ok), 2)
+            restored_dir = self.restore / f"ProjectX_{v_dir.name}"
+            self.assertEqual((restored_dir / "export.csv").read_bytes(), content)
+            # No temporary file of the chain is left behind
+            self.assertEqual(
+                sorted(p.name for p in restored_dir.iterdir()), ["export.csv", "secret.txt"]
+            )
+        self.assertEqual(verify(manager, password="123").damaged, [])
+        print("[✓] Delta test passed")
+
+    def test_parallel_backup_matches_serial(self):
+        # Many files with the same content race for the same object
+        for i in range(30):
+            (self.source / f"copy{i}.txt").write_bytes(self.file_content)
+            (self.source / f"unique{i}.txt").write_bytes(os.urandom(100 + i))
+        scan_res = scan_files(self.source)
+
+        serial_storage = self.test_dir / "serial"
+        if serial_storage.exists():
+            shutil.rmtree(serial_storage)
+        serial = BackupManager(serial_storage)
+        parallel = BackupManager(self.storage)
+        serial.create_backup(scan_res, self.source, "ProjectX", jobs=1)
+        res = parallel.create_backup(scan_res, self.source, "ProjectX", jobs=8)
+
+        def read_manifest(manager):
+            ver_dir = manager._find_target_versions("ProjectX")[0]
+            return list(open_manifest(ver_dir).items())
+
+        self.assertEqual(res.errors, 0)
+        self.assertEqual(read_manifest(serial), read_manifest(parallel))
+        serial_objects = sorted(p.name for p in serial_storage.glob("objects/*/*"))
+        parallel_objects = sorted(p.name for p in self.storage.glob("objects/*/*"))
+        self.assertEqual(serial_objects, parallel_objects)
+        print("[✓] Parallel backup test passed")
+
+    def test_in_order_bounds_pending_tasks(self):
+        submitted = []
+
+        def submit_all(pool):
+            for i in range(40):
+                submitted.append(i)
+                # Later tasks finish first
+                yield i, pool.submit(time.sleep, (40 - i) / 4000)
+
+        taken = []
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            for i, task in in_order(submit_all(pool), 4, per_job=2):
+                task.result()
+                # Never more than jobs * per_job tasks waiting besides this one
+                self.assertLessEqual(len(submitted) - len(taken), 9)
+                taken.append(i)
+        self.assertEqual(taken, list(range(40)))
+
+        # Work that runs inline is given back at once
+        inline = list(in_order(((i, None) for i in range(5)), 1))
+        self.assertEqual([i for i, _ in inline], list(range(5)))
+        print("[✓] Ordered bounded pool test passed")
+    def test_parallel_restore_report(self):
+        for i in range(10):
+            (self.source / f"file{i}.txt").write_bytes(os.urandom(1000))
+        manager = BackupManager(self.storage)
+        scan_res = scan_files(self.source)
+        manager.create_backup(scan_res, self.source, "ProjectX", compress=False)
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+
+        # One damaged object and one missing object
+        objects = sorted(self.storage.glob("objects/*/*"))
+        objects[0].write_bytes(b"broken")
+        objects[1].unlink()
+
+        report = manager.restore_version("ProjectX", ver_dir.name, self.restore, jobs=4)
+        self.assertEqual(report.total, 11)
+        self.assertEqual(len(report.ok), 9)
+        self.assertEqual(len(report.damaged), 1)
+        self.assertEqual(len(report.missing_object), 1)
+        print("[✓] Restore report test passed")
+
+    def test_wrong_password_stops_restore(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+
+        report = manager.restore_version("ProjectX", ver_dir.name, self.restore, password="bad")
+        self.assertEqual(report.ok, [])
+        self.assertEqual(report.wrong_password, ["secret.txt"])
+        print("[✓] Wrong password test passed")
+
+    def test_packed_store(self):
+        for i in range(50):
+            (self.source / f"small{i}.txt").write_bytes(b"small file %d" % i)
+        (self.source / "big.bin").write_bytes(os.urandom(200 * 1024))
+
+        manager = BackupManager(self.storage, packed=True)
+        scan_res = scan_files(self.source)
+        manager.create_backup(scan_res, self.source, "ProjectX", password="123", jobs=4)
+        manager.close()
+
+        # Only the big object is a loose file, the small ones are in one pack
+        loose = [p for p in self.storage.glob("objects/*/*") if p.parent.name != "packs"]
+        self.assertEqual(len(loose), 1)
+        self.assertEqual(len(list(self.storage.glob("objects/packs/*.pack"))), 1)
+
+        # A new manager finds the packed objects through the pack index
+        manager = BackupManager(self.storage)
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+        report = manager.restore_version("ProjectX", ver_dir.name, self.restore, password="123")
+        manager.close()
+        self.assertEqual(len(report.ok), 52)
+        restored = self.restore / f"ProjectX_{ver_dir.name}"
+        self.assertEqual((restored / "small7.txt").read_bytes(), b"small file 7")
+        print("[✓] Packed store test passed")
+
+    def test_reads_without_pread(self):
+        # Windows has no os.pread: pack and delta reads go through a mapping instead
+        data = os.urandom(10000)
+        (self.source / "data.bin").write_bytes(data)
+        for i in range(5):
+            (self.source / f"small{i}.txt").write_bytes(b"small file %d" % i)
+        manager = BackupManager(self.storage, packed=True)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        v_name = manager._find_target_versions("ProjectX")[0].name
+        manager.close()
+
+        saved = os.pread
+        del os.pread
+        try:
+            fd = os.open(self.source / "data.bin", os.O_RDONLY)
+            try:
+                self.assertEqual(pread(fd, 100, 5000), data[5000:5100])
+                self.assertEqual(pread(fd, 100, 9950), data[9950:])
+                self.assertEqual(pread(fd, 100, 20000), b"")
+            finally:
+                os.close(fd)
+            manager = BackupManager(self.storage)
+            report = manager.restore_version("ProjectX", v_name, self.restore, password="123")
+            manager.close()
+        finally:
+            os.pread = saved
+        self.assertEqual(len(report.ok), 7)
+        restored = self.restore / f"ProjectX_{v_name}"
+        self.assertEqual((restored / "small3.txt").read_bytes(), b"small file 3")
+        print("[✓] Reads without pread test passed")
+    def test_object_index_is_rebuilt(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        manager.close()
+        store_hash = next(self.storage.glob("objects/*/*")).name
+        index_path = self.storage / "objects" / "index.bin"
+        self.assertTrue(BackupManager(self.storage).store.exists(store_hash))
+
+        # A missing or damaged index is rebuilt from objects/
+        for broken in (None, b"garbage"):
+            if broken is None:
+                index_path.unlink()
+            else:
+                index_path.write_bytes(broken)
+            self.assertTrue(BackupManager(self.storage).store.exists(store_hash))
+            self.assertTrue(index_path.read_bytes().endswith(bytes.fromhex(store_hash)))
+        print("[✓] Object index test passed")
+
+    def test_version_catalog(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+        salt = manager.get_version_info(ver_dir)["salt"]
+
+        # Lookups do not need the manifests
+        manifest_path = ver_dir / "manifest.dat"
+        manifest_data = manifest_path.read_bytes()
+        manifest_path.unlink()
+        manager = BackupManager(self.storage)
+        self.assertEqual(manager._find_target_versions("ProjectX"), [ver_dir])
+        self.assertEqual(manager.get_version_info(ver_dir)["salt"], salt)
+        self.assertEqual(manager.get_version_info(ver_dir)["total_files"], 1)
+
+        # Date range queries
+        for name in ("2024-01-01_10-00-00", "2024-06-01_10-00-00", "2025-01-01_10-00-00"):
+            (self.storage / "Old" / name).mkdir(parents=True)
+            manager.catalog.add("Old", name, {"timestamp": name, "total_files": 0})
+        found = manager._find_target_versions("Old", since="2024-02", until="2024-12")
+        self.assertEqual([v.name for v in found], ["2024-06-01_10-00-00"])
+        shutil.rmtree(self.storage / "Old")
+
+        # A missing catalog is rebuilt from the manifests
+        manifest_path.write_bytes(manifest_data)
+        (self.storage / "catalog.json").unlink()
+        manager = BackupManager(self.storage)
+        self.assertEqual(manager._find_target_versions(), [ver_dir])
+
+        # Two managers on one storage (a watch daemon and a manual backup): neither
+        # loses the versions of the other
+        other = BackupManager(self.storage)
+        other.create_backup(scan_files(self.source), self.source, "ProjectY")
+        (self.source / "new.txt").write_bytes(b"new")
+        manager.create_backup(scan_files(self.source), self.source, "ProjectZ")
+        catalog = json.loads((self.storage / "catalog.json").read_text())["projects"]
+        self.assertEqual(sorted(catalog), ["ProjectX", "ProjectY", "ProjectZ"])
+        self.assertEqual(len(other._find_target_versions()), 3)
+
+        # A version folder removed by hand is dropped, one the catalog lost is added back
+        shutil.rmtree(other._find_target_versions("ProjectY")[0])
+        self.assertEqual(manager._find_target_versions("ProjectY"), [])
+        manager.catalog.remove("ProjectX", ver_dir.name)
+        self.assertEqual(BackupManager(self.storage)._find_target_versions("ProjectX"), [ver_dir])
+        print("[✓] Version catalog test passed")
+
+    def test_manifest_lookup_and_iteration(self):
+        version_dir = self.test_dir / "manifest_version"
+        version_dir.mkdir(exist_ok=True)
+        writer = ManifestWriter(version_dir)
+        paths = [f"dir{i % 7}/file{i}.txt" for i in range(2500)]
+        for i, rel_path in enumerate(paths):
+            writer.add(rel_path, {"hash": f"{i:064x}", "compressed": True})
+        writer.write({"total_files": len(paths)})
+
+        manifest = open_manifest(version_dir)
+        self.assertEqual(len(manifest), 2500)
+        self.assertEqual(manifest.info["total_files"], 2500)
+        self.assertEqual([p for p, _ in manifest.items()], sorted(paths))
+        self.assertEqual(manifest.get("dir3/file1200.txt")["hash"], f"{1200:064x}")
+        self.assertIsNone(manifest.get("dir3/missing.txt"))
+        self.assertIsNone(manifest.get("aaa"))
+        self.assertEqual(
+            [p for p, _ in manifest.items("dir3/")],
+            sorted(p for p in paths if p.startswith("dir3/")),
+        )
+        self.assertEqual(list(manifest.items("dir9/")), [])
+        print("[✓] Manifest format test passed")
+
+    def test_manifest_spills_sorted_runs(self):
+        version_dir = self.test_dir / "manifest_runs"
+        version_dir.mkdir(exist_ok=True)
+        old_run_entries = manifest_module.RUN_ENTRIES
+        manifest_module.RUN_ENTRIES = 300
+        try:
+            writer = ManifestWriter(version_dir)
+            paths = [f"dir{i % 7}/file{i}.txt" for i in range(2500)]
+            for i, rel_path in enumerate(paths):
+                writer.add(rel_path, {"hash": f"{i:064x}", "compressed": False})
+            self.assertEqual(len(writer._runs), 8)
+            writer.write({"total_files": len(paths)})
+        finally:
+            manifest_module.RUN_ENTRIES = old_run_entries
+
+        manifest = open_manifest(version_dir)
+        self.assertEqual([p for p, _ in manifest.items()], sorted(paths))
+        self.assertEqual(list(version_dir.glob("*.run*")), [])
+        print("[✓] Manifest runs test passed")
+
+    def test_streaming_scan_backup(self):
+        (self.source / "sub").mkdir()
+        for i in range(20):
+            (self.source / "sub" / f"f{i}.txt").write_bytes(f"file {i}".encode() * 100)
+        records = iter_scan(self.source, workers=4)
+        self.assertEqual(next(records).rel_path, "secret.txt")
+
+        manager = BackupManager(self.storage)
+        res = manager.create_backup(
+            iter_scan(self.source, defer_hashing=True), self.source, "ProjectX", jobs=4
+        )
+        self.assertEqual(res.errors, 0)
+        self.assertEqual(res.copied, 21)
+
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+        info = manager.get_version_info(ver_dir)
+        scan_res = scan_files(self.source)
+        self.assertEqual(info["total_files"], scan_res.total_files)
+        self.assertEqual(info["total_bytes"], scan_res.total_size)
+        hashes = {p: e["hash"] for p, e in open_manifest(ver_dir).items()}
+        self.assertEqual(
+            hashes,
+            {str(p.relative_to(self.source)): h for p, h in scan_res.file_hashes.items()},
+        )
+        print("[✓] Streaming scan test passed")
+    def test_codecs_decode_in_bounded_pieces(self):
+        # Zeros compress to almost nothing: one frame must not come out as one huge piece
+        zeros = bytes(1024 * 1024)
+        crypter = FileCrypter("123")
+        for name in CODECS:
+            codec = get_codec(name)
+            encoded = b"".join(object_format.encode_stream([zeros] * 32, codec, crypter))
+            self.assertLess(len(encoded), 4 * 1024 * 1024)
+            sizes = [
+                len(piece)
+                for piece in object_format.decode_stream(io.BytesIO(encoded), crypter)
+            ]
+            self.assertEqual(sum(sizes), 32 * len(zeros), name)
+            self.assertLessEqual(max(sizes), OUTPUT_BLOCK, name)
+
+            # A cut compressed stream is an error, not a short file
+            encoder = codec.encoder()
+            compressed = encoder.compress(b"data " * 10000) + encoder.flush()
+            with self.assertRaises(ValueError, msg=name):
+                b"".join(codec.decoder().decode([compressed[:-8]]))
+        print(f"[✓] Bounded decoding test passed ({', '.join(CODECS)})")
+
+    def test_adaptive_compression(self):
+        (self.source / "log.txt").write_bytes(b"INFO request served\n" * 5000)
+        (self.source / "random.bin").write_bytes(os.urandom(200 * 1024))
+        manager = BackupManager(self.storage)
+        manager.create_backup(
+            scan_files(self.source),
+            self.source,
+            "ProjectX",
+            password="123",
+            compression_policy="smallest",
+        )
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+        manifest = open_manifest(ver_dir)
+
+        # Text is compressed with the codec of the policy, random bytes are stored as is
+        self.assertTrue(manifest.get("log.txt")["compressed"])
+        self.assertEqual(manifest.get("log.txt")["codec"], policy_codec("smallest")[0])
+        self.assertFalse(manifest.get("random.bin")["compressed"])
+
+        report = manager.restore_version("ProjectX", ver_dir.name, self.restore, password="123")
+        self.assertEqual(len(report.ok), 3)
+        restored = self.restore / f"ProjectX_{ver_dir.name}"
+        self.assertEqual(
+            (restored / "log.txt").read_bytes(), (self.source / "log.txt").read_bytes()
+        )
+        print("[✓] Adaptive compression test passed")
+
+    def test_fused_backup_matches_two_pass(self):
+        (self.source / "notes.txt").write_bytes(b"line of notes\n" * 3000)
+        (self.source / "copy.txt").write_bytes(self.file_content)
+        two_pass_storage = self.test_dir / "two_pass"
+        if two_pass_storage.exists():
+            shutil.rmtree(two_pass_storage)
+        BackupManager(two_pass_storage).create_backup(
+            scan_files(self.source), self.source, "ProjectX", jobs=4
+        )
+
+        # The scan reads nothing, hashes are computed while the objects are written
+        scan_res = scan_files(self.source, defer_hashing=True)
+        self.assertEqual(set(scan_res.file_hashes.values()), {None})
+        manager = BackupManager(self.storage, packed=True)
+        res = manager.create_backup(scan_res, self.source, "ProjectX", jobs=4)
+        self.assertEqual(res.errors, 0)
+        self.assertEqual(res.copied, 2)
+        self.assertEqual(scan_res.file_hashes, scan_files(self.source).file_hashes)
+
+        def entries(storage):
+            ver_dir = BackupManager(storage)._find_target_versions("ProjectX")[0]
+            return list(open_manifest(ver_dir).items())
+
+        self.assertEqual(entries(self.storage), entries(two_pass_storage))
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+        report = manager.restore_version("ProjectX", ver_dir.name, self.restore)
+        self.assertEqual(len(report.ok), 3)
+        print("[✓] Fused backup test passed")
+
+    def test_file_changed_after_scan_is_reported(self):
+        scan_res = scan_files(self.source)
+        (self.source / "secret.txt").write_bytes(b"edited after the scan")
+        manager = BackupManager(self.storage)
+        res = manager.create_backup(scan_res, self.source, "ProjectX")
+
+        self.assertEqual(res.changed, ["secret.txt"])
+        self.assertEqual(res.errors, 1)
+        # Nothing was stored under the hash recorded by the scan
+        self.assertEqual(list(self.storage.glob("objects/??/*")), [])
+        self.assertEqual(list(self.storage.glob("objects/tmp/*")), [])
+        print("[✓] Changed file test passed")
+
+    def test_ignore_rules(self):
+        rules = IgnoreRules(
+            ["# comment", "*.o", "/build/", "docs/**/*.pdf", "cache/", "!keep.o"]
+        )
+        self.assertTrue(rules.is_ignored("main.o"))
+        self.assertTrue(rules.is_ignored("src/deep/main.o"))
+        self.assertFalse(rules.is_ignored("keep.o"))
+        self.assertTrue(rules.is_ignored("build", is_dir=True))
+        self.assertFalse(rules.is_ignored("build"))
+        self.assertFalse(rules.is_ignored("src/build", is_dir=True))
+        self.assertTrue(rules.is_ignored("docs/a/b/x.pdf"))
+        self.assertTrue(rules.is_ignored("docs/x.pdf"))
+        self.assertFalse(rules.is_ignored("other/docs/x.pdf"))
+        self.assertTrue(rules.is_ignored("a/cache", is_dir=True))
+        print("[✓] Ignore rules test passed")
+
+    def test_walker_with_ignore_file(self):
+        for rel_path in [
+            "src/app.py",
+            "src/app.pyc",
+            "src/__pycache__/app.cpython.pyc",
+            "build/out.bin",
+            "notes/TODO.LOG",
+            "notes/keep.txt",
+            "b/x.txt",
+            "a.txt",
+        ]:
+            path = self.source / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(rel_path.encode())
+        (self.source / ".backupignore").write_text("*.pyc\n/build/\n")
+
+        rules = load_rules(self.source)
+        serial = [rel for rel, _ in walk_files(self.source, rules)]
+        parallel = [rel for rel, _ in walk_files(self.source, rules, workers=4)]
+        self.assertEqual(serial, parallel)
+        self.assertEqual(
+            serial,
+            [
+                ".backupignore",
+                "a.txt",
+                "secret.txt",
+                os.path.join("b", "x.txt"),
+                os.path.join("notes", "keep.txt"),
+                os.path.join("src", "app.py"),
+            ],
+        )
+        scan_res = scan_files(self.source, rules=load_rules(self.source, ["!*.pyc"]))
+        self.assertIn(self.source / "src" / "app.pyc", scan_res.file_hashes)
+        print("[✓] Walker test passed")
+
+    def test_inotify_watcher_reports_changes(self):
+        try:
+            watcher = InotifyWatcher(self.source, default_rules())
+        except OSError as e:
+            self.skipTest(f"inotify is not available: {e}")
+        try:
+            (self.source / "new.txt").write_bytes(b"new")
+            (self.source / "sub").mkdir()
+            (self.source / "sub" / "inner.txt").write_bytes(b"inner")
+            (self.source / "skip.tmp").write_bytes(b"ignored")
+            (self.source / "secret.txt").unlink()
+            dirty = set()
+            for _ in range(5):
+                dirty |= watcher.wait(0.2)
+            self.assertEqual(dirty, {"new.txt", "sub", "secret.txt"})
+
+            # The new directory is watched from now on
+            (self.source / "sub" / "later.txt").write_bytes(b"later")
+            self.assertIn(os.path.join("sub", "later.txt"), watcher.wait(1.0))
+        finally:
+            watcher.close()
+        print("[✓] Inotify watcher test passed")
+
+    def test_daemon_snapshots_only_changes(self):
+        (self.source / "keep.txt").write_bytes(b"unchanged file")
+        manager = BackupManager(self.storage)
+        daemon = BackupDaemon(
+            manager,
+            self.source,
+            "ProjectX",
+            default_rules(),
+            password="123",
+            watcher=PollingWatcher(self.source, default_rules(), interval=3600),
+        )
+        daemon.start(manager.get_stat_cache("ProjectX"))
+        self.assertEqual(len(daemon.files), 2)
+        # The files hashed while they were stored are in the saved stat cache
+        self.assertEqual(len(manager.get_stat_cache("ProjectX").entries), 2)
+
+        (self.source / "keep.txt").touch()
+        (self.source / "secret.txt").write_bytes(b"a new secret, longer than before")
+        (self.source / "sub").mkdir()
+        (self.source / "sub" / "added.txt").write_bytes(b"added")
+        daemon.dirty.add(WHOLE_TREE)
+        self.assertTrue(daemon.flush())
+
+        versions = manager._find_target_versions("ProjectX")
+        self.assertEqual(len(versions), 2)
+        entries = dict(open_manifest(versions[-1]).items())
+        self.assertEqual(
+            sorted(entries), ["keep.txt", "secret.txt", os.path.join("sub", "added.txt")]
+        )
+        self.assertEqual(
+            entries["secret.txt"]["hash"], get_file_hash(self.source / "secret.txt")
+        )
+
+        # A normal run after the daemon hashes nothing again
+        cache = manager.get_stat_cache("ProjectX")
+        scan_files(self.source, stat_cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+
+        # Nothing changed since: no snapshot
+        daemon.dirty.add(WHOLE_TREE)
+        self.assertFalse(daemon.flush())
+        report = manager.restore_version(
+            "ProjectX", versions[-1].name, self.restore, password="123"
+        )
+        self.assertEqual(len(report.ok), 3)
+        daemon.close()
+
+        # Paranoid: a file rewritten with its old size and mtime is still read again
+        keep_stat = (self.source / "keep.txt").stat()
+        (self.source / "keep.txt").write_bytes(b"changed sneaky")
+        os.utime(self.source / "keep.txt", ns=(keep_stat.st_atime_ns, keep_stat.st_mtime_ns))
+        daemon = BackupDaemon(
+            manager,
+            self.source,
+            "ProjectX",
+            default_rules(),
+            password="123",
+            paranoid=True,
+            watcher=PollingWatcher(self.source, default_rules(), interval=3600),
+        )
+        cache = manager.get_stat_cache("ProjectX")
+        daemon.start(cache)
+        self.assertEqual(cache.hits, 0)
+        daemon.dirty.add("keep.txt")
+        self.assertTrue(daemon.flush())
+        entries = dict(open_manifest(manager._find_target_versions("ProjectX")[-1]).items())
+        self.assertEqual(entries["keep.txt"]["hash"], get_file_hash(self.source / "keep.txt"))
+        daemon.close()
+        print("[✓] Daemon test passed")
+
+    @unittest.skipIf(mock_aws is None, "moto is not installed")
+    def test_cloud_sync(self):
+        from cloud_manager import CloudManager
+
+        (self.source / "big.bin").write_bytes(os.urandom(100 * 1024))
+        for i in range(20):
+            (self.source / f"small{i}.txt").write_bytes(os.urandom(100))
+        manager = BackupManager(self.storage, packed=True)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX")
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+
+        with mock_aws():
+            cloud = CloudManager(None, "test", "test", "backups", region_name="us-east-1")
+            cloud.s3.create_bucket(Bucket="backups")
+            order = []
+            upload = cloud._upload
+
+            def recording_upload(local_path, key):
+                order.append(key)
+                return upload(local_path, key)
+
+            cloud._upload = recording_upload
+            report = cloud.sync(manager, jobs=4)
+            self.assertEqual(report.errors, [])
+            self.assertEqual(report.manifests, 1)
+
+            remote = set(cloud.list_keys(""))
+            loose = {
+                f"objects/{p.parent.name}/{p.name}"
+                for p in self.storage.glob("objects/??/*")
+            }
+            packs = {
+                f"objects/packs/{p.name}" for p in self.storage.glob("objects/packs/*")
+            }
+            manifest_key = f"ProjectX/{ver_dir.name}/manifest.dat"
+            self.assertTrue(loose and packs)
+            self.assertTrue(loose | packs | {manifest_key, "catalog.json"} <= remote)
+            # Objects first, then the manifest, the catalog last
+            self.assertEqual(order[-2:], [manifest_key, "catalog.json"])
+
+            self.assertEqual(cloud.sync(manager).uploaded, 0)
+
+            # A remote object lost after the listing is only seen with a fresh listing
+            cloud.s3.delete_object(Bucket="backups", Key=sorted(loose)[0])
+            self.assertEqual(cloud.sync(manager).uploaded, 0)
+            self.assertEqual(cloud.sync(manager, refresh=True).uploaded, 1)
+
+            # A backup writing at the same time (a watch daemon) keeps appending to its
+            # pack: a pack that grew after it was uploaded goes up again
+            ver_dir.rename(ver_dir.with_name("2020-01-01_00-00-00"))
+            writer = BackupManager(self.storage, packed=True)
+            for n in range(2):
+                for i in range(5):
+                    (self.source / f"new{n}_{i}.txt").write_bytes(os.urandom(100))
+                writer.create_backup(scan_files(self.source), self.source, "ProjectX")
+                v_name = f"2020-01-0{n + 2}_00-00-00"
+                v_dir = writer._find_target_versions("ProjectX")[-1]
+                v_dir.rename(v_dir.with_name(v_name))
+                self.assertEqual(cloud.sync(manager).errors, [])
+                self.assertIn(f"ProjectX/{v_name}/manifest.dat", cloud.list_keys("ProjectX/"))
+            writer.close()
+            remote = dict(cloud.list_sizes("objects/packs/"))
+            for p in self.storage.glob("objects/packs/*"):
+                self.assertEqual(remote[f"objects/packs/{p.name}"], p.stat().st_size)
+        print("[✓] Cloud sync test passed")
+
+    @unittest.skipIf(mock_aws is None, "moto is not installed")
+    def test_restore_from_cloud(self):
+        from cloud_manager import CloudManager
+
+        files = {"secret.txt": self.file_content, "big.bin": os.urandom(100 * 1024)}
+        for i in range(10):
+            files[f"small{i}.txt"] = os.urandom(100)
+        # Same content twice: one object, downloaded once
+        files["copy.bin"] = files["big.bin"]
+        for name, data in files.items():
+            (self.source / name).write_bytes(data)
+        manager = BackupManager(self.storage, packed=True)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX")
+        ver_dir = manager._find_target_versions("ProjectX")[0]
+
+        with mock_aws():
+            cloud = CloudManager(None, "test", "test", "backups", region_name="us-east-1")
+            cloud.s3.create_bucket(Bucket="backups")
+            self.assertEqual(cloud.sync(manager).errors, [])
+            manager.close()
+
+            # Only the manifests and the indexes are left locally
+            for p in self.storage.glob("objects/??/*"):
+                p.unlink()
+            for p in self.storage.glob("objects/packs/*.pack"):
+                p.unlink()
+
+            manager = BackupManager(self.storage, packed=True)
+            report = manager.restore_version(
+                "ProjectX", ver_dir.name, self.restore, jobs=4, cloud=cloud
+            )
+            self.assertEqual(len(report.ok), len(files))
+            restored = self.restore / f"ProjectX_{ver_dir.name}"
+            for name, data in files.items():
+                self.assertEqual((restored / name).read_bytes(), data)
+            cached = list((self.storage / "objects" / "cache").iterdir())
+            self.assertEqual(len(cached), len(files) - 1)
+
+            # A small cache keeps only what is pinned, the restore still succeeds
+            shutil.rmtree(self.storage / "objects" / "cache")
+            shutil.rmtree(restored)
+            report = manager.restore_version(
+                "ProjectX", ver_dir.name, self.restore, cloud=cloud, cache_bytes=1024
+            )
+            self.assertEqual(len(report.ok), len(files))
+            size = sum(
+                p.stat().st_size for p in (self.storage / "objects" / "cache").iterdir()
+            )
+            self.assertLessEqual(size, 1024)
+            manager.close()
+        print("[✓] Restore from cloud test passed")
+
+    def test_prune(self):
+        manager = BackupManager(self.storage, packed=True)
+        old_data = os.urandom(100 * 1024)
+        (self.source / "old.bin").write_bytes(old_data)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        old_manifest = open_manifest(manager._find_target_versions("ProjectX")[0])
+        entry = dict(old_manifest.items())["old.bin"]
+        store_hash = manager._get_entry_store_hashes(entry, old_manifest.info["salt"])[0]
+        old_object = manager.store.loose_path(store_hash)
+        self.assertTrue(old_object.exists())
+
+        # Versions of other days: the names are their timestamps
+        v_dir = manager._find_target_versions("ProjectX")[0]
+        v_dir.rename(v_dir.with_name("2020-01-01_00-00-00"))
+        (self.source / "old.bin").unlink()
+        (self.source / "new.bin").write_bytes(os.urandom(100 * 1024))
+        # A new salt: every object is stored again
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        v_dir = manager._find_target_versions("ProjectX")[-1]
+        v_dir.rename(v_dir.with_name("2020-01-02_00-00-00"))
+        salt = open_manifest(v_dir.with_name("2020-01-02_00-00-00")).info["salt"]
+        manager.create_backup(
+            scan_files(self.source), self.source, "ProjectX", password="123", forced_salt=salt
+        )
+        manager.rebuild_catalog()
+        manager.close()
+
+        policy = RetentionPolicy(keep_last=2)
+        self.assertEqual(
+            select_versions(
+                ["2020-01-01_10-00-00", "2020-01-01_12-00-00", "2020-01-02_00-00-00"],
+                RetentionPolicy(keep_daily=2),
+            ),
+            {"2020-01-01_12-00-00", "2020-01-02_00-00-00"},
+        )
+
+        manager = BackupManager(self.storage, packed=True)
+        # A long-running process (a watch daemon) that loaded the store before the prune
+        stale = BackupManager(self.storage, packed=True)
+        self.assertTrue(stale.store.exists(store_hash))
+        dry = prune(manager, policy, dry_run=True, grace=0)
+        self.assertEqual(dry.removed_versions, ["ProjectX/2020-01-01_00-00-00"])
+        self.assertGreaterEqual(dry.reclaimable_bytes, len(old_data))
+        self.assertTrue(old_object.exists())
+
+        report = prune(manager, policy, jobs=2, grace=0)
+        self.assertEqual(report.removed_versions, dry.removed_versions)
+        self.assertEqual(report.reclaimable_bytes, dry.reclaimable_bytes)
+        self.assertFalse(old_object.exists())
+        self.assertFalse((self.storage / "ProjectX" / "2020-01-01_00-00-00").exists())
+        self.assertFalse(manager.store.exists(old_object.name))
+
+        # What is left restores, and a second prune finds nothing
+        for v_dir in manager._find_target_versions("ProjectX"):
+            restored = manager.restore_version("ProjectX", v_dir.name, self.restore, password="123")
+            self.assertEqual(len(restored.ok), 2)
+        again = prune(manager, policy, grace=0)
+        self.assertEqual((again.dead_objects, again.removed_versions), (0, []))
+        manager.close()
+
+        # It reloads the index instead of skipping the deleted object
+        (self.source / "old.bin").write_bytes(old_data)
+        stale.create_backup(
+            scan_files(self.source),
+            self.source,
+            "ProjectX",
+            password="123",
+            forced_salt=old_manifest.info["salt"],
+        )
+        self.assertTrue(stale.store.exists(store_hash))
+        v_name = stale._find_target_versions("ProjectX")[-1].name
+        restored = stale.restore_version("ProjectX", v_name, self.restore, password="123")
+        self.assertEqual(len(restored.ok), 3)
+        self.assertEqual((self.restore / f"ProjectX_{v_name}" / "old.bin").read_bytes(), old_data)
+        stale.close()
+        print("[✓] Prune test passed")
+
+    def test_benchmark_dataset_and_stages(self):
+        first, second = self.test_dir / "gen1", self.test_dir / "gen2"
+        for p in (first, second):
+            shutil.rmtree(p, ignore_errors=True)
+        self.assertEqual(
+            generate_dataset(first, "deep", scale=0.01, seed=7),
+            generate_dataset(second, "deep", scale=0.01, seed=7),
+        )
+        self.assertEqual(
+            sorted(scan_files(first).file_hashes.values()),
+            sorted(scan_files(second).file_hashes.values()),
+        )
+
+        work_dir = self.test_dir / "bench"
+        results = run_dataset(work_dir, "tiny", scale=0.01, combinations=[(True, "123")])
+        self.assertEqual(
+            [r.stage for r in results],
+            ["scan", "backup", "rescan", "backup-incremental", "restore"],
+        )
+        self.assertTrue(all(r.files == 50 and r.seconds > 0 for r in results))
+
+        rows = [asdict(r) for r in results]
+        slower = [dict(row, seconds=row["seconds"] * 2) for row in rows]
+        self.assertEqual(len(compare(slower, rows, 0.1)), len(rows))
+        self.assertEqual(compare(rows, slower, 0.1), [])
+        print("[✓] Benchmark test passed")
+
+    def test_stage_metrics_and_progress(self):
+        (self.source / "data.txt").write_bytes(b"log line\n" * 50000)
+        METRICS.reset()
+        manager = BackupManager(self.storage)
+        manager.create_backup(
+            scan_files(self.source), self.source, "ProjectX", password="123"
+        )
+        stages = METRICS.snapshot()
+        for stage in ("walk", "stat", "read", "hash", "exists", "compress", "pad", "encrypt"):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages["hash"]["bytes_in"], 450000 + len(self.file_content))
+        self.assertLess(stages["compress"]["bytes_out"], stages["compress"]["bytes_in"])
+
+        prom_path = self.test_dir / "metrics.prom"
+        METRICS.write_prometheus(prom_path)
+        text = prom_path.read_text()
+        self.assertIn("# TYPE smart_backup_stage_seconds_total counter", text)
+        self.assertIn('smart_backup_stage_bytes_in_total{stage="hash"} 450025', text)
+
+        # Many events within the interval draw one line, the last one always draws
+        out = io.StringIO()
+        renderer = ProgressRenderer(interval=60)
+        with contextlib.redirect_stdout(out):
+            for i in range(1, 1001):
+                renderer(ProgressEvent(processed=i, total=1000))
+        self.assertEqual(out.getvalue().count("\r"), 2)
+        self.assertIn("MB/s", out.getvalue())
+        self.assertTrue(out.getvalue().endswith("Done!\n"))
+        print("[✓] Stage metrics test passed")
+
+    def test_verify_without_restore(self):
+        (self.source / "big.bin").write_bytes(os.urandom(200 * 1024))
+        (self.source / "copy.bin").write_bytes((self.source / "big.bin").read_bytes())
+        (self.source / "text.txt").write_bytes(b"some text\n" * 1000)
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        salt = open_manifest(manager._find_target_versions("ProjectX")[0]).info["salt"]
+        # A second version of the same content shares every object
+        v_dir = manager._find_target_versions("ProjectX")[0]
+        v_dir.rename(v_dir.with_name("2020-01-01_00-00-00"))
+        manager.create_backup(
+            scan_files(self.source), self.source, "ProjectX", password="123", forced_salt=salt
+        )
+        manager.rebuild_catalog()
+
+        report = verify(manager, "ProjectX", password="123", jobs=2)
+        self.assertEqual((report.versions, report.checked), (2, 3))
+        self.assertEqual(report.damaged + report.missing, [])
+        self.assertEqual(list(self.restore.iterdir()), [])
+
+        self.assertEqual(verify(manager, password="123", sample_percent=0).sampled_out, 3)
+        self.assertEqual(verify(manager, "ProjectX", "2020-01-01_00-00-00").unverifiable, 3)
+
+        objects = sorted(self.storage.glob("objects/??/*"), key=lambda p: p.stat().st_size)
+        damaged = bytearray(objects[-1].read_bytes())
+        damaged[100] ^= 0xFF
+        objects[-1].write_bytes(damaged)
+        objects[0].unlink()
+        report = verify(manager, password="123")
+        self.assertEqual((len(report.damaged), len(report.missing)), (1, 1))
+        self.assertIn("authentication failed", report.damaged[0])
+        print("[✓] Verify test passed")
+
+    def test_partial_restore_and_list(self):
+        for i in range(30):
+            sub = self.source / ("conf" if i % 3 == 0 else "data") / ("old" if i % 2 else "")
+            sub.mkdir(parents=True, exist_ok=True)
+            (sub / f"file{i}.{'yaml' if i % 5 else 'json'}").write_bytes(b"content %d" % i)
+        # Siblings whose names start with the prefix directory
+        (self.source / "conf_old").mkdir()
+        (self.source / "conf_old" / "file.yaml").write_bytes(b"old")
+        (self.source / "confx.yaml").write_bytes(b"x")
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        v_name = manager._find_target_versions("ProjectX")[0].name
+
+        report = manager.restore_version(
+            "ProjectX",
+            v_name,
+            self.restore,
+            password="123",
+            prefix="conf/",
+            include=["*.yaml"],
+            exclude=["old/"],
+        )
+        restored_dir = self.restore / f"ProjectX_{v_name}"
+        restored = sorted(
+            str(p.relative_to(restored_dir)) for p in restored_dir.rglob("*") if p.is_file()
+        )
+        self.assertEqual(
+            restored, [f"conf/file{i}.yaml" for i in (12, 18, 24, 6)]
+        )
+        self.assertEqual((report.total, len(report.ok)), (4, 4))
+
+        # Listing needs the manifest only, not even the objects
+        shutil.rmtree(self.storage / "objects")
+        listed = dict(manager.list_version("ProjectX", v_name, include=["conf/old/*"]))
+        self.assertEqual(
+            sorted(listed),
+            ["conf/old/file15.json"] + [f"conf/old/file{i}.yaml" for i in (21, 27, 3, 9)],
+        )
+        self.assertEqual(listed["conf/old/file3.yaml"]["size"], len(b"content 3"))
+        self.assertEqual(
+            listed["conf/old/file3.yaml"]["hash"], hashlib.sha256(b"content 3").hexdigest()
+        )
+        for prefix in ("conf", "/conf/", "conf/old"):
+            listed = [p for p, _ in manager.list_version("ProjectX", v_name, prefix=prefix)]
+            self.assertEqual(len(listed), 10 if prefix.strip("/") == "conf" else 5)
+            self.assertTrue(all(p.startswith(f"{prefix.strip('/')}/") for p in listed))
+        listed = [p for p, _ in manager.list_version("ProjectX", v_name, prefix="confx.yaml")]
+        self.assertEqual(listed, ["confx.yaml"])
+        print("[✓] Partial restore test passed")
+
+    def test_restore_decodes_duplicates_once(self):
+        vendored = os.urandom(50 * 1024)
+        for i in range(10):
+            (self.source / f"app{i}" / "vendor").mkdir(parents=True)
+            (self.source / f"app{i}" / "vendor" / "lib.js").write_bytes(vendored)
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ProjectX", password="123")
+        v_name = manager._find_target_versions("ProjectX")[0].name
+
+        for hardlink in (False, True):
+            METRICS.reset()
+            target = self.restore / str(hardlink)
+            report = manager.restore_version(
+                "ProjectX", v_name, target, password="123", jobs=4, hardlink=hardlink
+            )
+            self.assertEqual(len(report.ok), 11)
+            # One object for the ten copies and one for secret.txt
+            self.assertEqual(METRICS.snapshot()["decrypt"]["calls"], 2)
+            restored = [
+                target / f"ProjectX_{v_name}" / f"app{i}" / "vendor" / "lib.js"
+                for i in range(10)
+            ]
+            self.assertTrue(all(path.read_bytes() == vendored for path in restored))
+            inodes = {path.stat().st_ino for path in restored}
+            self.assertEqual(len(inodes), 1 if hardlink else 10)
+        print("[✓] Duplicate restore test passed")
+
+    def test_durability_levels(self):
+        for i in range(20):
+            (self.source / f"file{i}.txt").write_bytes(b"file %d" % i)
+        syncs = {}
+        for durability in ("none", "batch", "strict"):
+            METRICS.reset()
+            storage = self.storage / durability
+            manager = BackupManager(storage, durability=durability)
+            manager.create_backup(scan_files(self.source), self.source, "ProjectX")
+            manager.close()
+            syncs[durability] = METRICS.snapshot().get("sync", {}).get("calls", 0)
+
+            manager = BackupManager(storage)
+            v_name = manager._find_target_versions("ProjectX")[0].name
+            report = manager.restore_version("ProjectX", v_name, self.restore / durability)
+            self.assertEqual(len(report.ok), 21)
+        # No fsync at all, a few batches, one per object
+        self.assertEqual(syncs["none"], 0)
+        self.assertGreater(syncs["batch"], 0)
+        self.assertGreater(syncs["strict"], syncs["batch"])
+
+        # In batch mode a pack index record is written only after the pack data is synced
+        store = ObjectStore(self.storage / "packed" / "objects", packed=True)
+        store.commit_spool("ab" * 32, store.spool([b"small object"]))
+        idx_path = next((self.storage / "packed" / "objects" / "packs").glob("*.idx"))
+        self.assertEqual(idx_path.read_bytes(), b"")
+        store.flush()
+        self.assertEqual(len(idx_path.read_bytes()), 44)
+        store.close()
+
+        # In strict mode the object index lists an object as soon as it is written
+        store = ObjectStore(self.storage / "strict-index" / "objects", durability="strict")
+        store.commit_spool("ef" * 32, store.spool([b"loose object"]))
+        self.assertEqual(
+            store.index_path.read_bytes(), object_store_module.OBJECT_INDEX_HEADER + b"\xef" * 32
+        )
+        store.close()
+        # A new pack syncs packs/ and objects/ before anything refers to it
+        synced = []
+        saved = object_store_module.fsync_dir
+        object_store_module.fsync_dir = synced.append
+        try:
+            objects_path = self.storage / "new-packs" / "objects"
+            store = ObjectStore(objects_path, packed=True)
+            store.commit_spool("cd" * 32, store.spool([b"small object"]))
+            self.assertEqual(synced, [objects_path / "packs", objects_path])
+            store.close()
+        finally:
+            object_store_module.fsync_dir = saved
+
+        with self.assertRaises(ValueError):
+            BackupManager(self.storage / "other", durability="sometimes")
+        print("[✓] Durability test passed")
+
+    def tearDown(self):
+        # We remove the garbage after the test
+        # shutil.rmtree(self.test_dir)
+        pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,111 @@
-import sys
-from classes import ProgressEvent
-
-
-def show_progress(event: ProgressEvent):
-    if event.total is None:
-        msg = f"\r[SCANNING] Files found: {event.processed} | Current: {event.current_file[:30]}..."
-    else:
-        scale_width = 30
-        percent = (event.processed / event.total) * 100
-        filled = int(scale_width * event.processed / event.total)
-        bar = "#" * filled + "-" * (scale_width - filled)
-        msg = f"\r[COPYING] |{bar}| {percent:.1f}% ({event.processed}/{event.total})"
-
-    sys.stdout.write(msg)
-    sys.stdout.flush()
-
-    if event.total and event.processed >= event.total:
-        sys.stdout.write("\nDone!\n")
-        sys.stdout.flush()
+import mmap
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Iterable, Iterator, Optional
+from classes import ProgressEvent
+from metrics import METRICS, StageMetrics
+
+# The progress line is redrawn at most this often (seconds)
+PROGRESS_INTERVAL = 0.2
+# How many tasks each worker may have queued ahead
+PENDING_PER_JOB = 4
+
+
+def pread(fd: int, length: int, offset: int) -> bytes:
+    # os.pread does not move the file position, so threads can share one descriptor.
+    # Windows has no pread: there the range is read through a mapping made for the call
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    if length <= 0 or os.fstat(fd).st_size <= offset:
+        return b""
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as view:
+        return view[offset : offset + length]
+
+
+def in_order(
+    items: Iterable[tuple], jobs: int, per_job: int = PENDING_PER_JOB
+) -> Iterator[tuple]:
+    # Tuples whose last element is a task (a Future, or anything else when the work runs
+    # inline), given back in the order they came in. An item comes out as soon as its
+    # task and all before it are done, or when more than jobs * per_job are waiting,
+    # so memory stays bounded and the results keep the submission order. Leaving the
+    # loop early leaves the rest uncollected: shut the pool down with cancel_futures
+    pending = deque()
+    max_pending = max(1, jobs) * per_job
+    for item in items:
+        pending.append(item)
+        while pending and (
+            len(pending) > max_pending
+            or not isinstance(pending[0][-1], Future)
+            or pending[0][-1].done()
+        ):
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def _format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class ProgressRenderer:
+    # Draws the progress line at most every interval seconds, whatever the file rate.
+    # The speed is the "read" counter of the stage metrics (bytes read from the source
+    # or from the store), the ETA follows the file count.
+    def __init__(self, metrics: StageMetrics = METRICS, interval: float = PROGRESS_INTERVAL):
+        self.metrics = metrics
+        self.interval = interval
+        self._started = None
+        self._bytes_at_start = 0
+        self._last_render = 0.0
+        self._last_processed = 0
+
+    def __call__(self, event: ProgressEvent):
+        now = time.monotonic()
+        if self._started is None or event.processed < self._last_processed:
+            # A new run
+            self._started = now
+            self._bytes_at_start = self.metrics.bytes_in("read")
+            self._last_render = 0.0
+        self._last_processed = event.processed
+        done = bool(event.total) and event.processed >= event.total
+        if not done and now - self._last_render < self.interval:
+            return
+        self._last_render = now
+
+        elapsed = max(now - self._started, 1e-6)
+        speed = (self.metrics.bytes_in("read") - self._bytes_at_start) / elapsed / (1024**2)
+        eta = None
+        if event.total and event.processed:
+            eta = (event.total - event.processed) * elapsed / event.processed
+
+        sys.stdout.write(_render(event, speed, eta))
+        sys.stdout.flush()
+
+        if done:
+            sys.stdout.write("\nDone!\n")
+            sys.stdout.flush()
+            self._started = None
+
+
+def _render(event: ProgressEvent, speed: float, eta: Optional[float]) -> str:
+    if event.total is None and event.found is not None:
+        return f"\r[COPYING] {event.processed} of {event.found} found so far | {speed:.1f} MB/s | Current: {event.current_file[:30]}..."
+    if event.total is None:
+        return f"\r[SCANNING] Files found: {event.processed} | {speed:.1f} MB/s | Current: {event.current_file[:30]}..."
+    scale_width = 30
+    percent = (event.processed / event.total) * 100
+    filled = int(scale_width * event.processed / event.total)
+    bar = "#" * filled + "-" * (scale_width - filled)
+    return (
+        f"\r[COPYING] |{bar}| {percent:.1f}% ({event.processed}/{event.total})"
+        f" | {speed:.1f} MB/s | ETA {_format_eta(eta or 0)}"
+    )
+
+
+show_progress = ProgressRenderer()
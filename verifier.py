@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from cryptography.exceptions import InvalidTag
+
+from classes import VerifyReport
+from crypter import FileCrypter
+from manager import BackupManager, get_entry_objects, is_plain_object
+from manifest import open_manifest
+from object_format import STREAM_FORMAT, decode_stream, read_blocks
+from utils import in_order
+
+logger = logging.getLogger(__name__)
+
+# The rate limit allows this many seconds of reads ahead of the budget
+BURST_SECONDS = 1.0
+
+
+class Throttle:
+    # At most rate bytes per second over all workers together
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size: int):
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now - BURST_SECONDS) + size / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _CountingReader:
+    # The object as decode_stream reads it: bytes are counted and paced
+    def __init__(self, f, throttle: Optional[Throttle]):
+        self._f = f
+        self._throttle = throttle
+        self.read_bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self.read_bytes += len(data)
+        if self._throttle and data:
+            self._throttle.consume(len(data))
+        return data
+
+
+def _sampled(digest: bytes, key: bytes, percent: float) -> bool:
+    # A keyed hash of the object picks it: every object has the same chance,
+    # and an object shared by many versions is picked or left out once
+    if percent >= 100:
+        return True
+    mixed = hashlib.blake2b(digest, key=key, digest_size=8).digest()
+    return int.from_bytes(mixed, "big") < percent / 100 * 2**64
+
+
+def check_object(
+    manager: BackupManager,
+    store_hash: str,
+    expected: Optional[str],
+    info: dict,
+    crypter,
+    salt_hex,
+    throttle: Optional[Throttle] = None,
+) -> tuple[str, int, Optional[str]]:
+    # Decodes one object block by block and compares the sha256 of its content with the
+    # manifest (deltas and signatures have no hash of their own, only their encoding is
+    # checked). Nothing is written. Returns (ok/damaged/missing, bytes read, problem)
+    try:
+        f = manager.store.open(store_hash)
+    except FileNotFoundError:
+        return "missing", 0, None
+    sha256 = hashlib.sha256()
+    with f:
+        reader = _CountingReader(f, throttle)
+        try:
+            if info.get("format", 1) == STREAM_FORMAT:
+                for piece in decode_stream(reader, crypter):
+                    sha256.update(piece)
+            elif "chunks" in info or is_plain_object(info, salt_hex):
+                for block in read_blocks(reader):
+                    sha256.update(block)
+            else:
+                sha256.update(
+                    manager._decode_legacy_object(
+                        reader.read(), info, crypter, salt_hex, True, True, store_hash
+                    )
+                )
+        except InvalidTag:
+            return "damaged", reader.read_bytes, "authentication failed"
+        except Exception as e:
+            return "damaged", reader.read_bytes, str(e)
+    if expected is not None and sha256.hexdigest() != expected:
+        return "damaged", reader.read_bytes, "hash mismatch"
+    return "ok", reader.read_bytes, None
+
+
+def verify(
+    manager: BackupManager,
+    project_name: Optional[str] = None,
+    version_name: Optional[str] = None,
+    password=None,
+    sample_percent: float = 100,
+    bytes_per_second: Optional[float] = None,
+    jobs: int = 1,
+) -> VerifyReport:
+    # Checks the objects of one version, of every version of a project, or of the
+    # whole storage, without restoring anything. Every unique object is checked
+    # once, however many files and versions share it.
+    report = VerifyReport()
+    throttle = Throttle(bytes_per_second) if bytes_per_second else None
+    sample_key = os.urandom(16)
+    # Store hashes of the objects already checked or left out, as binary digests
+    seen = set()
+    # The key is derived once per salt
+    crypters = {}
+
+    versions = [
+        v_dir
+        for v_dir in manager._find_target_versions(project_name)
+        if version_name is None or v_dir.name == version_name
+    ]
+    report.versions = len(versions)
+
+    def items():
+        for v_dir in versions:
+            manifest = open_manifest(v_dir)
+            salt_hex = manifest.info.get("salt")
+            crypter = None
+            if salt_hex and password:
+                if salt_hex not in crypters:
+                    crypters[salt_hex] = FileCrypter(password, bytes.fromhex(salt_hex))
+                crypter = crypters[salt_hex]
+            label = f"{v_dir.parent.name}/{v_dir.name}"
+            for rel_path, info in manifest.items():
+                for store_hash, obj_hash in get_entry_objects(info, salt_hex):
+                    digest = bytes.fromhex(store_hash)
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                    if not _sampled(digest, sample_key, sample_percent):
+                        report.sampled_out += 1
+                        continue
+                    if salt_hex and crypter is None:
+                        report.unverifiable += 1
+                        continue
+                    yield f"{label}: {rel_path}", store_hash, obj_hash, info, crypter, salt_hex
+
+    def collect(name, task):
+        status, read_bytes, problem = task.result()
+        report.checked += 1
+        report.checked_bytes += read_bytes
+        if status == "missing":
+            report.missing.append(name)
+        elif status == "damaged":
+            report.damaged.append(f"{name} ({problem})")
+
+    def submit_all(pool):
+        for name, store_hash, obj_hash, info, crypter, salt_hex in items():
+            task = pool.submit(
+                check_object, manager, store_hash, obj_hash, info, crypter, salt_hex, throttle
+            )
+            yield name, task
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for name, task in in_order(submit_all(pool), jobs):
+            collect(name, task)
+
+    for problem in (report.missing + report.damaged)[:5]:
+        logger.error(problem)
+    return report
@@ -0,0 +1,192 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from ignore_rules import IgnoreRules
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# A dirty path of "" means the whole tree has to be compared with what is known
+WHOLE_TREE = ""
+
+
+class InotifyWatcher:
+    # Watches every directory of the tree that the rules do not ignore. wait() returns
+    # the relative paths that changed: files, and directories that appeared or went
+    # away as a whole. A lost event queue (overflow) reports WHOLE_TREE.
+    def __init__(self, folder_path: Path, rules: IgnoreRules):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.folder_path = folder_path
+        self.rules = rules
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        try:
+            self._watch_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, rel_dir: str):
+        path = os.fsencode(self.folder_path / rel_dir)
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Gone already, its parent reports it
+                return False
+            # ENOSPC: fs.inotify.max_user_watches is too low for this tree
+            raise OSError(err, f"inotify_add_watch failed for {rel_dir or '.'}")
+        self._dirs[wd] = rel_dir
+        return True
+
+    def _watch_tree(self, rel_dir: str):
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            if not self._watch(current):
+                continue
+            try:
+                with os.scandir(self.folder_path / current) as it:
+                    for entry in it:
+                        rel_path = (
+                            os.path.join(current, entry.name) if current else entry.name
+                        )
+                        if entry.is_dir(follow_symlinks=False) and not self.rules.is_ignored(
+                            rel_path, True
+                        ):
+                            stack.append(rel_path)
+            except OSError as e:
+                logger.warning(f"Cannot watch {self.folder_path / current}: {e}")
+
+    def wait(self, timeout: float) -> set[str]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        dirty = set()
+        while True:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._parse(data, dirty)
+        return dirty
+
+    def _parse(self, data: bytes, dirty: set[str]):
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos : pos + length].rstrip(b"\0"))
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("The inotify queue overflowed, the whole tree is rescanned")
+                dirty.add(WHOLE_TREE)
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            rel_dir = self._dirs.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                dirty.add(rel_dir)
+                continue
+
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            is_dir = bool(mask & IN_ISDIR)
+            if self.rules.is_ignored(rel_path, is_dir):
+                continue
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been written before the watch was added,
+                # the directory is marked dirty and walked as a whole
+                self._watch_tree(rel_path)
+            dirty.add(rel_path)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    # Fallback without inotify: every interval the whole tree is compared with what
+    # is known (stat only, unchanged files are not read)
+    def __init__(self, folder_path: Path, rules: IgnoreRules, interval: float = 60):
+        self.folder_path = folder_path
+        self.rules = rules
+        self.interval = interval
+        self._next_poll = time.monotonic() + interval
+
+    def wait(self, timeout: float) -> set[str]:
+        delay = self._next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, delay))
+        self._next_poll = time.monotonic() + self.interval
+        return {WHOLE_TREE}
+
+    def close(self):
+        pass
+
+
+def open_watcher(folder_path: Path, rules: IgnoreRules, poll_interval: float = 60):
+    try:
+        return InotifyWatcher(folder_path, rules)
+    except (OSError, AttributeError, TypeError) as e:
+        # No inotify (another OS, no libc symbol) or too few watches for the tree
+        logger.warning(f"inotify is not available ({e}), polling every {poll_interval}s")
+        return PollingWatcher(folder_path, rules, poll_interval)